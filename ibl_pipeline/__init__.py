@@ -90,4 +90,34 @@ def get_one_api_public(password=None, url="https://openalyx.internationalbrainla
     return one
 
 
-one = get_one_api_public()
+class LazyOne(object):
+    """
+    Proxy to the ONE api instance, created with get_one_api_public at its first use,
+    so that importing ibl_pipeline does not connect to Alyx.
+    """
+
+    def __init__(self, factory=get_one_api_public):
+        self._factory = factory
+        self._one = None
+        self._initialized = False
+
+    def get(self):
+        """Create the ONE api instance on the first call, None if one-api is not installed"""
+        if not self._initialized:
+            self._one = self._factory()
+            self._initialized = True
+        return self._one
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+    def __bool__(self):
+        return self.get() is not None
+
+    def __repr__(self):
+        if not self._initialized:
+            return "<LazyOne: not initialized>"
+        return repr(self._one)
+
+
+one = LazyOne()
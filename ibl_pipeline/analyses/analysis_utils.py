@@ -1,3 +1,8 @@
+import hashlib
+import json
+import logging
+import multiprocessing
+
 import datajoint as dj
 import numpy as np
 import pandas as pd
@@ -7,8 +12,32 @@ import scipy
 from ibl_pipeline import acquisition, action, behavior, subject
 from ibl_pipeline.utils import psychofit as psy
 
+logger = logging.getLogger(__name__)
+
+
+# settings of the fits of fit_psych_curve, hashed with the fitted counts
+# for PsychFitCache, min, start and max of the slope and of the lapse rates.
+# optimizer: "fmin" for psychofit.mle_fit_psycho, "L-BFGS-B" for
+# psychofit.mle_fit_psycho_lbfgsb
+PSYCH_FIT_SETTINGS = {
+    "P_model": "erf_psycho_2gammas",
+    "optimizer": "fmin",
+    "nfits": 5,
+    "slope": [0.0, 20.0, 100.0],
+    "lapse": [0.0, 0.05, 1.0],
+}
+
 
 def compute_psych_pars(trials):
+    """Psychometric curve of the trials, fitted with erf_psycho_2gammas
+
+    Args:
+        trials (dj query): query of behavior.TrialSet.Trial
+
+    Returns:
+        dict: contrasts, trial counts, fraction of rightward choices and fitted
+            parameters
+    """
 
     trials = trials.proj(
         "trial_response_choice",
@@ -21,41 +50,82 @@ def compute_psych_pars(trials):
     signed_contrasts, n_trials_stim, n_trials_stim_right = q.fetch(
         "signed_contrast", "n", "n_right"
     )
-    signed_contrasts = signed_contrasts.astype(float)
-    n_trials_stim = n_trials_stim.astype(int)
-    n_trials_stim_right = n_trials_stim_right.astype(int)
+    return fit_psych_curve(signed_contrasts, n_trials_stim, n_trials_stim_right)
+
 
-    # merge left 0 and right 0
+def aggregate_psych_counts(signed_contrasts, n_trials_stim, n_trials_stim_right):
+    """Sort the counts by signed contrast, merging left 0 and right 0"""
     data = pd.DataFrame(
         {
-            "signed_contrasts": signed_contrasts,
-            "n_trials_stim": n_trials_stim,
-            "n_trials_stim_right": n_trials_stim_right,
+            "signed_contrasts": np.asarray(signed_contrasts).astype(float),
+            "n_trials_stim": np.asarray(n_trials_stim).astype(int),
+            "n_trials_stim_right": np.asarray(n_trials_stim_right).astype(int),
         }
     )
     data = data.groupby("signed_contrasts").sum()
 
-    signed_contrasts = np.unique(signed_contrasts)
-    n_trials_stim_right = np.array(data["n_trials_stim_right"])
-    n_trials_stim = np.array(data["n_trials_stim"])
+    return (
+        np.array(data.index) + 0.0,  # -0.0 as 0.0 for get_psych_fit_hash
+        np.array(data["n_trials_stim"]),
+        np.array(data["n_trials_stim_right"]),
+    )
+
+
+def get_psych_fit_hash(signed_contrasts, n_trials_stim, n_trials_stim_right):
+    """md5 of aggregated counts and of PSYCH_FIT_SETTINGS, key of PsychFitCache"""
+    h = hashlib.md5()
+    for values, dtype in (
+        (signed_contrasts, np.float64),
+        (n_trials_stim, np.int64),
+        (n_trials_stim_right, np.int64),
+    ):
+        h.update(np.ascontiguousarray(values, dtype=dtype).tobytes())
+    h.update(json.dumps(PSYCH_FIT_SETTINGS, sort_keys=True).encode())
+    return h.hexdigest()
 
+
+def fit_psych_pars(signed_contrasts, n_trials_stim, n_trials_stim_right):
+    """Fit erf_psycho_2gammas to aggregated counts, with the optimizer of
+    PSYCH_FIT_SETTINGS
+
+    Returns:
+        numpy.ndarray: bias, threshold, lapse_low and lapse_high
+    """
     prob_choose_right = np.divide(n_trials_stim_right, n_trials_stim)
 
     # convert to percentage and fit psychometric function
     contrasts = signed_contrasts * 100
-    pars, L = psy.mle_fit_psycho(
+    (slope_min, slope_start, slope_max) = PSYCH_FIT_SETTINGS["slope"]
+    (lapse_min, lapse_start, lapse_max) = PSYCH_FIT_SETTINGS["lapse"]
+    mle_fit_psycho = (
+        psy.mle_fit_psycho_lbfgsb
+        if PSYCH_FIT_SETTINGS["optimizer"] == "L-BFGS-B"
+        else psy.mle_fit_psycho
+    )
+    pars, L = mle_fit_psycho(
         np.vstack([contrasts, n_trials_stim, prob_choose_right]),
-        P_model="erf_psycho_2gammas",
-        parstart=np.array([np.mean(contrasts), 20.0, 0.05, 0.05]),
-        parmin=np.array([np.min(contrasts), 0.0, 0.0, 0.0]),
-        parmax=np.array([np.max(contrasts), 100.0, 1, 1]),
+        P_model=PSYCH_FIT_SETTINGS["P_model"],
+        parstart=np.array([np.mean(contrasts), slope_start, lapse_start, lapse_start]),
+        parmin=np.array([np.min(contrasts), slope_min, lapse_min, lapse_min]),
+        parmax=np.array([np.max(contrasts), slope_max, lapse_max, lapse_max]),
+        nfits=PSYCH_FIT_SETTINGS["nfits"],
     )
+    return pars
 
+
+def _get_psych_fit_cache():
+    # imported here, ibl_pipeline.analyses.behavior imports this module
+    from ibl_pipeline.analyses.behavior import PsychFitCache
+
+    return PsychFitCache
+
+
+def _psych_results(signed_contrasts, n_trials_stim, n_trials_stim_right, pars):
     return {
         "signed_contrasts": signed_contrasts,
         "n_trials_stim": n_trials_stim,
         "n_trials_stim_right": n_trials_stim_right,
-        "prob_choose_right": prob_choose_right,
+        "prob_choose_right": np.divide(n_trials_stim_right, n_trials_stim),
         "bias": pars[0],
         "threshold": pars[1],
         "lapse_low": pars[2],
@@ -63,6 +133,142 @@ def compute_psych_pars(trials):
     }
 
 
+def fit_psych_curve(signed_contrasts, n_trials_stim, n_trials_stim_right, cache=True):
+    """Fit erf_psycho_2gammas to the number of trials and of rightward choices
+    for each signed contrast, see compute_psych_pars
+
+    With cache, the parameters are looked up in PsychFitCache by the hash of the
+    aggregated counts and only fitted, then cached, if missing.
+    """
+    counts = aggregate_psych_counts(
+        signed_contrasts, n_trials_stim, n_trials_stim_right
+    )
+    if not cache:
+        return _psych_results(*counts, fit_psych_pars(*counts))
+
+    fit_cache = _get_psych_fit_cache()
+    fit_hash = get_psych_fit_hash(*counts)
+    pars = fit_cache.fetch_fits([fit_hash]).get(fit_hash)
+    if pars is None:
+        pars = fit_psych_pars(*counts)
+        fit_cache.insert_fits({fit_hash: pars})
+    return _psych_results(*counts, pars)
+
+
+def fetch_psych_counts(trials, group_by=()):
+    """Number of trials, of rightward and of leftward choices for each session,
+    attribute of group_by and signed contrast, in one grouped fetch
+
+    Args:
+        trials (dj query): query of behavior.TrialSet.Trial of many sessions
+        group_by (tuple, optional): other attributes of trials to group by,
+            e.g. ("trial_stim_prob_left",). Defaults to ().
+
+    Returns:
+        list: dicts of the TrialSet primary key, group_by, signed_contrast,
+            n, n_right and n_left
+    """
+    attrs = behavior.TrialSet.primary_key + list(group_by) + ["signed_contrast"]
+    trials = trials.proj(
+        "trial_response_choice",
+        *group_by,
+        signed_contrast="trial_stim_contrast_right \
+        - trial_stim_contrast_left",
+    )
+    q = dj.U(*attrs).aggr(
+        trials,
+        n="count(*)",
+        n_right='sum(trial_response_choice="CCW")',
+        n_left='sum(trial_response_choice="CW")',
+    )
+    return q.fetch(as_dict=True)
+
+
+def _fit_psych_group(args):
+    key, counts = args
+    try:
+        return fit_psych_pars(*counts)
+    except Exception:
+        logger.exception(f"Psychometric fit failed for {key}")
+        return None
+
+
+def compute_psych_pars_batch(counts, group_by, processes=None):
+    """Fit the psychometric curves of many groups of trials, e.g. sessions.
+    The fits are looked up in PsychFitCache in one query, and only the missing
+    ones are fitted, then cached in one insert.
+
+    Args:
+        counts (list): per contrast counts from fetch_psych_counts
+        group_by (list): attributes of counts identifying a curve
+        processes (int, optional): number of worker processes fitting the curves.
+            Defaults to None, fitting in the current process.
+
+    Returns:
+        list: for each curve successfully fitted, dict of the group_by values,
+            the results of compute_psych_pars and performance_easy, None if there
+            were no easy trials
+    """
+    groups = {}
+    for c in counts:
+        groups.setdefault(tuple(c[attr] for attr in group_by), []).append(c)
+
+    aggregated, performance_easy = {}, {}
+    for group, group_counts in groups.items():
+        signed_contrast = np.array([float(c["signed_contrast"]) for c in group_counts])
+        n, n_right, n_left = (
+            np.array([int(c[column]) for c in group_counts])
+            for column in ("n", "n_right", "n_left")
+        )
+        aggregated[group] = aggregate_psych_counts(signed_contrast, n, n_right)
+
+        # same as compute_performance_easy
+        easy = np.abs(signed_contrast) > 0.499
+        performance_easy[group] = (
+            (
+                n_right[easy & (signed_contrast > 0)].sum()
+                + n_left[easy & (signed_contrast < 0)].sum()
+            )
+            / n[easy].sum()
+            if n[easy].sum()
+            else None
+        )
+
+    fit_cache = _get_psych_fit_cache()
+    fit_hashes = {
+        group: get_psych_fit_hash(*counts) for group, counts in aggregated.items()
+    }
+    fits = fit_cache.fetch_fits(list(set(fit_hashes.values())))
+
+    tasks = [
+        (dict(zip(group_by, group)), aggregated[group])
+        for group in groups
+        if fit_hashes[group] not in fits
+    ]
+    if processes and processes > 1:
+        with multiprocessing.Pool(processes) as pool:
+            new_pars = pool.map(_fit_psych_group, tasks, chunksize=16)
+    else:
+        new_pars = map(_fit_psych_group, tasks)
+
+    new_fits = {}
+    for (key, _), pars in zip(tasks, new_pars):
+        if pars is not None:
+            new_fits[fit_hashes[tuple(key[attr] for attr in group_by)]] = pars
+    fit_cache.insert_fits(new_fits)
+    fits.update(new_fits)
+
+    return [
+        {
+            **dict(zip(group_by, group)),
+            **_psych_results(*aggregated[group], fits[fit_hashes[group]]),
+            "performance_easy": performance_easy[group],
+        }
+        for group in groups
+        if fit_hashes[group] in fits
+    ]
+
+
 def compute_performance_easy(trials):
     trials = trials.proj(
         "trial_response_choice",
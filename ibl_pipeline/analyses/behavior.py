@@ -41,6 +41,50 @@ def compute_reaction_time(trials, stim_on_type="stim on"):
     return median_rt
 
 
+@schema
+class PsychFitCache(dj.Manual):
+    definition = """
+    # parameters fitted by analysis_utils.fit_psych_curve, by hash of the counts
+    psych_fit_hash:     char(32)    # analysis_utils.get_psych_fit_hash
+    ---
+    bias:               double
+    threshold:          double
+    lapse_low:          double
+    lapse_high:         double
+    fit_ts=CURRENT_TIMESTAMP: timestamp
+    """
+
+    _pars = ("bias", "threshold", "lapse_low", "lapse_high")
+
+    @classmethod
+    def fetch_fits(cls, fit_hashes):
+        """Cached parameters of the hashes
+
+        Returns:
+            dict: hash -> array of bias, threshold, lapse_low and lapse_high,
+                for the hashes in the cache
+        """
+        if not len(fit_hashes):
+            return {}
+        entries = (cls & [{"psych_fit_hash": h} for h in fit_hashes]).fetch(
+            "psych_fit_hash", *cls._pars, as_dict=True
+        )
+        return {
+            e["psych_fit_hash"]: np.array([e[p] for p in cls._pars]) for e in entries
+        }
+
+    @classmethod
+    def insert_fits(cls, fits):
+        """Cache fits, dict of hash -> bias, threshold, lapse_low and lapse_high"""
+        cls.insert(
+            [
+                dict(psych_fit_hash=h, **dict(zip(cls._pars, map(float, pars))))
+                for h, pars in fits.items()
+            ],
+            skip_duplicates=True,
+        )
+
+
 @schema
 class PsychResults(dj.Computed):
     definition = """
@@ -109,10 +153,11 @@ class PsychResultsBlock(dj.Computed):
                 )
 
                 # compute psych results
+                prob_left_block = round(p_left * 10) * 10
                 psych_results = utils.compute_psych_pars(trials_sub)
                 psych_results = {**key, **psych_results}
                 psych_results["prob_left"] = prob_left["trial_stim_prob_left"]
-                psych_results["prob_left_block"] = round(p_left * 10) * 10
+                psych_results["prob_left_block"] = prob_left_block
 
                 self.insert1(psych_results)
 
@@ -125,6 +170,84 @@ class PsychResultsBlock(dj.Computed):
             self.insert1(psych_results)
 
 
+def populate_psych_results(restriction={}, processes=None, chunksz=500):
+    """Populate PsychResults and PsychResultsBlock for chunks of sessions at a time:
+    one grouped fetch of the per contrast counts of the chunk, fits in a pool of
+    processes and one insert of the results, instead of queries for each key.
+    Sessions with a failed fit, of the session or of any of its blocks, are not
+    inserted and left to populate.
+
+    Args:
+        restriction (optional): restriction of the sessions. Defaults to all.
+        processes (int, optional): number of worker processes fitting the curves.
+            Defaults to None, fitting in the current process.
+        chunksz (int, optional): number of sessions per chunk. Defaults to 500.
+    """
+    keys = ((PsychResults.key_source - PsychResults) & restriction).fetch("KEY")
+    for i in range(0, len(keys), chunksz):
+        chunk = keys[i : i + chunksz]
+        group_by = behavior.TrialSet.primary_key
+        counts = utils.fetch_psych_counts(behavior.TrialSet.Trial & chunk)
+        results = utils.compute_psych_pars_batch(counts, group_by, processes=processes)
+        performance = {
+            (t["subject_uuid"], t["session_start_time"]): t["n_correct_trials"]
+            / t["n_trials"]
+            for t in (behavior.TrialSet & chunk).fetch(
+                *group_by, "n_trials", "n_correct_trials", as_dict=True
+            )
+        }
+        PsychResults.insert(
+            [
+                dict(r, performance=performance[tuple(r[a] for a in group_by)])
+                for r in results
+            ],
+            allow_direct_insert=True,
+            skip_duplicates=True,
+        )
+
+    keys = ((PsychResultsBlock.key_source - PsychResultsBlock) & restriction).fetch(
+        "KEY"
+    )
+    for i in range(0, len(keys), chunksz):
+        chunk = keys[i : i + chunksz]
+        group_by = behavior.TrialSet.primary_key + ["trial_stim_prob_left"]
+        biased = {
+            (s["subject_uuid"], s["session_start_time"])
+            for s in (
+                acquisition.Session
+                & chunk
+                & 'task_protocol like "%biased%" or task_protocol like "%ephys%"'
+            ).fetch(*behavior.TrialSet.primary_key, as_dict=True)
+        }
+        counts = utils.fetch_psych_counts(
+            behavior.TrialSet.Trial & chunk, group_by=("trial_stim_prob_left",)
+        )
+        # a single block with prob_left 0.5 for the unbiased sessions
+        for c in counts:
+            if (c["subject_uuid"], c["session_start_time"]) not in biased:
+                c["trial_stim_prob_left"] = 0.5
+        results = utils.compute_psych_pars_batch(counts, group_by, processes=processes)
+        # the blocks of a session are inserted only if all of them were fitted
+        fitted = {tuple(r[attr] for attr in group_by) for r in results}
+        failed = {
+            (c["subject_uuid"], c["session_start_time"])
+            for c in counts
+            if tuple(c[attr] for attr in group_by) not in fitted
+        }
+        entries = []
+        for r in results:
+            if (r["subject_uuid"], r["session_start_time"]) in failed:
+                continue
+            r.pop("performance_easy")
+            prob_left = r.pop("trial_stim_prob_left")
+            entries.append(
+                dict(r, prob_left=prob_left, prob_left_block=round(prob_left * 10) * 10)
+            )
+        PsychResultsBlock.insert(
+            entries, allow_direct_insert=True, skip_duplicates=True
+        )
+
+
 @schema
 class ReactionTime(dj.Computed):
     definition = """
@@ -3,6 +3,7 @@ import logging
 
 import datajoint as dj
 import numpy as np
+import pandas as pd
 
 from ibl_pipeline import acquisition, data, mode, one, reference, subject
 
@@ -133,6 +134,11 @@ class CompleteTrialSession(dj.Computed):
         "_ibl_trials.itiDuration.npy",
     ]
 
+    # for update.populate_incremental, sessions with newly created trials datasets
+    watermark_source = data.DataSet & 'dataset_name LIKE "_ibl_trials.%"'
+    watermark_attr = "created_datetime"
+    watermark_retry = IncompleteTrialSession
+
     def get_missing_files(self, key):
         datasets = (
             data.FileRecord & key & 'repo_name LIKE "flatiron_%"' & {"exists": 1}
@@ -224,6 +230,81 @@ class CompleteTrialSession(dj.Computed):
             )
 
 
+# TrialSet.Trial attributes, ONE trials attribute and the CompleteTrialSession status
+# deciding whether the attribute is loaded, NaN values are inserted as NULL
+TRIAL_ATTRIBUTES = (
+    ("trial_response_time", "response_times", None),
+    ("trial_feedback_time", "feedback_times", None),
+    ("trial_feedback_type", "feedbackType", None),
+    ("trial_stim_prob_left", "probabilityLeft", None),
+    ("trial_stim_on_time", "stimOn_times", "stim_on_times_status"),
+    ("trial_rep_num", "repNum", "rep_num_status"),
+    ("trial_included", "included", "included_status"),
+    ("trial_go_cue_time", "goCue_times", "go_cue_times_status"),
+    ("trial_go_cue_trigger_time", "goCueTrigger_times", "go_cue_trigger_times_status"),
+    ("trial_reward_volume", "rewardVolume", "reward_volume_status"),
+    ("trial_iti_duration", "itiDuration", "iti_duration_status"),
+)
+
+RESPONSE_CHOICES = {-1: "CCW", 0: "No Go", 1: "CW"}
+
+
+def get_trial_entries(trials, status, key):
+    """Build the TrialSet.Trial entries of a session in one pass over the trial arrays
+
+    Trials with a NaN end time, choice or probabilityLeft are skipped, NaN contrasts
+    are set to 0 and the other NaN values are inserted as NULL.
+
+    Args:
+        trials (dict): ONE trials object
+        status (dict): CompleteTrialSession entry of the session
+        key (dict): primary key of the session
+
+    Returns:
+        numpy.ndarray: record array of the TrialSet.Trial entries
+    """
+
+    def column(name):
+        return np.asarray(trials[name], dtype=float).ravel()
+
+    choice = column("choice")
+    intervals = np.asarray(trials["intervals"], dtype=float)
+    valid = ~(
+        np.isnan(intervals[:, 1])
+        | np.isnan(choice)
+        | np.isnan(column("probabilityLeft"))
+    )
+    if not np.isin(choice[valid], list(RESPONSE_CHOICES)).all():
+        raise ValueError("Invalid reponse choice.")
+
+    columns = dict(
+        trial_id=np.flatnonzero(valid) + 1,
+        trial_start_time=intervals[valid, 0],
+        trial_end_time=intervals[valid, 1],
+        trial_response_choice=np.array(
+            [RESPONSE_CHOICES[c] for c in choice[valid]], dtype=object
+        ),
+        trial_stim_contrast_left=np.nan_to_num(column("contrastLeft")[valid]),
+        trial_stim_contrast_right=np.nan_to_num(column("contrastRight")[valid]),
+    )
+    for attr, name, status_attr in TRIAL_ATTRIBUTES:
+        if status_attr is not None and status[status_attr] == "Missing":
+            columns[attr] = np.full(valid.sum(), np.nan)
+        else:
+            columns[attr] = column(name)[valid]
+
+    entries = np.empty(
+        valid.sum(),
+        dtype=[(k, object) for k in key]
+        + [(attr, values.dtype) for attr, values in columns.items()],
+    )
+    for k, v in key.items():
+        entries[k] = [v] * len(entries)
+    for attr, values in columns.items():
+        entries[attr] = values
+    return entries
+
+
 @schema
 class TrialSet(dj.Imported):
     definition = """
@@ -238,6 +319,7 @@ class TrialSet(dj.Imported):
 
     # Knowledge based hack to be formalized better later
     key_source = acquisition.Session & CompleteTrialSession
+    chunksz = 5000  # Trial entries per insert
 
     def make(self, key):
         trial_key = key.copy()
@@ -284,69 +366,11 @@ class TrialSet(dj.Imported):
         key["trials_start_time"] = trials["intervals"][0, 0]
         key["trials_end_time"] = trials["intervals"][-1, 1]
 
-        trial_entries = []
-        for idx_trial in range(len(trials["choice"])):
-
-            if np.any(
-                np.isnan(
-                    [
-                        trials["intervals"][idx_trial, 1],
-                        trials["choice"][idx_trial],
-                        trials["probabilityLeft"][idx_trial],
-                    ]
-                )
-            ):
-                continue
-
-            trial = trial_key.copy()
-            c_left = trials["contrastLeft"][idx_trial]
-            c_right = trials["contrastRight"][idx_trial]
-            trial.update(
-                trial_id=idx_trial + 1,
-                trial_start_time=float(trials["intervals"][idx_trial, 0]),
-                trial_end_time=float(trials["intervals"][idx_trial, 1]),
-                trial_response_time=float(trials["response_times"][idx_trial]),
-                trial_stim_contrast_left=0 if np.isnan(c_left) else float(c_left),
-                trial_stim_contrast_right=0 if np.isnan(c_right) else float(c_right),
-                trial_feedback_time=float(trials["feedback_times"][idx_trial]),
-                trial_feedback_type=int(trials["feedbackType"][idx_trial]),
-                trial_stim_prob_left=float(trials["probabilityLeft"][idx_trial]),
-                trial_stim_on_time=float(trials["stimOn_times"][idx_trial])
-                if status["stim_on_times_status"] != "Missing"
-                else None,
-                trial_rep_num=int(trials["repNum"][idx_trial])
-                if status["rep_num_status"] != "Missing"
-                else None,
-                trial_included=bool(trials["included"][idx_trial])
-                if status["included_status"] != "Missing"
-                else None,
-                trial_go_cue_time=float(trials["goCue_times"][idx_trial])
-                if status["go_cue_times_status"] != "Missing"
-                else None,
-                trial_go_cue_trigger_time=float(trials["goCueTrigger_times"][idx_trial])
-                if status["go_cue_trigger_times_status"] != "Missing"
-                else None,
-                trial_reward_volume=float(trials["rewardVolume"][idx_trial])
-                if status["reward_volume_status"] != "Missing"
-                else None,
-                trial_iti_duration=float(trials["itiDuration"][idx_trial])
-                if status["iti_duration_status"] != "Missing"
-                else None,
-            )
-
-            if trials["choice"][idx_trial] == -1:
-                trial["trial_response_choice"] = "CCW"
-            elif trials["choice"][idx_trial] == 0:
-                trial["trial_response_choice"] = "No Go"
-            elif trials["choice"][idx_trial] == 1:
-                trial["trial_response_choice"] = "CW"
-            else:
-                raise ValueError("Invalid reponse choice.")
-
-            trial_entries.append(trial)
+        trial_entries = get_trial_entries(trials, status, trial_key)
 
         self.insert1(key)
-        self.Trial.insert(trial_entries)
+        for i in range(0, len(trial_entries), self.chunksz):
+            self.Trial.insert(trial_entries[i : i + self.chunksz])
 
         logger.info(
             "Populated a TrialSet tuple, \
@@ -388,6 +412,60 @@ class TrialSet(dj.Imported):
         """
 
 
+@schema
+class TrialSetColumns(dj.Computed):
+    definition = """
+    # trials of a TrialSet stored as one columnar blob, see fetch_trials
+    -> TrialSet
+    ---
+    trial_columns:      longblob    # dict of TrialSet.Trial attribute -> array ordered by trial_id
+    """
+
+    def make(self, key):
+        attrs = ["trial_id"] + TrialSet.Trial.heading.secondary_attributes
+        values = (TrialSet.Trial & key).fetch(*attrs, order_by="trial_id")
+        columns = {}
+        for attr, v in zip(attrs, values):
+            if attr == "trial_id":
+                columns[attr] = np.array(v, dtype=int)
+            elif attr == "trial_response_choice":
+                # stored as the keys of RESPONSE_CHOICES
+                codes = {choice: code for code, choice in RESPONSE_CHOICES.items()}
+                columns[attr] = np.array([codes[c] for c in v], dtype=np.int8)
+            else:
+                # NULL as NaN
+                columns[attr] = np.array(v, dtype=float)
+        self.insert1(dict(key, trial_columns=columns))
+
+    @classmethod
+    def fetch_trials(cls, restriction={}):
+        """Fetch the trials of the sessions in restriction, reading one blob per session
+
+        Args:
+            restriction (optional): restriction of TrialSetColumns. Defaults to all sessions.
+
+        Returns:
+            pandas.DataFrame: one row per trial with the primary key of the session
+                and the attributes of TrialSet.Trial, NULL as NaN
+        """
+        frames = []
+        for entry in (cls & restriction).fetch(as_dict=True):
+            columns = entry.pop("trial_columns")
+            df = pd.DataFrame(columns)
+            df["trial_response_choice"] = df["trial_response_choice"].map(
+                RESPONSE_CHOICES
+            )
+            for k, v in reversed(list(entry.items())):
+                df.insert(0, k, v)
+            frames.append(df)
+        if not frames:
+            return pd.DataFrame(
+                columns=TrialSet.Trial.primary_key
+                + TrialSet.Trial.heading.secondary_attributes
+            )
+        return pd.concat(frames, ignore_index=True)
+
+
 @schema
 class SessionDelayAvailability(dj.Imported):
     definition = """
@@ -1,3 +1,4 @@
+import datetime
 import os
 
 import datajoint as dj
@@ -5,7 +6,7 @@ import numpy as np
 import pandas as pd
 from tqdm import tqdm
 
-from ibl_pipeline import acquisition, behavior, data, mode, one, reference
+from ibl_pipeline import acquisition, behavior, data, mode, one, reference, update
 
 try:
     wheel = dj.create_virtual_module("wheel", "group_shared_wheel")
@@ -63,6 +64,14 @@ class CompleteClusterSession(dj.Computed):
         & (data.FileRecord & 'dataset_name="spikes.clusters.npy"')
     )
 
+    # for update.populate_incremental, sessions with newly created spikes datasets
+    watermark_source = data.DataSet & 'dataset_name LIKE "spikes.%"'
+    watermark_attr = "created_datetime"
+
+    @property
+    def watermark_retry(self):
+        return EphysMissingDataLog
+
     def make(self, key):
 
         datasets = (
@@ -386,6 +395,21 @@ class AlignedTrialSpikes(dj.Computed):
         dj.AndList([wheel.MovementTimes, 'event="movement"']),
     ]
 
+    # for update.populate_incremental, newly ingested clusters
+    watermark_source = DefaultCluster
+    watermark_attr = "cluster_ts"
+
+    @property
+    def watermark_retry(self):
+        # clusters of recent sessions whose trials or movement times arrived after them
+        cutoff = datetime.datetime.now() - update.WATERMARK_LOOKBACK
+        recent = f'session_start_time > "{cutoff:%Y-%m-%d %H:%M:%S}"'
+        return [
+            DefaultCluster & ((behavior.TrialSet & recent) - self),
+            DefaultCluster
+            & ((wheel.MovementTimes & recent) - (self & 'event="movement"')),
+        ]
+
     def make(self, key):
         cluster = DefaultCluster() & key
         spike_times = cluster.fetch1("cluster_spikes_times")
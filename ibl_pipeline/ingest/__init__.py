@@ -52,10 +52,19 @@ While this should not happen in the current architecture, following the pattern
 outlined here should prevent it in general and so is a good 'safe practice' to
 use for the ingest modules.
 """
+import collections
+import contextlib
+import hashlib
 import logging
 import os
+import queue
+import tempfile
+import threading
+import time
+import uuid
 
 import datajoint as dj
+import pymysql
 from tqdm import tqdm
 
 from ibl_pipeline import mode
@@ -67,7 +76,131 @@ if mode == "test":
 logger = logging.getLogger(__name__)
 
 
+# RawFieldBatch of the keys being ingested, set by raw_field_batch
+_raw_field_batch = None
+
+
+class RawFieldBatch(object):
+    """
+    RawFieldBatch: the AlyxRaw.Field entries of a batch of uuids, fetched in a single
+    query and pivoted into a dict per uuid, together with in-memory maps of the
+    lookup tables entries referenced by these fields.
+    """
+
+    def __init__(self, uuids):
+        self.uuids = set(uuids)
+        self.fields = collections.defaultdict(dict)
+        self.models = {}
+        if self.uuids:
+            uuids, models, fnames, fvalues = (
+                alyxraw.AlyxRaw.Field * alyxraw.AlyxRaw.proj("model")
+                & [{"uuid": u} for u in self.uuids]
+            ).fetch(
+                "uuid", "model", "fname", "fvalue", order_by="uuid, fname, value_idx"
+            )
+            for u, model, fname, fvalue in zip(uuids, models, fnames, fvalues):
+                self.models[u] = model
+                self.fields[u].setdefault(fname, []).append(fvalue)
+        self._referenced_uuids = None
+        self._lookups = {}
+
+    def get(self, key, field, multiple_entries=False, model=None):
+        values = self.fields.get(key["uuid"], {}).get(field)
+        if not values or (model and self.models.get(key["uuid"]) != model):
+            raise AlyxKeyError(f'No "{field}" field in AlyxRaw.Field for key: {key}')
+        if multiple_entries:
+            return values
+        if len(values) != 1:
+            raise dj.DataJointError(
+                "fetch1 should only return one tuple. %d tuples were found"
+                % len(values)
+            )
+        return values[0]
+
+    def referenced_uuids(self):
+        """uuids of the batch and all uuids stored as field values of the batch"""
+        if self._referenced_uuids is None:
+            self._referenced_uuids = set(self.uuids)
+            for fields in self.fields.values():
+                for values in fields.values():
+                    for value in values:
+                        if value and len(value) == 36:
+                            try:
+                                self._referenced_uuids.add(uuid.UUID(value))
+                            except ValueError:
+                                pass
+        return self._referenced_uuids
+
+    def lookup1(self, table, key, attrs):
+        ((attr, value),) = key.items()
+        value = value if isinstance(value, uuid.UUID) else uuid.UUID(value)
+
+        lookup_key = (table.full_table_name, attr, attrs)
+        if lookup_key not in self._lookups:
+            lookup = collections.defaultdict(list)
+            restriction = [{attr: u} for u in self.referenced_uuids()]
+            for entry in (table & restriction).fetch(attr, *attrs, as_dict=True):
+                lookup[entry[attr]].append(tuple(entry[a] for a in attrs))
+            self._lookups[lookup_key] = lookup
+
+        lookup = self._lookups[lookup_key]
+        if value not in lookup:
+            # referenced through a value that is not a plain uuid field, e.g. json
+            lookup[value] = [
+                tuple(entry[a] for a in attrs)
+                for entry in (table & {attr: value}).fetch(*attrs, as_dict=True)
+            ]
+
+        entries = lookup[value]
+        if len(entries) != 1:
+            raise dj.DataJointError(
+                "fetch1 should only return one tuple. %d tuples were found"
+                % len(entries)
+            )
+        return entries[0] if len(attrs) > 1 else entries[0][0]
+
+
+@contextlib.contextmanager
+def raw_field_batch(uuids):
+    """Within this context, get_raw_field and lookup1 for the given uuids are
+    served from a RawFieldBatch instead of a query per call
+
+    Args:
+        uuids (iterable of uuid.UUID): uuids of the AlyxRaw entries to be ingested
+    """
+    global _raw_field_batch
+    previous_batch = _raw_field_batch
+    _raw_field_batch = RawFieldBatch(uuids)
+    try:
+        yield _raw_field_batch
+    finally:
+        _raw_field_batch = previous_batch
+
+
+def lookup1(table, key, *attrs):
+    """Fetch attrs of the single entry of table matching key, a dict of a single
+    uuid attribute. Inside raw_field_batch, the entries of table referenced by
+    the batch are fetched once and served from memory.
+
+    Args:
+        table (datajoint table): lookup table, e.g. subject.Strain
+        key (dict): e.g. {"strain_uuid": strain_uuid}, uuid.UUID or uuid str value
+        attrs (str): attributes to fetch
+
+    Returns:
+        value of the attribute if a single attribute is given, otherwise a tuple
+    """
+    if _raw_field_batch is not None:
+        return _raw_field_batch.lookup1(table, key, attrs)
+    return (table & key).fetch1(*attrs)
+
+
 def get_raw_field(key, field, multiple_entries=False, model=None):
+    if _raw_field_batch is not None and key.get("uuid") in _raw_field_batch.uuids:
+        return _raw_field_batch.get(
+            key, field, multiple_entries=multiple_entries, model=model
+        )
+
     if model:
         query = (
             alyxraw.AlyxRaw.Field
@@ -88,6 +221,119 @@ def get_raw_field(key, field, multiple_entries=False, model=None):
     )
 
 
+# fields of interest per alyx model, hashed into AlyxRaw.fields_hash so that changes
+# in these fields only can be detected without comparing AlyxRaw.Field
+ALYXRAW_FIELDS_OF_INTEREST = {"actions.session": ("extended_qc", "qc")}
+
+
+def _hash_field_entries(field_entries):
+    content_hash = hashlib.md5()
+    for entry in sorted(field_entries, key=lambda e: (e["fname"], e["value_idx"])):
+        fvalue = entry.get("fvalue")
+        fvalue = b"\x00" if fvalue is None else fvalue.encode("utf-8", "surrogatepass")
+        content_hash.update(
+            f'{entry["fname"]}\x1f{entry["value_idx"]}\x1f{len(fvalue)}\x1f'.encode()
+        )
+        content_hash.update(fvalue)
+    return content_hash.hexdigest()
+
+
+def get_alyxraw_hashes(model, field_entries):
+    """Compute the content hashes of an AlyxRaw entry from its AlyxRaw.Field entries
+
+    Args:
+        model (str): alyx model name, e.g. "actions.session"
+        field_entries (list of dict): AlyxRaw.Field entries of the AlyxRaw entry
+
+    Returns:
+        dict: "content_hash" over all fields except json, and "fields_hash" over the
+            fields in ALYXRAW_FIELDS_OF_INTEREST if the model has any
+    """
+    field_entries = [entry for entry in field_entries if entry["fname"] != "json"]
+    hashes = dict(content_hash=_hash_field_entries(field_entries))
+    if model in ALYXRAW_FIELDS_OF_INTEREST:
+        fields = ALYXRAW_FIELDS_OF_INTEREST[model]
+        hashes["fields_hash"] = _hash_field_entries(
+            [entry for entry in field_entries if entry["fname"] in fields]
+        )
+    return hashes
+
+
+def _get_modified_field_values(original, update, fields=None):
+    fields_original = alyxraw.AlyxRaw.Field & original
+    fields_update = alyxraw.UpdateAlyxRaw.Field & update
+    fields_restr = [{"fname": f} for f in fields] if fields else {}
+
+    return (
+        fields_update.proj(fvalue_new="fvalue") * fields_original
+        & "fvalue_new != fvalue"
+        & 'fname not in ("json")'
+        & fields_restr
+    )
+
+
+def get_modified_alyxraw(model, fields=None):
+    """Query of the AlyxRaw entries of a model that are modified in UpdateAlyxRaw.
+    Entries are compared by their content hash (or fields hash when fields are the
+    fields of interest of the model), entries without hashes on either side and
+    other field selections fall back to comparing AlyxRaw.Field values.
+
+    Args:
+        model (str): alyx model name, e.g. "actions.session"
+        fields (list of str, optional): only detect modifications in these fields.
+            Defaults to None, any field except json.
+
+    Returns:
+        datajoint query of the modified entries in AlyxRaw
+    """
+    original = alyxraw.AlyxRaw & {"model": model}
+    update = alyxraw.UpdateAlyxRaw & {"model": model}
+
+    if not fields:
+        hash_attr = "content_hash"
+    elif set(fields) == set(ALYXRAW_FIELDS_OF_INTEREST.get(model, ())):
+        hash_attr = "fields_hash"
+    else:
+        return original & _get_modified_field_values(original, update, fields)
+
+    hashes = original.proj(hash_attr) * update.proj(new_hash=hash_attr)
+    modified = [(hashes & f"new_hash != {hash_attr}").proj()]
+
+    unhashed = (hashes & f"new_hash is null or {hash_attr} is null").proj()
+    if unhashed:
+        modified.append(
+            _get_modified_field_values(original & unhashed, update & unhashed, fields)
+        )
+
+    return original & modified
+
+
+def _insert_bisect(rel, entries, **kwargs):
+    """Insert entries into rel, splitting a failing chunk in halves until the
+    failing rows are isolated, so that a few bad rows in a large chunk cost a
+    number of inserts logarithmic in the chunk size instead of one per row.
+
+    Returns:
+        list: entries that failed to be inserted
+    """
+    try:
+        rel.insert(entries, **kwargs)
+        return []
+    except Exception as e:
+        if len(entries) == 1:
+            logger.debug("error in flush-insert: {}".format(e))
+            return list(entries)
+        logger.info(
+            "error in flush-insert: {}"
+            " - Splitting the chunk ({} records)".format(e, len(entries))
+        )
+
+    half = len(entries) // 2
+    return _insert_bisect(rel, entries[:half], **kwargs) + _insert_bisect(
+        rel, entries[half:], **kwargs
+    )
+
+
 class QueryBuffer(object):
     """
     QueryBuffer: a utility class to help managed chunked inserts
@@ -121,21 +367,7 @@ class QueryBuffer(object):
         while qlen >= chunksz:
             entries = self._queue[:chunksz]
             del self._queue[:chunksz]
-            try:
-                self._rel.insert(entries, **kwargs)
-            except Exception as e:
-                logger.info(
-                    "error in flush-insert: {}"
-                    " - Trying ingestion one by one ({} records)".format(
-                        e, len(entries)
-                    )
-                )
-                for entry in entries:
-                    try:
-                        self._rel.insert1(entry, **kwargs)
-                    except Exception as e:
-                        failed_insertions.append(entry)
-                        logger.debug("error in flush-insert: {}".format(e))
+            failed_insertions.extend(_insert_bisect(self._rel, entries, **kwargs))
             if self.verbose:
                 logger.log(
                     25,
@@ -202,25 +434,514 @@ class QueryBuffer(object):
             return 0
 
 
-def populate_batch(t, chunksz=1000, verbose=True):
+class AsyncQueryBuffer(QueryBuffer):
+    """
+    AsyncQueryBuffer: a QueryBuffer whose inserts run in a background writer thread,
+    so that the producer keeps creating entries while the previous chunk is inserted.
+    At most max_pending chunks wait for the writer, beyond that flush_insert blocks.
+    The chunk size adapts to keep each insert close to target_latency seconds.
+    The writer uses its own database connection, so records referencing records
+    queued in another buffer can only be queued after that buffer is joined.
+    """
+
+    def __init__(
+        self,
+        rel,
+        verbose=False,
+        chunksz=1000,
+        max_pending=2,
+        target_latency=1.0,
+        min_chunksz=10,
+        max_chunksz=50000,
+    ):
+        super().__init__(rel, verbose=verbose)
+        self.chunksz = chunksz
+        self.target_latency = target_latency
+        self.min_chunksz = min_chunksz
+        self.max_chunksz = max_chunksz
+        self._pending = queue.Queue(maxsize=max_pending)
+        self._failed_insertions = []
+        self._failed_lock = threading.Lock()
+        self._writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _connect(self):
+        conn_info = self._rel.connection.conn_info
+        connection = dj.Connection(
+            conn_info["host_input"],
+            conn_info["user"],
+            conn_info["passwd"],
+            use_tls=conn_info["ssl_input"],
+        )
+        return connection, dj.FreeTable(connection, self._rel.full_table_name)
+
+    def _write(self):
+        try:
+            connection, rel = self._connect()
+        except Exception as e:
+            logger.error("error in connecting the background writer: {}".format(e))
+            connection, rel = None, None
+
+        while True:
+            item = self._pending.get()
+            if item is None:
+                self._pending.task_done()
+                break
+            entries, kwargs = item
+            if rel is None:
+                failed = entries
+            else:
+                start = time.time()
+                failed = _insert_bisect(rel, entries, **kwargs)
+                self._adapt_chunksz(len(entries), time.time() - start)
+            with self._failed_lock:
+                self._failed_insertions.extend(failed)
+            if self.verbose:
+                logger.log(
+                    25,
+                    "Inserted {}/{} {} tuples".format(
+                        len(entries) - len(failed),
+                        len(entries),
+                        self._rel.table_name,
+                    ),
+                )
+            self._pending.task_done()
+
+        if connection is not None:
+            connection.close()
+
+    def _adapt_chunksz(self, n_entries, elapsed):
+        # only full chunks are representative of the latency of the chunk size
+        if n_entries < self.chunksz or elapsed <= 0:
+            return
+        ratio = min(max(self.target_latency / elapsed, 0.5), 2.0)
+        self.chunksz = int(
+            min(max(self.chunksz * ratio, self.min_chunksz), self.max_chunksz)
+        )
+
+    def _pop_failed_insertions(self):
+        with self._failed_lock:
+            failed_insertions = self._failed_insertions
+            self._failed_insertions = []
+        return failed_insertions
+
+    def flush_insert(self, chunksz=None, **kwargs):
+        """
+        hand off the queued records to the background writer, in chunks of the
+        adaptive chunk size. If chunksz is None, all queued records are handed off,
+        otherwise only full chunks.
+
+        Returns:
+            list: records that failed to be inserted since the last call
+        """
+        if self._queue and self._writer is None:
+            self._writer = threading.Thread(target=self._write, daemon=True)
+            self._writer.start()
+
+        while self._queue and (chunksz is None or len(self._queue) >= self.chunksz):
+            entries = self._queue[: self.chunksz]
+            del self._queue[: self.chunksz]
+            self._pending.put((entries, kwargs))
+
+        return self._pop_failed_insertions()
+
+    def join(self, **kwargs):
+        """
+        hand off the remaining records and wait until the writer has inserted all
+        of them.
+
+        Returns:
+            list: records that failed to be inserted since the last flush_insert
+        """
+        self.flush_insert(**kwargs)
+        self._pending.join()
+        return self._pop_failed_insertions()
+
+    def close(self, **kwargs):
+        """
+        join the buffer and stop the writer thread.
+
+        Returns:
+            list: records that failed to be inserted since the last flush_insert
+        """
+        failed_insertions = self.join(**kwargs)
+        if self._writer is not None:
+            self._pending.put(None)
+            self._writer.join()
+            self._writer = None
+        return failed_insertions
+
+
+class BulkLoadBuffer(QueryBuffer):
+    """
+    BulkLoadBuffer: a QueryBuffer that flushes the queued records by writing them
+    to a local tab-separated spool file and loading it with LOAD DATA LOCAL INFILE,
+    bypassing the per-row INSERT encoding of DataJoint.
+    Requires `local_infile` to be enabled on the MySQL server, and the table to have
+    no blob, attachment or filepath attributes.
+    The file is loaded over a separate connection, so the records that are referenced
+    by the loaded records have to be committed first.
+    """
+
+    _escapes = str.maketrans(
+        {"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r", "\0": "\\0"}
+    )
+
+    def __init__(self, rel, verbose=False, spool_dir=None):
+        super().__init__(rel, verbose=verbose)
+        self.spool_dir = spool_dir
+
+        attributes = list(rel.heading.attributes.values())
+        unsupported = [
+            attr.name
+            for attr in attributes
+            if attr.is_blob or attr.is_attachment or attr.is_filepath
+        ]
+        if unsupported:
+            raise dj.DataJointError(
+                f"BulkLoadBuffer does not support attributes: {unsupported}"
+            )
+        self._attributes = attributes
+
+    def _format_value(self, attr, value):
+        if value is None:
+            return "\\N"
+        if attr.uuid:
+            return (value if isinstance(value, uuid.UUID) else uuid.UUID(value)).hex
+        if isinstance(value, bool):
+            return str(int(value))
+        return str(value).translate(self._escapes)
+
+    def _load(self, entries, skip_duplicates):
+        columns, assignments = [], []
+        for attr in self._attributes:
+            if attr.uuid:
+                columns.append(f"@{attr.name}")
+                assignments.append(f"`{attr.name}` = UNHEX(@{attr.name})")
+            else:
+                columns.append(f"`{attr.name}`")
+
+        sql = (
+            "LOAD DATA LOCAL INFILE %s {ignore} INTO TABLE {table} "
+            "CHARACTER SET utf8mb4 "
+            "FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\' "
+            "LINES TERMINATED BY '\\n' ({columns}){assignments}"
+        ).format(
+            ignore="IGNORE" if skip_duplicates else "",
+            table=self._rel.full_table_name,
+            columns=", ".join(columns),
+            assignments=" SET " + ", ".join(assignments) if assignments else "",
+        )
+
+        with tempfile.NamedTemporaryFile(
+            "w",
+            suffix=".tsv",
+            dir=self.spool_dir,
+            encoding="utf-8",
+            newline="\n",
+            delete=False,
+        ) as f:
+            spool_file = f.name
+            for entry in entries:
+                f.write(
+                    "\t".join(
+                        self._format_value(attr, entry.get(attr.name))
+                        for attr in self._attributes
+                    )
+                    + "\n"
+                )
+
+        # LOCAL INFILE has to be enabled when the connection is created
+        conn_info = {
+            k: v
+            for k, v in self._rel.connection.conn_info.items()
+            if k not in ("ssl_input", "host_input")
+        }
+        conn = pymysql.connect(
+            **conn_info, charset="utf8mb4", local_infile=True, autocommit=True
+        )
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(sql, (spool_file,))
+                return cursor.rowcount
+        finally:
+            conn.close()
+            os.remove(spool_file)
+
+    def flush_insert(self, chunksz=None, skip_duplicates=False, **kwargs):
+        """
+        flush the buffer with LOAD DATA, falling back to QueryBuffer.flush_insert
+        for a chunk that failed to load.
+        """
+        qlen = len(self._queue)
+        if not qlen:
+            return
+
+        chunksz = chunksz or qlen
+        failed_insertions = []
+        while qlen >= chunksz:
+            entries = self._queue[:chunksz]
+            del self._queue[:chunksz]
+            try:
+                loaded_count = self._load(entries, skip_duplicates)
+            except Exception as e:
+                logger.info(
+                    "error in flush-bulk-load: {}"
+                    " - Trying flush-insert ({} records)".format(e, len(entries))
+                )
+                fallback_buffer = QueryBuffer(self._rel, verbose=self.verbose)
+                fallback_buffer.add_to_queue(entries)
+                failed_insertions.extend(
+                    fallback_buffer.flush_insert(
+                        skip_duplicates=skip_duplicates, **kwargs
+                    )
+                )
+            else:
+                if self.verbose:
+                    logger.log(
+                        25,
+                        "Loaded {}/{} raw field tuples".format(
+                            loaded_count, len(entries)
+                        ),
+                    )
+
+            del entries
+            qlen = len(self._queue)  # new queue size for the next loop-iteration
+
+        return failed_insertions
+
+
+# mysql errors of a transaction that can be retried: lock wait timeout, deadlock
+_LOCK_ERROR_CODES = (1205, 1213)
+
+
+def _is_lock_error(e):
+    return (
+        isinstance(e, pymysql.err.MySQLError)
+        and e.args
+        and e.args[0] in _LOCK_ERROR_CODES
+    ) or "Deadlock" in str(e)
+
+
+# delete plans by (full_table_name, host), dj.Connection is not hashable
+_delete_plans = {}
+
+
+def get_delete_plan(full_table_name, connection):
+    """Dependent-table closure of a table, computed once per table and host
+
+    Args:
+        full_table_name (str): full name of the table to delete from
+        connection (dj.Connection): connection of the table
+
+    Returns:
+        list: (full_table_name, parents) of the table and its descendants in
+            topological order, parents being the (parent full_table_name, attr_map)
+            of the foreign keys from tables in the closure
+    """
+    plan_key = (full_table_name, connection.conn_info["host"])
+    if plan_key not in _delete_plans:
+        _delete_plans[plan_key] = _get_delete_plan(full_table_name, connection)
+    return _delete_plans[plan_key]
+
+
+def _get_delete_plan(full_table_name, connection):
+    graph = connection.dependencies
+    graph.load()
+    descendants = [n for n in graph.descendants(full_table_name) if not n.isdigit()]
+    plan = []
+    for node in descendants:
+        parents = []
+        for parent, props in graph.parents(node).items():
+            if parent.isdigit():
+                # alias node of a renamed foreign key
+                parent = next(iter(graph.parents(parent)))
+            if parent in descendants:
+                parents.append((parent, props["attr_map"]))
+        plan.append((node, parents))
+    return plan
+
+
+def _delete_chunk(rel, plan, keys):
+    queries = {plan[0][0]: rel & keys}
+    for node, parents in plan[1:]:
+        queries[node] = dj.FreeTable(rel.connection, node) & [
+            queries[parent].proj(**{k: v for k, v in attr_map.items() if k != v})
+            for parent, attr_map in parents
+        ]
+    # children first, the restrictions of the children read their parents
+    return {
+        node: queries[node].delete_quick(get_count=True) for node, _ in reversed(plan)
+    }
+
+
+def delete_cascade(rel, keys, chunksz=1000, max_retries=5, verbose=True):
+    """Delete the entries of rel restricted by keys, and their dependent entries,
+    without the per-call dependency walk of rel.delete().
+
+    The dependent-table closure is planned once with get_delete_plan. Each chunk of keys
+    is deleted with delete_quick from every table of the closure, children first, in one
+    transaction that is retried on deadlocks and lock wait timeouts.
+
+    Args:
+        rel (datajoint table or query): table to delete from, may be restricted
+        keys (list of dict): keys of the entries to delete
+        chunksz (int, optional): number of keys per transaction. Defaults to 1000.
+        max_retries (int, optional): attempts per chunk. Defaults to 5.
+        verbose (bool, optional): log the deleted counts. Defaults to True.
+
+    Returns:
+        collections.Counter: number of deleted entries per full table name
+    """
+    connection = rel.connection
+    plan = get_delete_plan(rel.full_table_name, connection)
+    counts = collections.Counter()
+    start_time = time.time()
+
+    for chunk in tqdm(
+        list(_iter_key_chunks(keys, chunksz)), position=0, disable=not verbose
+    ):
+        for attempt in range(max_retries):
+            # inside a populate call, the caller's transaction is the bound
+            in_transaction = connection.in_transaction
+            try:
+                with (
+                    contextlib.nullcontext()
+                    if in_transaction
+                    else connection.transaction
+                ):
+                    chunk_counts = _delete_chunk(rel, plan, chunk)
+            except Exception as e:
+                if (
+                    in_transaction
+                    or not _is_lock_error(e)
+                    or attempt + 1 == max_retries
+                ):
+                    raise
+                logger.log(25, f"Retrying the deletion of a chunk after: {e}")
+                time.sleep(2**attempt)
+            else:
+                counts.update(chunk_counts)
+                break
+
+    if verbose:
+        for table_name, count in counts.items():
+            if count:
+                logger.log(25, f"Deleted {count} entries from {table_name}")
+        logger.log(
+            25,
+            f"Deleted {len(keys)} keys in {time.time() - start_time:.1f} s",
+        )
+    return counts
+
+
+def _iter_key_chunks(keys, chunksz):
+    for i in range(0, len(keys), chunksz):
+        yield keys[i : i + chunksz]
+
+
+def _get_key_uuids(keys):
+    return [v for key in keys for v in key.values() if isinstance(v, uuid.UUID)]
+
+
+def populate_chunks(t, chunksz=1000, display_progress=False, **kwargs):
+    """Call t.populate on chunks of the keys left to populate, with the
+    AlyxRaw.Field entries of each chunk fetched in one query (see raw_field_batch)
+
+    Args:
+        t (datajoint table class): shadow table
+        chunksz (int, optional): number of keys per chunk. Defaults to 1000.
+        display_progress (bool, optional): show the progress over the chunks.
+            Defaults to False.
+        kwargs: settings passed to populate, e.g. suppress_errors, reserve_jobs
+
+    Returns:
+        list: errors returned by populate when suppress_errors is set
+    """
+    keys = (t.key_source - t.proj()).fetch("KEY")
+    errors = []
+    for chunk in tqdm(
+        list(_iter_key_chunks(keys, chunksz)), position=0, disable=not display_progress
+    ):
+        with raw_field_batch(_get_key_uuids(chunk)):
+            errors.extend(t.populate(chunk, **kwargs) or [])
+    return errors
+
+
+def populate_batch(t, chunksz=1000, verbose=True, background=True):
+    """Populate the shadow table t in chunks of keys. The AlyxRaw.Field entries of
+    each chunk are fetched in one query (see raw_field_batch). If t has a
+    create_entry method, the entries are inserted in chunks, otherwise t.populate
+    is called on each chunk.
+
+    Args:
+        t (datajoint table class): shadow table
+        chunksz (int, optional): number of keys per chunk. Defaults to 1000.
+        verbose (bool, optional): print the progress. Defaults to True.
+        background (bool, optional): insert in a background thread through an
+            AsyncQueryBuffer while the entries are being created, chunksz is then the
+            initial chunk size. Defaults to True.
+
+    Returns:
+        list: entries that failed to be inserted, or the errors returned by
+            populate if t has no create_entry method
+    """
+    if not hasattr(t, "create_entry"):
+        errors = populate_chunks(
+            t, chunksz=chunksz, display_progress=True, suppress_errors=True
+        )
+        if errors:
+            logger.warning(f"{len(errors)} {t.__name__} keys failed to populate")
+        return errors
 
     keys = (t.key_source - t.proj()).fetch("KEY")
-    table = QueryBuffer(t)
-    for key in tqdm(keys, position=0):
-        entry = t.create_entry(key)
-        if entry:
-            table.add_to_queue1(entry)
 
-        if (
+    if background:
+        table = AsyncQueryBuffer(t, verbose=verbose, chunksz=chunksz)
+    else:
+        table = QueryBuffer(t)
+    failed_insertions = []
+    for chunk in tqdm(list(_iter_key_chunks(keys, chunksz)), position=0):
+        with raw_field_batch(_get_key_uuids(chunk)):
+            for key in chunk:
+                try:
+                    entry = t.create_entry(key)
+                except (ShadowIngestionError, AlyxKeyError) as e:
+                    logger.debug(f"Error creating entry for key {key}: {e}")
+                    continue
+                if entry:
+                    table.add_to_queue1(entry)
+
+        failed_insertions.extend(
             table.flush_insert(
                 skip_duplicates=True, allow_direct_insert=True, chunksz=chunksz
             )
-            and verbose
-        ):
-            print(f"Inserted {chunksz} {t.__name__} tuples.")
+            or []
+        )
+        if verbose and not background:
+            print(f"Inserted {len(chunk)} {t.__name__} tuples.")
+
+    if background:
+        failed_insertions.extend(
+            table.close(skip_duplicates=True, allow_direct_insert=True)
+        )
+    else:
+        failed_insertions.extend(
+            table.flush_insert(skip_duplicates=True, allow_direct_insert=True) or []
+        )
+
+    if verbose:
+        print(
+            f"Inserted all remaining {t.__name__} tuples"
+            f" - {len(failed_insertions)} failed."
+        )
 
-    if table.flush_insert(skip_duplicates=True, allow_direct_insert=True) and verbose:
-        print(f"Inserted all remaining {t.__name__} tuples.")
+    return failed_insertions
 
 
 class ShadowIngestionError(Exception):
@@ -6,7 +6,7 @@ import datajoint as dj
 from ibl_pipeline import acquisition
 from ibl_pipeline.ingest import ShadowIngestionError, action, alyxraw
 from ibl_pipeline.ingest import get_raw_field as grf
-from ibl_pipeline.ingest import reference, subject
+from ibl_pipeline.ingest import lookup1, reference, subject
 
 schema = dj.schema(dj.config.get("database.prefix", "") + "ibl_ingest_acquisition")
 
@@ -57,9 +57,12 @@ class Session(dj.Computed):
 
         location_uuid = grf(key, "location")
         if location_uuid != "None":
-            key_session["session_lab"], key_session["session_location"] = (
-                reference.LabLocation & dict(location_uuid=uuid.UUID(location_uuid))
-            ).fetch1("lab_name", "location_name")
+            key_session["session_lab"], key_session["session_location"] = lookup1(
+                reference.LabLocation,
+                dict(location_uuid=uuid.UUID(location_uuid)),
+                "lab_name",
+                "location_name",
+            )
 
         session_type = grf(key, "type")
         if session_type != "None":
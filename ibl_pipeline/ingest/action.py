@@ -5,7 +5,7 @@ from datajoint.errors import DataJointError
 
 from ibl_pipeline.ingest import ShadowIngestionError, alyxraw
 from ibl_pipeline.ingest import get_raw_field as grf
-from ibl_pipeline.ingest import reference, subject
+from ibl_pipeline.ingest import lookup1, reference, subject
 
 schema = dj.schema(dj.config.get("database.prefix", "") + "ibl_ingest_action")
 
@@ -70,9 +70,9 @@ class Weighing(dj.Computed):
 
         user_uuid = grf(key, "user")
         if user_uuid != "None":
-            key_weigh["weighing_user"] = (
-                reference.LabMember & dict(user_uuid=uuid.UUID(user_uuid))
-            ).fetch1("user_name")
+            key_weigh["weighing_user"] = lookup1(
+                reference.LabMember, dict(user_uuid=uuid.UUID(user_uuid)), "user_name"
+            )
 
         self.insert1(key_weigh)
 
@@ -134,15 +134,15 @@ class WaterAdministration(dj.Computed):
             key_wa["water_administered"] = wa
 
         water_type = grf(key, "water_type")
-        key_wa["watertype_name"] = (
-            WaterType & dict(watertype_uuid=uuid.UUID(water_type))
-        ).fetch1("watertype_name")
+        key_wa["watertype_name"] = lookup1(
+            WaterType, dict(watertype_uuid=uuid.UUID(water_type)), "watertype_name"
+        )
 
         user_uuid = grf(key, "user")
         if user_uuid != "None":
-            key_wa["administration_user"] = (
-                reference.LabMember & dict(user_uuid=uuid.UUID(user_uuid))
-            ).fetch1("user_name")
+            key_wa["administration_user"] = lookup1(
+                reference.LabMember, dict(user_uuid=uuid.UUID(user_uuid)), "user_name"
+            )
 
         key_wa["adlib"] = grf(key, "adlib") == "True"
 
@@ -190,9 +190,12 @@ class WaterRestriction(dj.Computed):
 
         location_uuid = grf(key, "location")
         if location_uuid != "None":
-            key_res["restriction_lab"], key_res["restriction_location"] = (
-                reference.LabLocation & dict(location_uuid=uuid.UUID(location_uuid))
-            ).fetch1("lab_name", "location_name")
+            key_res["restriction_lab"], key_res["restriction_location"] = lookup1(
+                reference.LabLocation,
+                dict(location_uuid=uuid.UUID(location_uuid)),
+                "lab_name",
+                "location_name",
+            )
 
         key_res["reference_weight"] = grf(key, "reference_weight")
 
@@ -266,9 +269,12 @@ class Surgery(dj.Computed):
 
         location_uuid = grf(key, "location")
         if location_uuid != "None":
-            key_surgery["surgery_lab"], key_surgery["surgery_location"] = (
-                reference.LabLocation & dict(location_uuid=uuid.UUID(location_uuid))
-            ).fetch1("lab_name", "location_name")
+            key_surgery["surgery_lab"], key_surgery["surgery_location"] = lookup1(
+                reference.LabLocation,
+                dict(location_uuid=uuid.UUID(location_uuid)),
+                "lab_name",
+                "location_name",
+            )
 
         self.insert1(key_surgery)
 
@@ -348,9 +354,12 @@ class OtherAction(dj.Computed):
 
         location_uuid = grf(key, "location")
         if location_uuid != "None":
-            key_other["other_action_lab"], key_other["other_action_location"] = (
-                reference.LabLocation & dict(location_uuid=uuid.UUID(location_uuid))
-            ).fetch1("lab_name", "location_name")
+            key_other["other_action_lab"], key_other["other_action_location"] = lookup1(
+                reference.LabLocation,
+                dict(location_uuid=uuid.UUID(location_uuid)),
+                "lab_name",
+                "location_name",
+            )
 
         self.insert1(key_other)
 
@@ -456,21 +465,21 @@ class Cull(dj.Computed):
 
         user_uuid = grf(key, "user")
         if user_uuid != "None":
-            key_cull["cull_user"] = (
-                reference.LabMember & {"user_uuid": user_uuid}
-            ).fetch1("user_name")
+            key_cull["cull_user"] = lookup1(
+                reference.LabMember, {"user_uuid": user_uuid}, "user_name"
+            )
 
         cull_method_uuid = grf(key, "cull_method")
         if cull_method_uuid != "None":
-            key_cull["cull_method"] = (
-                CullMethod & {"cull_method_uuid": cull_method_uuid}
-            ).fetch1("cull_method")
+            key_cull["cull_method"] = lookup1(
+                CullMethod, {"cull_method_uuid": cull_method_uuid}, "cull_method"
+            )
 
         cull_reason_uuid = grf(key, "cull_reason")
         if cull_reason_uuid != "None":
-            key_cull["cull_reason"] = (
-                CullReason & {"cull_reason_uuid": cull_reason_uuid}
-            ).fetch1("cull_reason")
+            key_cull["cull_reason"] = lookup1(
+                CullReason, {"cull_reason_uuid": cull_reason_uuid}, "cull_reason"
+            )
 
         description = grf(key, "description")
         if description != "None":
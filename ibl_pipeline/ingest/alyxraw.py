@@ -9,6 +9,8 @@ class UpdateAlyxRaw(dj.Manual):
     uuid: uuid  # pk field (uuid string repr)
     ---
     model: varchar(255)  # alyx 'model'
+    content_hash=null: char(32)  # md5 of the sorted fields except json, computed at ingest
+    fields_hash=null: char(32)  # md5 of the fields of interest of the model, if any
     """
 
     class Field(dj.Part):
@@ -28,6 +30,8 @@ class AlyxRaw(dj.Manual):
     uuid: uuid  # pk field (uuid string repr)
     ---
     model: varchar(255)  # alyx 'model'
+    content_hash=null: char(32)  # md5 of the sorted fields except json, computed at ingest
+    fields_hash=null: char(32)  # md5 of the fields of interest of the model, if any
     """
 
     class Field(dj.Part):
@@ -46,3 +50,14 @@ class ProblematicData(dj.Manual):
     definition = """
     -> AlyxRaw
     """
+
+
+@schema
+class AlyxRawWatermark(dj.Manual):
+    definition = """  # latest modification time of the alyx entries ingested per alyx model
+    alyxraw_table: varchar(32)  # AlyxRaw or UpdateAlyxRaw
+    model: varchar(255)  # alyx 'model'
+    ---
+    watermark: datetime(6)  # latest auto_datetime (UTC) of the ingested entries
+    watermark_ts=CURRENT_TIMESTAMP: timestamp
+    """
@@ -1,11 +1,22 @@
+import contextlib
 import json
+import logging
 import uuid
 
 import datajoint as dj
-
-from ibl_pipeline.ingest import ShadowIngestionError, acquisition, alyxraw
+from tqdm import tqdm
+
+from ibl_pipeline.ingest import (
+    AlyxKeyError,
+    QueryBuffer,
+    ShadowIngestionError,
+    acquisition,
+    alyxraw,
+)
 from ibl_pipeline.ingest import get_raw_field as grf
-from ibl_pipeline.ingest import reference
+from ibl_pipeline.ingest import lookup1, raw_field_batch, reference
+
+logger = logging.getLogger(__name__)
 
 schema = dj.schema(dj.config.get("database.prefix", "") + "ibl_ingest_data")
 
@@ -94,9 +105,9 @@ class DataRepository(dj.Computed):
         key_repo["repo_name"] = grf(key, "name")
 
         repotype = grf(key, "repository_type")
-        key_repo["repotype_name"] = (
-            DataRepositoryType & dict(repotype_uuid=uuid.UUID(repotype))
-        ).fetch1("repotype_name")
+        key_repo["repotype_name"] = lookup1(
+            DataRepositoryType, dict(repotype_uuid=uuid.UUID(repotype)), "repotype_name"
+        )
         key_repo["repo_timezone"] = grf(key, "timezone")
         key_repo["repo_hostname"] = grf(key, "hostname")
         key_repo["globus_endpoint_id"] = grf(key, "globus_endpoint_id")
@@ -145,9 +156,9 @@ class DataSetType(dj.Computed):
 
         user_uuid = grf(key, "created_by")
         if user_uuid != "None":
-            key_dst["dataset_type_created_by"] = (
-                reference.LabMember & dict(user_uuid=uuid.UUID(user_uuid))
-            ).fetch1("user_name")
+            key_dst["dataset_type_created_by"] = lookup1(
+                reference.LabMember, dict(user_uuid=uuid.UUID(user_uuid)), "user_name"
+            )
 
         key_dst["filename_pattern"] = grf(key, "filename_pattern")
         key_dst["dataset_type_description"] = grf(key, "description")
@@ -187,36 +198,39 @@ class DataSet(dj.Computed):
         key["uuid"] = key["dataset_uuid"]
 
         session = grf(key, "session")
-        if not len(acquisition.Session & dict(session_uuid=uuid.UUID(session))):
+        try:
+            key_ds["subject_uuid"], key_ds["session_start_time"] = lookup1(
+                acquisition.Session,
+                dict(session_uuid=uuid.UUID(session)),
+                "subject_uuid",
+                "session_start_time",
+            )
+        except dj.DataJointError:
             raise ShadowIngestionError("Non existing session: {}".format(session))
 
-        key_ds["subject_uuid"], key_ds["session_start_time"] = (
-            acquisition.Session & dict(session_uuid=uuid.UUID(session))
-        ).fetch1("subject_uuid", "session_start_time")
-
         key_ds["dataset_name"] = grf(key, "name")
 
         dt = grf(key, "dataset_type")
-        key_ds["dataset_type_name"] = (
-            DataSetType & dict(dataset_type_uuid=uuid.UUID(dt))
-        ).fetch1("dataset_type_name")
+        key_ds["dataset_type_name"] = lookup1(
+            DataSetType, dict(dataset_type_uuid=uuid.UUID(dt)), "dataset_type_name"
+        )
 
         user = grf(key, "created_by")
 
         if user != "None":
             try:
-                key_ds["dataset_created_by"] = (
-                    reference.LabMember & dict(user_uuid=uuid.UUID(user))
-                ).fetch1("user_name")
+                key_ds["dataset_created_by"] = lookup1(
+                    reference.LabMember, dict(user_uuid=uuid.UUID(user)), "user_name"
+                )
             except:
                 print(user)
         else:
             key_ds["dataset_created_by"] = None
 
         format = grf(key, "data_format")
-        key_ds["format_name"] = (
-            DataFormat & dict(format_uuid=uuid.UUID(format))
-        ).fetch1("format_name")
+        key_ds["format_name"] = lookup1(
+            DataFormat, dict(format_uuid=uuid.UUID(format)), "format_name"
+        )
 
         key_ds["created_datetime"] = grf(key, "created_datetime")
 
@@ -234,6 +248,67 @@ class DataSet(dj.Computed):
 
         return key_ds
 
+    @classmethod
+    def insert_from_alyxraw(cls, keys=None, chunksz=10000):
+        """
+        Set-based alternative to create_entry: insert the DataSet entries of keys
+        with one INSERT ... SELECT per chunk, pivoting AlyxRaw.Field and joining the
+        lookup tables on the server. Datasets of missing sessions, dataset types or
+        formats are recorded in OrphanEntry instead.
+
+        Args:
+            keys (list of dict, optional): keys of DataSet.key_source. Defaults to
+                all keys not yet in DataSet.
+            chunksz (int, optional): number of keys per statement. Defaults to 10000.
+
+        Returns:
+            int: number of inserted entries
+        """
+        return _insert_from_alyxraw(
+            cls(),
+            keys,
+            chunksz=chunksz,
+            fields=(
+                "session",
+                "name",
+                "dataset_type",
+                "created_by",
+                "data_format",
+                "created_datetime",
+                "generating_software",
+                "provenance_directory",
+                "md5",
+                "file_size",
+            ),
+            joins=(
+                ("s", acquisition.Session, "session_uuid", "session"),
+                ("dst", DataSetType, "dataset_type_uuid", "dataset_type"),
+                ("df", DataFormat, "format_uuid", "data_format"),
+                ("lm", reference.LabMember, "user_uuid", "created_by"),
+            ),
+            columns=dict(
+                dataset_uuid="p.uuid",
+                subject_uuid="s.subject_uuid",
+                session_start_time="s.session_start_time",
+                dataset_created_by="lm.user_name",
+                dataset_name="p.`name`",
+                dataset_type_name="dst.dataset_type_name",
+                format_name="df.format_name",
+                created_datetime="p.created_datetime",
+                generating_software="NULLIF(p.generating_software, 'None')",
+                provenance_directory="NULLIF(p.provenance_directory, 'None')",
+                md5="NULLIF(p.md5, 'None')",
+                file_size="NULLIF(p.file_size, 'None')",
+            ),
+            required=(
+                ("s.session_uuid", "Non existing session"),
+                ("dst.dataset_type_uuid", "Non existing dataset type"),
+                ("df.format_uuid", "Non existing data format"),
+                ("p.`name`", "No name"),
+                ("p.created_datetime", "No created_datetime"),
+            ),
+        )
+
     @classmethod
     def create_session_entries(cls, session_uuid):
         """
@@ -267,19 +342,23 @@ class FileRecord(dj.Computed):
     relative_path:              varchar(255)
     """
     records = alyxraw.AlyxRaw & 'model="data.filerecord"'
-    repos = (DataRepository & 'repo_name LIKE "flatiron%"').fetch("repo_uuid")
-    records_flatiron = (
-        alyxraw.AlyxRaw.Field
-        & records
-        & 'fname = "data_repository"'
-        & [{"fvalue": str(repo)} for repo in repos]
-    )
     record_exists = (
         alyxraw.AlyxRaw.Field & records & 'fname = "exists"' & 'fvalue="True"'
     )
-    key_source = (alyxraw.AlyxRaw & record_exists & records_flatiron).proj(
-        record_uuid="uuid"
-    )
+
+    @property
+    def key_source(self):
+        # the flatiron repositories are fetched here rather than at import
+        repos = (DataRepository & 'repo_name LIKE "flatiron%"').fetch("repo_uuid")
+        records_flatiron = (
+            alyxraw.AlyxRaw.Field
+            & self.records
+            & 'fname = "data_repository"'
+            & [{"fvalue": str(repo)} for repo in repos]
+        )
+        return (alyxraw.AlyxRaw & self.record_exists & records_flatiron).proj(
+            record_uuid="uuid"
+        )
 
     def make(self, key):
         self.insert1(self.create_entry(key))
@@ -291,32 +370,84 @@ class FileRecord(dj.Computed):
         key_fr["exists"] = True
 
         dataset = grf(key, "dataset")
-        if not len(DataSet & dict(dataset_uuid=uuid.UUID(dataset))):
+        try:
+            (
+                key_fr["subject_uuid"],
+                key_fr["session_start_time"],
+                key_fr["dataset_name"],
+            ) = lookup1(
+                DataSet,
+                dict(dataset_uuid=uuid.UUID(dataset)),
+                "subject_uuid",
+                "session_start_time",
+                "dataset_name",
+            )
+        except dj.DataJointError:
             raise ShadowIngestionError(
                 "Dataset is not in the table data.DataSet: {}".format(str(key["uuid"]))
             )
 
-        key_fr["subject_uuid"], key_fr["session_start_time"], key_fr["dataset_name"] = (
-            DataSet & dict(dataset_uuid=uuid.UUID(dataset))
-        ).fetch1("subject_uuid", "session_start_time", "dataset_name")
-
         repo = grf(key, "data_repository")
-        key_fr["repo_name"] = (DataRepository & dict(repo_uuid=uuid.UUID(repo))).fetch1(
-            "repo_name"
+        key_fr["repo_name"] = lookup1(
+            DataRepository, dict(repo_uuid=uuid.UUID(repo)), "repo_name"
         )
 
         key_fr["relative_path"] = grf(key, "relative_path")
         return key_fr
 
+    @classmethod
+    def insert_from_alyxraw(cls, keys=None, chunksz=10000):
+        """
+        Set-based alternative to create_entry: insert the FileRecord entries of keys
+        with one INSERT ... SELECT per chunk, pivoting AlyxRaw.Field and joining the
+        lookup tables on the server. File records of datasets missing in DataSet are
+        recorded in OrphanEntry instead.
+
+        Args:
+            keys (list of dict, optional): keys of FileRecord.key_source. Defaults to
+                all keys not yet in FileRecord.
+            chunksz (int, optional): number of keys per statement. Defaults to 10000.
+
+        Returns:
+            int: number of inserted entries
+        """
+        return _insert_from_alyxraw(
+            cls(),
+            keys,
+            chunksz=chunksz,
+            fields=("dataset", "data_repository", "relative_path"),
+            joins=(
+                ("ds", DataSet, "dataset_uuid", "dataset"),
+                ("dr", DataRepository, "repo_uuid", "data_repository"),
+            ),
+            columns=dict(
+                record_uuid="p.uuid",
+                exists="TRUE",
+                subject_uuid="ds.subject_uuid",
+                session_start_time="ds.session_start_time",
+                dataset_name="ds.dataset_name",
+                repo_name="dr.repo_name",
+                relative_path="p.relative_path",
+            ),
+            required=(
+                ("ds.dataset_uuid", "Dataset is not in the table data.DataSet"),
+                ("dr.repo_uuid", "Non existing data repository"),
+                ("p.relative_path", "No relative_path"),
+            ),
+        )
+
     @classmethod
     def create_session_entries(cls, session_uuid):
         """
         For a session_uuid, create a list of dictionaries representing all entries
          for the given session to be inserted into the FileRecord table
         """
-        subject_uuid, session_start_time = (
-            acquisition.Session & {"session_uuid": session_uuid}
-        ).fetch1("subject_uuid", "session_start_time")
+        subject_uuid, session_start_time = lookup1(
+            acquisition.Session,
+            {"session_uuid": session_uuid},
+            "subject_uuid",
+            "session_start_time",
+        )
         dataset_uuids = (
             DataSet
             & {"subject_uuid": subject_uuid, "session_start_time": session_start_time}
@@ -333,3 +464,128 @@ class FileRecord(dj.Computed):
         ).fetch("KEY")
 
         return [cls.create_entry(key) for key in alyxraw_filerecord_keys]
+
+
+@schema
+class OrphanEntry(dj.Manual):
+    definition = """  # alyx entries that could not be ingested by insert_from_alyxraw
+    table_name: varchar(32)  # shadow table, e.g. DataSet
+    uuid: uuid  # uuid of the alyx entry
+    ---
+    reason: varchar(255)  # e.g. the missing referenced entry
+    orphanentry_ts=CURRENT_TIMESTAMP: timestamp
+    """
+
+
+def _uuid_from_fvalue(column):
+    return f"UNHEX(REPLACE({column}, '-', ''))"
+
+
+def _insert_from_alyxraw(table, keys, chunksz, fields, joins, columns, required):
+    """Insert into a shadow table from a pivot of AlyxRaw.Field joined with lookup
+    tables, in chunks of keys, each chunk in one INSERT ... SELECT. Entries missing
+    a required value are recorded in OrphanEntry. A chunk whose statement fails is
+    ingested with create_entry instead.
+
+    Args:
+        table (datajoint table): shadow table with a single uuid primary key
+        keys (list of dict): keys to insert, defaults to key_source - table
+        chunksz (int): number of keys per statement
+        fields (tuple of str): AlyxRaw.Field fnames pivoted into the columns of p
+        joins (tuple): (alias, lookup table, uuid attribute, field) left joined on
+            the uuid stored in the field
+        columns (dict): attribute of table -> SQL expression
+        required (tuple): (SQL expression, reason), entries where the expression is
+            null are orphans
+
+    Returns:
+        int: number of inserted entries
+    """
+    if keys is None:
+        keys = (table.key_source - table).fetch("KEY")
+    pk = table.primary_key[0]
+    table_name = table.__class__.__name__
+
+    pivot_columns = ", ".join(
+        f"MAX(IF(fname = '{field}', fvalue, NULL)) AS `{field}`" for field in fields
+    )
+    fnames = ", ".join(f"'{field}'" for field in fields)
+    from_sql = "({pivot}) AS p " + " ".join(
+        f"LEFT JOIN {lookup.full_table_name} AS {alias} "
+        f"ON {alias}.`{attr}` = {_uuid_from_fvalue(f'p.`{field}`')}"
+        for alias, lookup, attr, field in joins
+    )
+    valid = " AND ".join(f"{expr} IS NOT NULL" for expr, _ in required)
+    reasons = " ".join(
+        f"WHEN {expr} IS NULL THEN '{reason}'" for expr, reason in required
+    )
+
+    n_inserted = 0
+    for i in tqdm(range(0, len(keys), chunksz), position=0):
+        chunk_keys = keys[i : i + chunksz]
+        uuids = ", ".join(f"X'{key[pk].hex}'" for key in chunk_keys)
+        chunk_from_sql = from_sql.format(
+            pivot=(
+                f"SELECT uuid, {pivot_columns} "
+                f"FROM {alyxraw.AlyxRaw.Field.full_table_name} "
+                f"WHERE uuid IN ({uuids}) AND value_idx = 0 AND fname IN ({fnames}) "
+                "GROUP BY uuid"
+            )
+        )
+        insert_sql = (
+            f"INSERT INTO {table.full_table_name} "
+            f"({', '.join(f'`{attr}`' for attr in columns)}) "
+            f"SELECT {', '.join(columns.values())} FROM {chunk_from_sql} "
+            f"WHERE {valid} "
+            f"ON DUPLICATE KEY UPDATE `{pk}` = VALUES(`{pk}`)"
+        )
+        orphan_sql = (
+            f"INSERT INTO {OrphanEntry.full_table_name} (table_name, uuid, reason) "
+            f"SELECT '{table_name}', p.uuid, CASE {reasons} END "
+            f"FROM {chunk_from_sql} WHERE NOT ({valid}) "
+            "ON DUPLICATE KEY UPDATE reason = VALUES(reason), "
+            "orphanentry_ts = CURRENT_TIMESTAMP"
+        )
+        try:
+            # inside a populate call, the caller's transaction is the bound
+            with (
+                contextlib.nullcontext()
+                if table.connection.in_transaction
+                else table.connection.transaction
+            ):
+                (
+                    OrphanEntry
+                    & {"table_name": table_name}
+                    & [{"uuid": key[pk]} for key in chunk_keys]
+                ).delete_quick()
+                n_inserted += table.connection.query(insert_sql).rowcount
+                table.connection.query(orphan_sql)
+        except Exception as e:
+            logger.info(
+                f"error in inserting {table_name} from alyxraw: {e}"
+                f" - Trying create_entry ({len(chunk_keys)} records)"
+            )
+            n_inserted += _insert_with_create_entry(table, chunk_keys)
+
+    return n_inserted
+
+
+def _insert_with_create_entry(table, keys):
+    table_name = table.__class__.__name__
+    pk = table.primary_key[0]
+    buffer = QueryBuffer(table)
+    orphans = []
+    with raw_field_batch([key[pk] for key in keys]):
+        for key in keys:
+            try:
+                buffer.add_to_queue1(table.create_entry(dict(key)))
+            except (ShadowIngestionError, AlyxKeyError, dj.DataJointError) as e:
+                orphans.append(
+                    dict(table_name=table_name, uuid=key[pk], reason=str(e)[:255])
+                )
+    n_entries = len(buffer._queue)
+    failed_insertions = buffer.flush_insert(
+        skip_duplicates=True, allow_direct_insert=True
+    )
+    OrphanEntry.insert(orphans, replace=True)
+    return n_entries - len(failed_insertions or [])
@@ -1,11 +1,17 @@
+import concurrent.futures
+import contextlib
 import datetime
+import functools
 import inspect
 import logging
+import multiprocessing
 import os
+import resource
 import time
 from pathlib import Path
 
 import datajoint as dj
+import pandas as pd
 
 schema = dj.schema(dj.config.get("database.prefix", "") + "ibl_ingest_job")
 
@@ -94,6 +100,235 @@ class TaskStatus(dj.Manual):
             skip_duplicates=True,
         )
 
+    @classmethod
+    @contextlib.contextmanager
+    def record(cls, job_key, task):
+        """Record the TaskStatus and the IngestionMetrics of the task run in the
+        context, the task status is only recorded if the task succeeded
+        """
+        start = datetime.datetime.now()
+        with IngestionMetrics.measure(get_metrics_job_name(job_key), task) as metrics:
+            yield metrics
+        cls.insert_task_status(job_key, task, start, end=datetime.datetime.now())
+
+
+_RUSAGE = (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)
+
+# IngestionMetrics attributes summed over the runs of a stage in a job
+_SUMMED_METRICS = (
+    "wall_time",
+    "cpu_time",
+    "rows_read",
+    "rows_written",
+    "bytes_sent",
+    "bytes_received",
+    "db_round_trips",
+    "error_count",
+)
+
+# session status counters of the database connection, see _get_session_status
+_STATUS_COUNTERS = {
+    "rows_read": (
+        "Handler_read_first",
+        "Handler_read_key",
+        "Handler_read_last",
+        "Handler_read_next",
+        "Handler_read_prev",
+        "Handler_read_rnd",
+        "Handler_read_rnd_next",
+    ),
+    "rows_written": ("Handler_write", "Handler_update", "Handler_delete"),
+    "bytes_sent": ("Bytes_received",),  # sent by the client, received by the server
+    "bytes_received": ("Bytes_sent",),
+    "db_round_trips": ("Questions",),
+}
+
+
+def _get_session_status(connection):
+    """Counters of _STATUS_COUNTERS for the session of the connection"""
+    names = [name for names in _STATUS_COUNTERS.values() for name in names]
+    status = dict(
+        connection.query(
+            "SHOW SESSION STATUS WHERE Variable_name IN ({})".format(
+                ", ".join(f'"{name}"' for name in names)
+            )
+        ).fetchall()
+    )
+    return {
+        attr: sum(int(status.get(name, 0)) for name in names)
+        for attr, names in _STATUS_COUNTERS.items()
+    }
+
+
+def get_metrics_job_name(job_key):
+    """job_name of IngestionMetrics for a key of Job or IngestionJob"""
+    if "job_datetime" in job_key:
+        return str(job_key["job_datetime"])
+    return f"{job_key['job_date']} {job_key['job_timezone']}"
+
+
+@schema
+class IngestionMetrics(dj.Manual):
+    definition = """  # resource usage of the ingestion stages, per table if applicable
+    job_name: varchar(48)  # see get_metrics_job_name
+    stage: varchar(64)  # task of Task or table populated for IngestionJob
+    table_name='': varchar(64)  # '' if the stage is not run per table
+    ---
+    stage_start_time: datetime
+    wall_time: float  # seconds
+    cpu_time: float  # seconds, user + system of the process and its terminated children
+    peak_rss: float  # MB, maximum resident set size of the process so far
+    rows_read=null: bigint  # rows read by the database session
+    rows_written=null: bigint  # rows inserted, updated and deleted by the database session
+    bytes_sent=null: bigint  # bytes sent to the database server
+    bytes_received=null: bigint  # bytes received from the database server
+    db_round_trips=null: int  # statements sent to the database server
+    error_count=0: int
+    error_message='': varchar(1000)
+    metrics_ts=CURRENT_TIMESTAMP: timestamp
+    """
+
+    @classmethod
+    @contextlib.contextmanager
+    def measure(cls, job_name, stage, table_name="", connection=None):
+        """Measure the stage run in the context and insert its IngestionMetrics.
+        If the stage was already measured for the job, e.g. in an earlier pass of
+        populate_ingestion_tables, the metrics are added to the recorded ones.
+
+        The database counters are the ones of the connection, which defaults to the
+        connection of the schema; the work of worker processes with their own
+        connections is only accounted for in cpu_time, once they terminated.
+        The yielded dict can be updated in the context, e.g. with error_count.
+        An exception raised in the context is counted and re-raised.
+
+        Args:
+            job_name (str): see get_metrics_job_name
+            stage (str): name of the stage
+            table_name (str, optional): table the stage is run for. Defaults to "".
+            connection (dj.Connection, optional): connection of the stage.
+                Defaults to the connection of the schema.
+        """
+        connection = connection or cls.connection
+        entry = {
+            "job_name": job_name,
+            "stage": stage,
+            "table_name": table_name,
+            "stage_start_time": datetime.datetime.utcnow(),
+            "error_count": 0,
+        }
+        try:
+            status = _get_session_status(connection)
+        except Exception:
+            status = None
+        usage = [resource.getrusage(r) for r in _RUSAGE]
+        start_time = time.time()
+        try:
+            yield entry
+        except Exception as e:
+            entry["error_count"] += 1
+            entry["error_message"] = f"{type(e).__name__}: {e}"[:1000]
+            raise
+        finally:
+            entry["wall_time"] = time.time() - start_time
+            end_usage = [resource.getrusage(r) for r in _RUSAGE]
+            entry["cpu_time"] = sum(
+                (u1.ru_utime + u1.ru_stime) - (u0.ru_utime + u0.ru_stime)
+                for u0, u1 in zip(usage, end_usage)
+            )
+            # ru_maxrss is in kB on linux
+            entry["peak_rss"] = max(u.ru_maxrss for u in end_usage) / 1024
+            if status is not None:
+                try:
+                    end_status = _get_session_status(connection)
+                except Exception:
+                    pass
+                else:
+                    entry.update(
+                        {attr: end_status[attr] - status[attr] for attr in status}
+                    )
+                    # discount the SHOW STATUS statement
+                    entry["db_round_trips"] -= 1
+            try:
+                cls._insert_accumulated(entry)
+            except Exception:
+                logger.exception(f"Could not record the metrics of {stage}")
+
+    @classmethod
+    def _insert_accumulated(cls, entry):
+        key = {attr: entry[attr] for attr in cls.primary_key}
+        previous = (cls & key).fetch(as_dict=True)
+        if previous:
+            (previous,) = previous
+            entry["stage_start_time"] = previous["stage_start_time"]
+            entry["peak_rss"] = max(entry["peak_rss"], previous["peak_rss"])
+            for attr in _SUMMED_METRICS:
+                if entry.get(attr) is None:
+                    entry[attr] = previous[attr]
+                elif previous[attr] is not None:
+                    entry[attr] += previous[attr]
+            entry["error_message"] = (
+                entry.get("error_message") or previous["error_message"]
+            )
+        cls.insert1(entry, replace=True)
+
+
+def get_metrics_trend(
+    metric="wall_time", stage=None, table_name=None, last_jobs=14, threshold=1.5
+):
+    """Trend of a metric of IngestionMetrics over the last jobs
+
+    Args:
+        metric (str, optional): attribute of IngestionMetrics. Defaults to "wall_time".
+        stage (str, optional): only the metrics of this stage. Defaults to all stages.
+        table_name (str, optional): only the metrics of this table. Defaults to all.
+        last_jobs (int, optional): number of most recent jobs. Defaults to 14.
+        threshold (float, optional): a stage and table regressed if the metric of
+            the last job is more than threshold times its median over the previous
+            jobs. Defaults to 1.5.
+
+    Returns:
+        pandas.DataFrame: one row per stage and table, one column per job from the
+            oldest to the latest, then the "median" over the previous jobs,
+            the "ratio" of the latest job to the median and whether it "regressed",
+            sorted by decreasing ratio
+    """
+    query = IngestionMetrics
+    if stage is not None:
+        query &= {"stage": stage}
+    if table_name is not None:
+        query &= {"table_name": table_name}
+
+    job_names = (dj.U("job_name") & query).fetch(
+        "job_name", order_by="job_name DESC", limit=last_jobs
+    )
+    df = pd.DataFrame(
+        (query & [{"job_name": j} for j in job_names]).fetch(
+            "job_name", "stage", "table_name", metric, as_dict=True
+        )
+    )
+    if df.empty:
+        return df
+
+    trend = df.pivot_table(
+        index=["stage", "table_name"], columns="job_name", values=metric
+    ).sort_index(axis=1)
+    trend["median"] = trend.iloc[:, :-1].median(axis=1)
+    trend["ratio"] = trend.iloc[:, -2] / trend["median"]
+    trend["regressed"] = trend["ratio"] > threshold
+    return trend.sort_values("ratio", ascending=False)
+
+
+def print_metrics_trend(metric="wall_time", **kwargs):
+    """Print get_metrics_trend, regressed stages and tables first"""
+    trend = get_metrics_trend(metric, **kwargs)
+    if trend.empty:
+        print(f"No {metric} recorded.")
+        return
+    with pd.option_context(
+        "display.max_rows", None, "display.max_columns", None, "display.width", None
+    ):
+        print(trend.round(2))
+
 
 # ================== Orchestrating the ingestion jobs =============
 
@@ -103,7 +338,6 @@ import data as alyx_data
 import experiments as alyx_experiments
 import misc as alyx_misc
 import subjects as alyx_subjects
-from tqdm import tqdm
 
 from ibl_pipeline import (
     acquisition,
@@ -114,14 +348,17 @@ from ibl_pipeline import (
     qc,
     reference,
     subject,
+    update,
 )
-from ibl_pipeline.ingest import QueryBuffer, ShadowIngestionError
 from ibl_pipeline.ingest import acquisition as shadow_acquisition
 from ibl_pipeline.ingest import action as shadow_action
 from ibl_pipeline.ingest import alyxraw
 from ibl_pipeline.ingest import data as shadow_data
+from ibl_pipeline.ingest import delete_cascade
 from ibl_pipeline.ingest import ephys as shadow_ephys
+from ibl_pipeline.ingest import get_modified_alyxraw
 from ibl_pipeline.ingest import histology as shadow_histology
+from ibl_pipeline.ingest import populate_chunks
 from ibl_pipeline.ingest import qc as shadow_qc
 from ibl_pipeline.ingest import reference as shadow_reference
 from ibl_pipeline.ingest import subject as shadow_subject
@@ -569,6 +806,32 @@ DJ_UPDATES = {
 }
 
 
+@functools.lru_cache()
+def get_ingestion_dag():
+    """Dependency graph of the tables in DJ_TABLES, built once from the ancestors
+    of their shadow and real tables
+
+    Returns:
+        dict: table_name -> set of the names of the DJ_TABLES it depends on
+    """
+    table_names = {}
+    for table_name, tables in DJ_TABLES.items():
+        for table in tables.values():
+            if table is not None:
+                table_names[table.full_table_name] = table_name
+
+    dag = {}
+    for table_name, tables in DJ_TABLES.items():
+        ancestors = set()
+        for table in tables.values():
+            if table is not None:
+                ancestors.update(table().ancestors())
+        dag[table_name] = {table_names[a] for a in ancestors if a in table_names} - {
+            table_name
+        }
+    return dag
+
+
 # ------ Pipeline for ingestion orchestration ------
 
 
@@ -740,22 +1003,8 @@ class AlyxRawDiff(dj.Computed):
                 ignore_extra_fields=True,
             )
 
-            # updated
-            fields_original = alyxraw.AlyxRaw.Field & (
-                alyxraw.AlyxRaw & {"model": key["alyx_model_name"]}
-            )
-            fields_update = alyxraw.UpdateAlyxRaw.Field & (
-                alyxraw.UpdateAlyxRaw & {"model": key["alyx_model_name"]}
-            )
-
-            fields_restriction = {}
-
-            modified_entries = alyxraw.AlyxRaw & (
-                fields_update.proj(fvalue_new="fvalue") * fields_original
-                & "fvalue_new != fvalue"
-                & 'fname not in ("json")'
-                & fields_restriction
-            )
+            # updated, comparing the content hashes of the entries
+            modified_entries = get_modified_alyxraw(key["alyx_model_name"])
             self.ModifiedEntry.insert(
                 modified_entries.proj(
                     ...,
@@ -808,25 +1057,21 @@ class DeleteModifiedAlyxRaw(dj.Computed):
             f" - {len(keys_to_delete)} records"
         )
 
+        # break transaction here, each chunk of deletions is its own transaction
+        self.connection.cancel_transaction()
+
         # handle AlyxRaw table
         if key["alyx_model_name"] == "actions.session":
-            alyxraw_field_buffer = QueryBuffer(
+            delete_cascade(
                 alyxraw.AlyxRaw.Field
                 & 'fname!="start_time"'
-                & (alyxraw.AlyxRaw & {"model": key["alyx_model_name"]})
+                & (alyxraw.AlyxRaw & {"model": key["alyx_model_name"]}),
+                keys_to_delete,
             )
-            for pk in keys_to_delete:
-                alyxraw_field_buffer.add_to_queue1(pk)
-                alyxraw_field_buffer.flush_delete(chunksz=50, quick=True)
-            alyxraw_field_buffer.flush_delete(quick=True)
         else:
-            alyxraw_buffer = QueryBuffer(
-                alyxraw.AlyxRaw & {"model": key["alyx_model_name"]}
+            delete_cascade(
+                alyxraw.AlyxRaw & {"model": key["alyx_model_name"]}, keys_to_delete
             )
-            for pk in keys_to_delete:
-                alyxraw_buffer.add_to_queue1(pk)
-                alyxraw_buffer.flush_delete(chunksz=50, quick=False)
-            alyxraw_buffer.flush_delete(quick=False)
 
         # handle shadow membership tables
         if key["alyx_model_name"] in MEMBERSHIP_ALYX_MODELS:
@@ -1012,37 +1257,62 @@ class PopulateShadowTable(dj.Computed):
                             )
 
         if key["table_name"] in ("data.DataSet", "data.FileRecord"):
+            # insert_from_alyxraw commits each chunk in its own transaction
+            self.connection.cancel_transaction()
+            # entries of the datasets modified since the previous job, backtrack_days
+            # back for late entries, and the orphans of the previous jobs
+            watermark = update.PopulateWatermark.get_watermark(shadow_table)
             date_cutoff = (
-                datetime.datetime.now().date()
+                (watermark or datetime.datetime.now())
                 - datetime.timedelta(days=_backtrack_days)
-            ).strftime("%Y-%m-%d")
+            ).strftime("%Y-%m-%d %H:%M:%S")
+            auto_datetimes = (
+                alyxraw.AlyxRaw.Field
+                & (alyxraw.AlyxRaw & {"model": "data.dataset"})
+                & 'fname = "auto_datetime"'
+                & 'fvalue != "None"'
+            )
+            new_datasets = auto_datetimes & f'fvalue > "{date_cutoff}"'
+            if key["table_name"] == "data.DataSet":
+                new_entries = new_datasets.proj()
+            else:
+                new_entries = (
+                    alyxraw.AlyxRaw.Field
+                    & 'fname = "dataset"'
+                    & "UNHEX(REPLACE(fvalue, '-', '')) IN ({})".format(
+                        new_datasets.make_sql(["uuid"])
+                    )
+                ).proj()
+            orphans = shadow_data.OrphanEntry & {
+                "table_name": key["table_name"].split(".")[-1]
+            }
             uuid_attr = shadow_table.primary_key[0]
             key_source = (
                 shadow_table.key_source.proj(uuid=uuid_attr)
-                & (
-                    alyxraw.AlyxRaw * alyxraw.AlyxRaw.Field
-                    & 'fname = "auto_datetime"'
-                    & f'fvalue > "{date_cutoff}"'
-                )
+                & [new_entries, orphans.proj()]
             ).proj(**{uuid_attr: "uuid"})
+            # taken before inserting, later entries are picked up by the next job
+            new_watermark = auto_datetimes.fetch(
+                "fvalue", order_by="fvalue DESC", limit=1
+            )
 
-            query_buffer = QueryBuffer(shadow_table, verbose=True)
-            for k in tqdm((key_source - shadow_table).fetch("KEY")):
-                try:
-                    query_buffer.add_to_queue1(shadow_table.create_entry(k))
-                except ShadowIngestionError:
-                    pass
-                query_buffer.flush_insert(
-                    skip_duplicates=True, allow_direct_insert=True, chunksz=1000
+            # one INSERT ... SELECT per chunk, orphans are recorded in data.OrphanEntry
+            shadow_table.insert_from_alyxraw((key_source - shadow_table).fetch("KEY"))
+
+            if len(new_watermark):
+                update.PopulateWatermark.set_watermark(
+                    shadow_table, datetime.datetime.fromisoformat(new_watermark[0][:19])
                 )
-            query_buffer.flush_insert(skip_duplicates=True, allow_direct_insert=True)
         elif is_membership:
             tab_args = DJ_SHADOW_MEMBERSHIP[key["table_name"]]
             ingest_membership.ingest_membership_table(**tab_args)
         else:
             self.connection.cancel_transaction()
-            shadow_table.populate(
-                reserve_jobs=True, display_progress=True, suppress_errors=True
+            populate_chunks(
+                shadow_table,
+                reserve_jobs=True,
+                display_progress=True,
+                suppress_errors=True,
             )
 
         after_count, _ = shadow_table.progress() if not is_membership else (None, None)
@@ -1081,23 +1351,8 @@ class CopyRealTable(dj.Computed):
 
         # Ensure the real-table copy routine is "in topologically sorted order"
         # so, if ancestors of this table is not yet copied, exit and retry later
-        schema_prefix = dj.config.get("database.prefix", "") + "ibl_"
-        ancestors = [tbl_name.split(".") for tbl_name in real_table.ancestors()]
         ancestors = [
-            schema_name.strip("`").replace(schema_prefix, "")
-            + "."
-            + ".".join(
-                [
-                    dj.utils.to_camel_case(s)
-                    for s in tbl_name.strip("`").split("__")
-                    if s
-                ]
-            )
-            for schema_name, tbl_name in ancestors
-        ]
-
-        ancestors = [
-            n for n in ancestors if n in self._real_tables and n != key["table_name"]
+            n for n in get_ingestion_dag()[key["table_name"]] if n in self._real_tables
         ]
 
         are_ancestors_copied = len(
@@ -1194,6 +1449,22 @@ class UpdateRealTable(dj.Computed):
         self.insert1(key)
 
 
+@schema
+class IngestionNodeTiming(dj.Manual):
+    definition = """  # timing of the tables ingested by populate_ingestion_dag
+    -> IngestionJob
+    table_name: varchar(48)
+    ---
+    node_start_time: datetime  # UTC time
+    node_duration: float  # seconds, shadow + copy + update
+    shadow_duration=null: float  # seconds, PopulateShadowTable
+    copy_duration=null: float  # seconds, CopyRealTable
+    update_duration=null: float  # seconds, UpdateRealTable
+    node_status: enum('success', 'error', 'skipped')
+    node_error='': varchar(1000)
+    """
+
+
 # what's next
 """
     job.main()
@@ -1226,6 +1497,8 @@ def _check_ingestion_completion():
         (IngestionJob & key)._update("job_status", "completed")
         (IngestionJob & key)._update("job_endtime", datetime.datetime.utcnow())
         logger.info(f"All ingestion jobs completed: {key}")
+        # wake up the populate routines waiting for new data
+        update.PipelineEvent.notify("ingestion")
         return True
 
     return False
@@ -1244,6 +1517,134 @@ _ingestion_tables = (
 )
 
 
+_node_populate_settings = {}
+
+
+def _init_node_worker(populate_settings):
+    # forked workers must not share the database connection of the parent process
+    IngestionJob.connection.connect()
+    _node_populate_settings.update(populate_settings)
+
+
+def _populate_node(job_key, table_name):
+    """Populate PopulateShadowTable, CopyRealTable and UpdateRealTable
+    for one table of DJ_TABLES
+
+    Returns:
+        dict: IngestionNodeTiming entry
+    """
+    key = {**job_key, "table_name": table_name}
+    entry = {**key, "node_start_time": datetime.datetime.utcnow()}
+    stages = [("shadow_duration", PopulateShadowTable)]
+    if table_name in CopyRealTable._real_tables:
+        stages.append(("copy_duration", CopyRealTable))
+    if table_name in DJ_UPDATES:
+        stages.append(("update_duration", UpdateRealTable))
+
+    start_time = time.time()
+    try:
+        for attr, table in stages:
+            stage_start_time = time.time()
+            with IngestionMetrics.measure(
+                get_metrics_job_name(job_key), table.__name__, table_name
+            ):
+                table.populate(key, **_node_populate_settings)
+            entry[attr] = time.time() - stage_start_time
+            if not table & key:
+                raise dj.DataJointError(f"{table.__name__} not populated for {key}")
+    except Exception as e:
+        entry.update(node_status="error", node_error=f"{type(e).__name__}: {e}"[:1000])
+    else:
+        entry["node_status"] = "success"
+    entry["node_duration"] = time.time() - start_time
+    return entry
+
+
+def populate_ingestion_dag(job_key=None, processes=4, **kwargs):
+    """Populate PopulateShadowTable, CopyRealTable and UpdateRealTable following the
+    dependency graph of DJ_TABLES, so that the tables whose dependencies are ingested
+    are populated concurrently by a pool of worker processes.
+    A table is skipped if any of its dependencies failed, and the timing of each
+    table is recorded in IngestionNodeTiming.
+
+    Args:
+        job_key (dict, optional): key of IngestionJob. Defaults to the on-going job.
+        processes (int, optional): number of worker processes. Defaults to 4.
+        kwargs: settings passed to populate
+
+    Returns:
+        list: names of the tables that failed or were skipped
+    """
+    job_key = job_key or IngestionJob.get_on_going_key()
+    if not ShadowTable & job_key:
+        return []
+
+    populate_settings = {"reserve_jobs": True, "suppress_errors": True, **kwargs}
+    populate_settings.pop("display_progress", None)
+
+    dag = get_ingestion_dag()
+    pending = dict(dag)
+    done, failed = set(), set()
+
+    # fork so that the workers inherit the schema modules, each reconnects
+    ctx = multiprocessing.get_context("fork")
+    with concurrent.futures.ProcessPoolExecutor(
+        processes,
+        mp_context=ctx,
+        initializer=_init_node_worker,
+        initargs=(populate_settings,),
+    ) as pool:
+        running = {}
+        while pending or running:
+            for table_name, dependencies in list(pending.items()):
+                if dependencies & failed:
+                    del pending[table_name]
+                    failed.add(table_name)
+                    IngestionNodeTiming.insert1(
+                        {
+                            **job_key,
+                            "table_name": table_name,
+                            "node_start_time": datetime.datetime.utcnow(),
+                            "node_duration": 0,
+                            "node_status": "skipped",
+                            "node_error": "dependencies failed: "
+                            + ", ".join(sorted(dependencies & failed))[:970],
+                        },
+                        replace=True,
+                    )
+                elif dependencies <= done:
+                    del pending[table_name]
+                    running[
+                        pool.submit(_populate_node, job_key, table_name)
+                    ] = table_name
+
+            if not running:
+                if not any(dependencies & failed for dependencies in pending.values()):
+                    raise dj.DataJointError(
+                        f"Cyclic dependencies between {sorted(pending)}"
+                    )
+                continue
+
+            finished, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in finished:
+                table_name = running.pop(future)
+                entry = future.result()
+                IngestionNodeTiming.insert1(entry, replace=True)
+                logger.log(
+                    25,
+                    f"{table_name}: {entry['node_status']} "
+                    f"in {entry['node_duration']:.1f} s",
+                )
+                if entry["node_status"] == "success":
+                    done.add(table_name)
+                else:
+                    failed.add(table_name)
+
+    return sorted(failed)
+
+
 def read_db_loaded_file(local_alyx_name="alyxlocal") -> str:
     try:
         alyx_db_name = dj.config["custom"]["database.alyx.name"]
@@ -1275,10 +1676,14 @@ def read_db_loaded_file(local_alyx_name="alyxlocal") -> str:
     return backup_date
 
 
-def populate_ingestion_tables(run_duration=3600 * 3, sleep_duration=60, **kwargs):
+def populate_ingestion_tables(
+    run_duration=3600 * 3, sleep_duration=60, processes=None, **kwargs
+):
     """
     Routine to populate all ingestion tables
     Run in continuous loop for the duration defined in "run_duration" (default 3 hours)
+    If "processes" is larger than 1, PopulateShadowTable, CopyRealTable and UpdateRealTable
+    are populated with populate_ingestion_dag using that many worker processes
     """
     populate_settings = {
         "display_progress": True,
@@ -1300,12 +1705,25 @@ def populate_ingestion_tables(run_duration=3600 * 3, sleep_duration=60, **kwargs
             IngestionJob.create_entry(latest_sql_dump)
 
         # check if completed
-        if _check_ingestion_completion():
+        is_completed = _check_ingestion_completion()
+        if is_completed:
             _clean_up()
         else:
             for table in _ingestion_tables:
+                if processes and processes > 1 and table is PopulateShadowTable:
+                    logger.info("------------- Ingestion DAG ---------------")
+                    populate_ingestion_dag(processes=processes, **populate_settings)
+                    break
                 logger.info(f"------------- {table.__name__} ---------------")
-                table.populate(**populate_settings)
+                with IngestionMetrics.measure(
+                    get_metrics_job_name(IngestionJob.get_latest_key()),
+                    table.__name__,
+                ) as metrics:
+                    table.populate(**populate_settings)
+                    metrics["error_count"] = len(
+                        schema.jobs
+                        & {"table_name": table.table_name, "status": "error"}
+                    )
 
         (schema.jobs & 'status = "error"').delete()
         stale_jobs = (schema.jobs & 'status = "reserved"').proj(
@@ -1313,7 +1731,33 @@ def populate_ingestion_tables(run_duration=3600 * 3, sleep_duration=60, **kwargs
         ) & "elapsed_days > 1"
         (schema.jobs & stale_jobs).delete()
 
-        time.sleep(sleep_duration)
+        if is_completed:
+            # nothing left to ingest until the next sql dump is loaded
+            _wait_for_new_sql_dump(
+                last_dump_file,
+                timeout=None
+                if run_duration is None or run_duration < 0
+                else run_duration - (time.time() - start_time),
+                poll_interval=sleep_duration,
+            )
+        else:
+            time.sleep(sleep_duration)
+
+
+def _wait_for_new_sql_dump(last_dump_file, timeout=None, poll_interval=60):
+    """Wait until an alyx sql dump other than last_dump_file is loaded,
+    only reading the db_loaded file in the meantime
+
+    Returns:
+        str: the new sql dump, "" on timeout
+    """
+    start_time = time.time()
+    while timeout is None or time.time() - start_time < timeout:
+        latest_sql_dump = read_db_loaded_file()
+        if latest_sql_dump and latest_sql_dump != last_dump_file:
+            return latest_sql_dump
+        time.sleep(poll_interval)
+    return ""
 
 
 def _clean_up():
@@ -1,3 +1,4 @@
+import functools
 import json
 
 import datajoint as dj
@@ -52,7 +53,10 @@ def get_extended_qc_fields_from_alyx(level="session"):
     return set(eqc_fields)
 
 
-qc_choices = qc_real.QCChoice.fetch(format="frame")
+@functools.lru_cache(maxsize=None)
+def get_qc_choices():
+    """QCChoice as a dataframe, fetched once at first use rather than at import"""
+    return qc_real.QCChoice.fetch(format="frame")
 
 
 @schema
@@ -105,6 +109,7 @@ class SessionQCIngest(dj.Computed):
                 elif extended_qc_label == 1 and qc_type == "behavior":
                     extended_qc = 10
                 else:
+                    qc_choices = get_qc_choices()
                     extended_qc = qc_choices[
                         qc_choices["qc_label"] == extended_qc_label
                     ].index[0]
@@ -5,7 +5,7 @@ import datajoint as dj
 
 from ibl_pipeline.ingest import ShadowIngestionError, alyxraw
 from ibl_pipeline.ingest import get_raw_field as grf
-from ibl_pipeline.ingest import reference
+from ibl_pipeline.ingest import lookup1, reference
 
 schema = dj.schema(dj.config.get("database.prefix", "") + "ibl_ingest_subject")
 
@@ -173,15 +173,15 @@ class Line(dj.Computed):
         key["uuid"] = key["line_uuid"]
 
         species_uuid = grf(key, "species")
-        key_line["binomial"] = (
-            Species & dict(species_uuid=uuid.UUID(species_uuid))
-        ).fetch1("binomial")
+        key_line["binomial"] = lookup1(
+            Species, dict(species_uuid=uuid.UUID(species_uuid)), "binomial"
+        )
 
         strain_uuid = grf(key, "strain")
         if strain_uuid != "None":
-            key_line["strain_name"] = (
-                Strain & dict(strain_uuid=uuid.UUID(strain_uuid))
-            ).fetch1("strain_name")
+            key_line["strain_name"] = lookup1(
+                Strain, dict(strain_uuid=uuid.UUID(strain_uuid)), "strain_name"
+            )
 
         key_line["line_name"] = grf(key, "name")
 
@@ -242,9 +242,9 @@ class Subject(dj.Computed):
 
         strain_uuid = grf(key, "strain")
         if strain_uuid != "None":
-            key_subject["subject_strain"] = (
-                Strain & dict(strain_uuid=uuid.UUID(strain_uuid))
-            ).fetch1("strain_name")
+            key_subject["subject_strain"] = lookup1(
+                Strain, dict(strain_uuid=uuid.UUID(strain_uuid)), "strain_name"
+            )
 
         birth_date = grf(key, "birth_date")
         if birth_date != "None":
@@ -252,9 +252,9 @@ class Subject(dj.Computed):
 
         line_uuid = grf(key, "line")
         if line_uuid != "None":
-            key_subject["subject_line"] = (
-                Line & dict(line_uuid=uuid.UUID(line_uuid))
-            ).fetch1("line_name")
+            key_subject["subject_line"] = lookup1(
+                Line, dict(line_uuid=uuid.UUID(line_uuid)), "line_name"
+            )
 
         key_subject["protocol_number"] = grf(key, "protocol_number")
 
@@ -264,9 +264,9 @@ class Subject(dj.Computed):
 
         source_uuid = grf(key, "source")
         if source_uuid != "None":
-            key_subject["subject_source"] = (
-                Source & dict(source_uuid=uuid.UUID(source_uuid))
-            ).fetch1("source_name")
+            key_subject["subject_source"] = lookup1(
+                Source, dict(source_uuid=uuid.UUID(source_uuid)), "source_name"
+            )
 
         description = grf(key, "description")
         if description != "None":
@@ -325,8 +325,8 @@ class BreedingPair(dj.Computed):
 
         line_uuid = grf(key, "line")
         if line_uuid != "None":
-            key_bp["bp_line"] = (Line & dict(line_uuid=uuid.UUID(line_uuid))).fetch1(
-                "line_name"
+            key_bp["bp_line"] = lookup1(
+                Line, dict(line_uuid=uuid.UUID(line_uuid)), "line_name"
             )
 
         key_bp["bp_name"] = grf(key, "name")
@@ -379,17 +379,17 @@ class Litter(dj.Computed):
 
         bp_uuid = grf(key, "breeding_pair")
         if bp_uuid != "None":
-            key_litter["bp_name"] = (
-                BreedingPair & dict(bp_uuid=uuid.UUID(bp_uuid))
-            ).fetch1("bp_name")
+            key_litter["bp_name"] = lookup1(
+                BreedingPair, dict(bp_uuid=uuid.UUID(bp_uuid)), "bp_name"
+            )
 
         key_litter["litter_name"] = grf(key, "name")
 
         line_uuid = grf(key, "line")
         if line_uuid != "None":
-            key_litter["litter_line"] = (
-                Line & dict(line_uuid=uuid.UUID(line_uuid))
-            ).fetch1("line_name")
+            key_litter["litter_line"] = lookup1(
+                Line, dict(line_uuid=uuid.UUID(line_uuid)), "line_name"
+            )
 
         description = grf(key, "description")
         if description != "None":
@@ -424,8 +424,8 @@ class LitterSubject(dj.Computed):
         key_ls = key.copy()
         key["uuid"] = key["subject_uuid"]
         litter = grf(key, "litter")
-        key_ls["litter_name"] = (Litter & dict(litter_uuid=uuid.UUID(litter))).fetch1(
-            "litter_name"
+        key_ls["litter_name"] = lookup1(
+            Litter, dict(litter_uuid=uuid.UUID(litter)), "litter_name"
         )
         self.insert1(key_ls)
 
@@ -457,9 +457,11 @@ class SubjectProject(dj.Computed):
         for proj_uuid in proj_uuids:
             key_sp = key_s.copy()
             try:
-                key_sp["subject_project"] = (
-                    reference.Project & dict(project_uuid=uuid.UUID(proj_uuid))
-                ).fetch1("project_name")
+                key_sp["subject_project"] = lookup1(
+                    reference.Project,
+                    dict(project_uuid=uuid.UUID(proj_uuid)),
+                    "project_name",
+                )
                 self.insert1(key_sp)
             except Exception:
                 print(key["subject_uuid"])
@@ -490,9 +492,9 @@ class SubjectUser(dj.Computed):
         key["uuid"] = key["subject_uuid"]
 
         user = grf(key, "responsible_user")
-        key_su["responsible_user"] = (
-            reference.LabMember & dict(user_uuid=uuid.UUID(user))
-        ).fetch1("user_name")
+        key_su["responsible_user"] = lookup1(
+            reference.LabMember, dict(user_uuid=uuid.UUID(user)), "user_name"
+        )
         self.insert1(key_su)
 
 
@@ -514,8 +516,8 @@ class SubjectLab(dj.Computed):
         key_sl = key.copy()
         key["uuid"] = key["subject_uuid"]
         lab = grf(key, "lab")
-        key_sl["lab_name"] = (reference.Lab & dict(lab_uuid=uuid.UUID(lab))).fetch1(
-            "lab_name"
+        key_sl["lab_name"] = lookup1(
+            reference.Lab, dict(lab_uuid=uuid.UUID(lab)), "lab_name"
         )
         self.insert1(key_sl)
 
@@ -585,9 +587,9 @@ class UserHistory(dj.Computed):
         key["uuid"] = key["subject_uuid"]
 
         user = grf(key, "responsible_user", model="subjects.subject")
-        key_user["user_name"] = (
-            reference.LabMember & dict(user_uuid=uuid.UUID(user))
-        ).fetch1("user_name")
+        key_user["user_name"] = lookup1(
+            reference.LabMember, dict(user_uuid=uuid.UUID(user)), "user_name"
+        )
 
         json_content = grf(key, "json", model="subjects.subject")
         if json_content != "None":
@@ -605,9 +607,11 @@ class UserHistory(dj.Computed):
                     self.insert1(key_user_i)
                     if user["value"] != "None":
                         user_uuid = user["value"]
-                        key_user_i["user_name"] = (
-                            reference.LabMember & dict(user_uuid=uuid.UUID(user_uuid))
-                        ).fetch1("user_name")
+                        key_user_i["user_name"] = lookup1(
+                            reference.LabMember,
+                            dict(user_uuid=uuid.UUID(user_uuid)),
+                            "user_name",
+                        )
         else:
             self.insert1(key_user)
 
@@ -758,21 +762,25 @@ class Housing(dj.Computed):
 
         food_uuid = grf(key, "food")
         if food_uuid != "None":
-            key_housing["food_name"] = (
-                Food & dict(food_uuid=uuid.UUID(food_uuid))
-            ).fetch1("food_name")
+            key_housing["food_name"] = lookup1(
+                Food, dict(food_uuid=uuid.UUID(food_uuid)), "food_name"
+            )
 
         enrichment_uuid = grf(key, "enrichment")
         if enrichment_uuid != "None":
-            key_housing["enrichment_name"] = (
-                Enrichment & dict(enrichment_uuid=uuid.UUID(enrichment_uuid))
-            ).fetch1("enrichment_name")
+            key_housing["enrichment_name"] = lookup1(
+                Enrichment,
+                dict(enrichment_uuid=uuid.UUID(enrichment_uuid)),
+                "enrichment_name",
+            )
 
         cage_type_uuid = grf(key, "cage_type")
         if cage_type_uuid != "None":
-            key_housing["cage_type_name"] = (
-                CageType & dict(cage_type_uuid=uuid.UUID(cage_type_uuid))
-            ).fetch1("cage_type_name")
+            key_housing["cage_type_name"] = lookup1(
+                CageType,
+                dict(cage_type_uuid=uuid.UUID(cage_type_uuid)),
+                "cage_type_name",
+            )
 
         frequency = grf(key, "cage_cleaning_frequency_days")
         if frequency != "None":
@@ -820,9 +828,9 @@ class SubjectHousing(dj.Computed):
         housing = grf(key, "housing")
         if housing == "None":
             return
-        key_subj_housing["cage_name"] = (
-            Housing & dict(housing_uuid=uuid.UUID(housing))
-        ).fetch1("cage_name")
+        key_subj_housing["cage_name"] = lookup1(
+            Housing, dict(housing_uuid=uuid.UUID(housing)), "cage_name"
+        )
 
         self.insert1(key_subj_housing)
 
@@ -850,9 +858,9 @@ class GenotypeTest(dj.Computed):
         key_gt["subject_uuid"] = uuid.UUID(grf(key, "subject"))
 
         sequence_uuid = grf(key, "sequence")
-        key_gt["sequence_name"] = (
-            Sequence & dict(sequence_uuid=uuid.UUID(sequence_uuid))
-        ).fetch1("sequence_name")
+        key_gt["sequence_name"] = lookup1(
+            Sequence, dict(sequence_uuid=uuid.UUID(sequence_uuid)), "sequence_name"
+        )
 
         test_result = grf(key, "test_result")
         key_gt["test_result"] = "Present" if test_result else "Absent"
@@ -886,9 +894,9 @@ class Zygosity(dj.Computed):
             return
 
         allele_uuid = grf(key, "allele")
-        key_zg["allele_name"] = (
-            Allele & dict(allele_uuid=uuid.UUID(allele_uuid))
-        ).fetch1("allele_name")
+        key_zg["allele_name"] = lookup1(
+            Allele, dict(allele_uuid=uuid.UUID(allele_uuid)), "allele_name"
+        )
 
         zygosity = grf(key, "zygosity")
         zygosity_types = {
@@ -49,6 +49,7 @@ SESSION_TABLES = [
     "wheel.WheelMoveSet",
     "behavior.CompleteWheelSession",
     "behavior.AmbientSensorData",
+    "behavior.TrialSetColumns",
     "behavior.TrialSet.ExcludedTrial",
     "behavior.TrialSet.Trial",
     "behavior.TrialSet",
@@ -50,6 +50,7 @@ def process_new(
     job_date=datetime.date.today().strftime("%Y-%m-%d"),
     timezone="other",
     perform_updates=True,
+    processes=None,
 ):
 
     job_key = dict(
@@ -73,69 +74,45 @@ def process_new(
 
     if perform_updates:
         logger.log(25, "Deleting modified entries from alyxraw and shadow tables...")
-        start = datetime.datetime.now()
-
-        delete_update_entries.delete_entries_from_alyxraw(
-            modified_pks, modified_pks_important
-        )
-
-        job.TaskStatus.insert_task_status(
-            job_key, "Delete alyxraw", start, end=datetime.datetime.now()
-        )
+        with job.TaskStatus.record(job_key, "Delete alyxraw"):
+            delete_update_entries.delete_entries_from_alyxraw(
+                modified_pks, modified_pks_important
+            )
 
         logger.log(25, "Deleting modified entries from membership tables...")
-        start = datetime.datetime.now()
-        delete_update_entries.delete_entries_from_membership(modified_pks_important)
-        job.TaskStatus.insert_task_status(
-            job_key, "Delete shadow membership", start, end=datetime.datetime.now()
-        )
+        with job.TaskStatus.record(job_key, "Delete shadow membership"):
+            delete_update_entries.delete_entries_from_membership(modified_pks_important)
 
     logger.log(25, "Ingesting into alyxraw...")
-    start = datetime.datetime.now()
-    ingest_alyx_raw.insert_to_alyxraw(
-        ingest_alyx_raw.get_alyx_entries(
-            latest_dump, new_pks=created_pks + modified_pks
+    with job.TaskStatus.record(job_key, "Ingest alyxraw"):
+        ingest_alyx_raw.insert_to_alyxraw(
+            ingest_alyx_raw.iter_alyx_entries(
+                latest_dump, new_pks=created_pks + modified_pks
+            )
         )
-    )
-    job.TaskStatus.insert_task_status(
-        job_key, "Ingest alyxraw", start, end=datetime.datetime.now()
-    )
 
     logger.log(25, "Ingesting into shadow tables...")
-    start = datetime.datetime.now()
-    ingest_shadow.main(modified_sessions_pks=modified_pks_important)
-    job.TaskStatus.insert_task_status(
-        job_key, "Ingest shadow", start, end=datetime.datetime.now()
-    )
+    with job.TaskStatus.record(job_key, "Ingest shadow"):
+        ingest_shadow.main(modified_sessions_pks=modified_pks_important)
 
     logger.log(25, "Ingesting into shadow membership tables...")
-    start = datetime.datetime.now()
-    ingest_membership.main(created_pks + modified_pks_important)
-    job.TaskStatus.insert_task_status(
-        job_key, "Ingest shadow membership", start, end=datetime.datetime.now()
-    )
+    with job.TaskStatus.record(job_key, "Ingest shadow membership"):
+        ingest_membership.main(created_pks + modified_pks_important)
 
     logger.log(25, "Ingesting alyx real...")
-    start = datetime.datetime.now()
-    ingest_real.main()
-    job.TaskStatus.insert_task_status(
-        job_key, "Ingest real", start, end=datetime.datetime.now()
-    )
+    with job.TaskStatus.record(job_key, "Ingest real"):
+        ingest_real.main(processes=processes)
 
     if perform_updates:
         logger.log(25, "Updating fields...")
-        start = datetime.datetime.now()
-        delete_update_entries.update_entries_from_real_tables(modified_pks_important)
-        job.TaskStatus.insert_task_status(
-            job_key, "Update fields", start, end=datetime.datetime.now()
-        )
+        with job.TaskStatus.record(job_key, "Update fields"):
+            delete_update_entries.update_entries_from_real_tables(
+                modified_pks_important
+            )
 
     logger.log(25, "Ingesting behavior...")
-    start = datetime.datetime.now()
-    populate_behavior.main(backtrack_days=30)
-    job.TaskStatus.insert_task_status(
-        job_key, "Populate behavior", start, end=datetime.datetime.now()
-    )
+    with job.TaskStatus.record(job_key, "Populate behavior"):
+        populate_behavior.main(backtrack_days=30)
 
 
 # TODO: change /data /tmp to use dj.config
@@ -152,7 +129,7 @@ def process_updates(pks, current_dump="/data/alyxfull.json"):
 
     logger.log(25, "Ingesting alyxraw...")
     ingest_alyx_raw.insert_to_alyxraw(
-        ingest_alyx_raw.get_alyx_entries(current_dump, new_pks=pks)
+        ingest_alyx_raw.iter_alyx_entries(current_dump, new_pks=pks)
     )
 
     logger.log(25, "Ingesting into shadow tables...")
@@ -215,12 +192,15 @@ def get_created_modified_deleted_pks():
     return created_pks, modified_pks, deleted_pks
 
 
-def process_postgres(sql_dump_path="/tmp/dump.sql.gz", perform_updates=True):
+def process_postgres(
+    sql_dump_path="/tmp/dump.sql.gz", perform_updates=True, processes=None
+):
     """function that process daily ingestion routine based on alyx postgres instance set up with sql dump
 
     Args:
         sql_dump_path (str, optional): file path to the current sql dump. Defaults to '/tmp/dump.sql.gz'
         perform_updates (bool, optional): whether to perform entry updates. Defaults to False.
+        processes (int, optional): number of worker processes copying the real tables. Defaults to None.
     """
 
     # ---- Step 1: new job entry in the job.Job table ----
@@ -243,21 +223,18 @@ def process_postgres(sql_dump_path="/tmp/dump.sql.gz", perform_updates=True):
     # compare the same tables between UpdateAlyxRaw and AlyxRaw,
     # get the created, modified, and deleted uuids
     logger.log(25, "Getting created, modified and deleted uuids...")
-    start = datetime.datetime.now()
-    created_pks, modified_pks, deleted_pks = get_created_modified_deleted_pks()
-
-    job.Job.insert1(
-        dict(
-            job_entry,
-            create_pks=created_pks,
-            modified_pks_important=modified_pks,
-            deleted_pks=deleted_pks,
-        ),
-        replace=True,
-    )
-    job.TaskStatus.insert_task_status(
-        job_key, "Get created modified deleted pks", start, end=datetime.datetime.now()
-    )
+    with job.TaskStatus.record(job_key, "Get created modified deleted pks"):
+        created_pks, modified_pks, deleted_pks = get_created_modified_deleted_pks()
+
+        job.Job.insert1(
+            dict(
+                job_entry,
+                create_pks=created_pks,
+                modified_pks_important=modified_pks,
+                deleted_pks=deleted_pks,
+            ),
+            replace=True,
+        )
     logger.log(25, "Job entry created!")
 
     # ---- Step 4: perform updates ----
@@ -268,72 +245,50 @@ def process_postgres(sql_dump_path="/tmp/dump.sql.gz", perform_updates=True):
             25,
             "Deleting modified and deleted entries from alyxraw and shadow tables ...",
         )
-        start = datetime.datetime.now()
-        delete_update_entries.delete_entries_from_alyxraw(
-            [], modified_pks + deleted_pks
-        )
-        job.TaskStatus.insert_task_status(
-            job_key, "Delete alyxraw", start, end=datetime.datetime.now()
-        )
+        with job.TaskStatus.record(job_key, "Delete alyxraw"):
+            delete_update_entries.delete_entries_from_alyxraw(
+                [], modified_pks + deleted_pks
+            )
 
         logger.log(
             25,
             "Deleting modified and deleted entries from shadow membership tables ...",
         )
-        start = datetime.datetime.now()
-        delete_update_entries.delete_entries_from_membership(modified_pks + deleted_pks)
-        job.TaskStatus.insert_task_status(
-            job_key, "Delete shadow membership", start, end=datetime.datetime.now()
-        )
+        with job.TaskStatus.record(job_key, "Delete shadow membership"):
+            delete_update_entries.delete_entries_from_membership(
+                modified_pks + deleted_pks
+            )
 
     # ---- Step 5: ingestion of AlyxRaw, shadow tables and shadow membership tables ----
 
     logger.log(25, "Ingesting from Postgres Alyx to AlyxRaw...")
-    start = datetime.datetime.now()
-    ingest_alyx_raw_postgres.main(backtrack_days=3, skip_existing_alyxraw=True)
-    job.TaskStatus.insert_task_status(
-        job_key, "Ingest alyxraw", start, end=datetime.datetime.now()
-    )
+    with job.TaskStatus.record(job_key, "Ingest alyxraw"):
+        ingest_alyx_raw_postgres.main(backtrack_days=3, skip_existing_alyxraw=True)
 
     logger.log(25, "Ingesting into shadow tables...")
-    start = datetime.datetime.now()
-    ingest_shadow.main(modified_sessions_pks=modified_pks)
-    job.TaskStatus.insert_task_status(
-        job_key, "Ingest shadow", start, end=datetime.datetime.now()
-    )
+    with job.TaskStatus.record(job_key, "Ingest shadow"):
+        ingest_shadow.main(modified_sessions_pks=modified_pks)
 
     logger.log(25, "Ingesting into shadow membership tables...")
-    start = datetime.datetime.now()
-    ingest_membership.main()
-    job.TaskStatus.insert_task_status(
-        job_key, "Ingest shadow membership", start, end=datetime.datetime.now()
-    )
+    with job.TaskStatus.record(job_key, "Ingest shadow membership"):
+        ingest_membership.main()
 
     # ---- Step 6: ingestion of all real tables (copy from shadow tables) ----
 
     logger.log(25, "Ingesting the real tables...")
-    start = datetime.datetime.now()
-    ingest_real.main(excluded_tables=["DataSet", "FileRecord"])
-    job.TaskStatus.insert_task_status(
-        job_key, "Ingest real", start, end=datetime.datetime.now()
-    )
+    with job.TaskStatus.record(job_key, "Ingest real"):
+        ingest_real.main(excluded_tables=["DataSet", "FileRecord"], processes=processes)
 
     if perform_updates:
         logger.log(25, "Updating field...")
-        start = datetime.datetime.now()
-        delete_update_entries.update_entries_from_real_tables(modified_pks)
-        job.TaskStatus.insert_task_status(
-            job_key, "Update fields", start, end=datetime.datetime.now()
-        )
+        with job.TaskStatus.record(job_key, "Update fields"):
+            delete_update_entries.update_entries_from_real_tables(modified_pks)
 
     # ---- Step 7: populate behavior tables ----
 
     logger.log(25, "Populating behavior...")
-    start = datetime.datetime.now()
-    populate_behavior.main(backtrack_days=30)
-    job.TaskStatus.insert_task_status(
-        job_key, "Populate behavior", start, end=datetime.datetime.now()
-    )
+    with job.TaskStatus.record(job_key, "Populate behavior"):
+        populate_behavior.main(backtrack_days=30)
 
     """ General flow for updates only (similar to procedures in process_histology and process_qc)
     + create UpdateAlyxRaw from scratch
@@ -1,11 +1,14 @@
 import datetime
 import gc
+import hashlib
 import json
 import os
+import struct
+from uuid import UUID
 
 from ibl_pipeline.ingest import job
 from ibl_pipeline.process import get_important_pks, get_timezone
-from ibl_pipeline.utils import is_valid_uuid
+from ibl_pipeline.utils.json_dump import iter_json_array
 
 SESSION_FIELDS = [
     "location",
@@ -33,59 +36,147 @@ EXCLUDED_MODELS = {
 }
 
 
-def get_modified_pks(data0, data1):
-    d0 = {
-        _["pk"]: json.dumps(_["fields"], sort_keys=True)
-        for _ in data0
-        if _["model"] not in EXCLUDED_MODELS
-    }
-    d1 = {
-        _["pk"]: json.dumps(_["fields"], sort_keys=True)
-        for _ in data1
-        if _["model"] not in EXCLUDED_MODELS
-    }
-    d0 = {k: v for k, v in d0.items() if k in d1.keys()}
-    d1 = {k: v for k, v in d1.items() if k in d0.keys()}
+_DIGEST_MAGIC = b"ALYXDIG1"
+_DIGEST_SIZE = 16
+_NO_SESSION_DIGEST = bytes(_DIGEST_SIZE)
 
-    return [k for k in d0.keys() if d0[k] != d1[k] and is_valid_uuid(k)]
 
+def _digest(obj):
+    return hashlib.blake2b(
+        json.dumps(obj, sort_keys=True).encode(), digest_size=_DIGEST_SIZE
+    ).digest()
 
-def get_created_deleted_pks(data0, data1):
 
-    old_pks = {
-        _["pk"]
-        for _ in data0
-        if not isinstance(_["pk"], int) and _["model"] not in EXCLUDED_MODELS
-    }
-    new_pks = {
-        _["pk"]
-        for _ in data1
-        if not isinstance(_["pk"], int) and _["model"] not in EXCLUDED_MODELS
-    }
+def _dump_signature(dump):
+    stat = os.stat(dump)
+    return stat.st_size, int(stat.st_mtime)
 
-    return [pk for pk in sorted(new_pks - old_pks) if is_valid_uuid(pk)], [
-        pk for pk in sorted(old_pks - new_pks) if is_valid_uuid(pk)
-    ]
 
+class DumpDigest:
+    """
+    Compact summary of an alyx json dump used to compute the differences between dumps.
+    For each entry with a valid uuid pk (excluding EXCLUDED_MODELS), keep a 16-byte
+    digest of its fields, and for "actions.session" entries an additional digest
+    of the SESSION_FIELDS only.
+    """
 
-def filter_modified_keys_session(data0, data1, modified_pks):
+    def __init__(self, digests=None, session_digests=None, signature=None):
+        self.digests = digests or {}  # uuid bytes -> digest of all fields
+        self.session_digests = session_digests or {}  # uuid bytes -> digest
+        self.signature = signature  # (size, mtime) of the dump it was created from
+
+    @classmethod
+    def from_dump(cls, dump):
+        """Create the digest of a json dump in a single streaming pass
+
+        Args:
+            dump (str): filepath of alyx json dump
+        """
+        digests, session_digests = {}, {}
+        for entry in iter_json_array(dump):
+            if entry["model"] in EXCLUDED_MODELS or isinstance(entry["pk"], int):
+                continue
+            try:
+                pk = UUID(entry["pk"]).bytes
+            except (ValueError, AttributeError):
+                continue
+            fields = entry["fields"]
+            digests[pk] = _digest(fields)
+            if entry["model"] == "actions.session":
+                session_digests[pk] = _digest(
+                    {key: fields[key] for key in SESSION_FIELDS}
+                )
+
+        return cls(digests, session_digests, signature=_dump_signature(dump))
+
+    @classmethod
+    def load(cls, filepath):
+        """Load a digest saved with DumpDigest.save
+
+        Args:
+            filepath (str): filepath of the digest file
+        """
+        record_size = 16 + 2 * _DIGEST_SIZE
+        digests, session_digests = {}, {}
+        with open(filepath, "rb") as f:
+            if f.read(len(_DIGEST_MAGIC)) != _DIGEST_MAGIC:
+                raise ValueError(f"{filepath} is not a json dump digest file")
+            signature = struct.unpack("<qq", f.read(16))
+            while True:
+                chunk = f.read(record_size * 100000)
+                if not chunk:
+                    break
+                for i in range(0, len(chunk), record_size):
+                    pk = chunk[i : i + 16]
+                    digests[pk] = chunk[i + 16 : i + 16 + _DIGEST_SIZE]
+                    session_digest = chunk[i + 16 + _DIGEST_SIZE : i + record_size]
+                    if session_digest != _NO_SESSION_DIGEST:
+                        session_digests[pk] = session_digest
+
+        return cls(digests, session_digests, signature=signature)
+
+    @classmethod
+    def load_for_dump(cls, filepath, dump):
+        """Load the digest in filepath if it was created from dump, otherwise
+        create the digest by streaming dump.
+
+        Args:
+            filepath (str): filepath of the digest file
+            dump (str): filepath of alyx json dump
+        """
+        if filepath and os.path.exists(filepath):
+            digest = cls.load(filepath)
+            if digest.signature == _dump_signature(dump):
+                return digest
+        return cls.from_dump(dump)
+
+    def save(self, filepath):
+        """Save the digest to a binary file, fixed size records of
+        uuid (16 bytes), digest and session digest
+
+        Args:
+            filepath (str): filepath of the digest file
+        """
+        with open(filepath, "wb") as f:
+            f.write(_DIGEST_MAGIC)
+            f.write(struct.pack("<qq", *self.signature))
+            f.writelines(
+                pk + digest + self.session_digests.get(pk, _NO_SESSION_DIGEST)
+                for pk, digest in self.digests.items()
+            )
+
+
+def diff_dump_digests(digest0, digest1, filter_session_fields=True):
+    """Compute the created, deleted and modified pks between two dump digests
 
-    sessions0 = {
-        _["pk"]: json.dumps(
-            {key: _["fields"][key] for key in SESSION_FIELDS}, sort_keys=True
-        )
-        for _ in data0
-        if _["model"] == "actions.session"
-    }
-    sessions1 = {
-        _["pk"]: json.dumps(
-            {key: _["fields"][key] for key in SESSION_FIELDS}, sort_keys=True
-        )
-        for _ in data1
-        if _["model"] == "actions.session"
-    }
-    sessions_same = dict(sessions0.items() & sessions1.items()).keys()
-    return list(set(modified_pks) - set(sessions_same))
+    Args:
+        digest0 (DumpDigest): digest of the previous dump
+        digest1 (DumpDigest): digest of the latest dump
+        filter_session_fields (bool, optional): only keep modified sessions when there is a change in SESSION_FIELDS. Defaults to True.
+
+    Returns:
+        created_pks [list]: sorted list of uuid strings of newly created entries
+        deleted_pks [list]: sorted list of uuid strings of deleted entries
+        modified_pks [list]: sorted list of uuid strings of modified entries
+    """
+    d0, d1 = digest0.digests, digest1.digests
+
+    created_pks = [pk for pk in d1 if pk not in d0]
+    deleted_pks = [pk for pk in d0 if pk not in d1]
+    modified_pks = [pk for pk, digest in d1.items() if d0.get(pk, digest) != digest]
+
+    if filter_session_fields:
+        s0, s1 = digest0.session_digests, digest1.session_digests
+        modified_pks = [
+            pk
+            for pk in modified_pks
+            if pk not in s0 or pk not in s1 or s0[pk] != s1[pk]
+        ]
+
+    def to_str(pks):
+        return sorted(str(UUID(bytes=pk)) for pk in pks)
+
+    return to_str(created_pks), to_str(deleted_pks), to_str(modified_pks)
 
 
 # TODO: change /data /tmp to use dj.config
@@ -96,6 +187,7 @@ def compare_json_dumps(
     insert_to_table=True,
     filter_pks_for_unused_models=True,
     filter_pks_for_unused_session_fields=True,
+    digest_file="/data/alyxfull.digest",
 ):
 
     """Compare two json dumps from alyx and created files with the added, deleted, modified fields.
@@ -107,32 +199,27 @@ def compare_json_dumps(
         insert_to_table (bool, optional): whether to insert the result to DataJoint job table. Defaults to True.
         filter_pks_for_unused_models (bool, optional): filter modified pks in models of interest. Defaults to True.
         filter_pks_for_unused_session_fields (bool, optional): only keep the modified keys when there is a change in fields of interest. Defaults to True.
+        digest_file (filepath, optional): digest index of the json dump. If it was created from previous_dump, it is used instead of reading previous_dump again, and it is then overwritten with the digest of latest_dump. Set to None to disable. Defaults to /data/alyxfull.digest.
 
     """
 
-    print("Loading first JSON dump...")
-    with open(previous_dump, "r") as f:
-        data0 = json.load(f)
-    print("Loading second JSON dump...")
-    with open(latest_dump, "r") as f:
-        data1 = json.load(f)
-    print("Finished loading JSON dumps.")
+    print("Creating digest of the previous JSON dump...")
+    digest0 = DumpDigest.load_for_dump(digest_file, previous_dump)
+    print("Creating digest of the latest JSON dump...")
+    digest1 = DumpDigest.from_dump(latest_dump)
+    if digest_file:
+        digest1.save(digest_file)
 
     print("Computing differences...")
-    modified_pks = get_modified_pks(data0, data1)
-
-    print("Finished creating modified keys.")
-    print("Computing created and deleted_keys...")
-
-    created_pks, deleted_pks = get_created_deleted_pks(data0, data1)
-
-    print("Finished creating created_pks and deleted_pks.")
+    created_pks, deleted_pks, modified_pks = diff_dump_digests(
+        digest0,
+        digest1,
+        filter_session_fields=filter_pks_for_unused_session_fields,
+    )
+    del digest0, digest1
+    gc.collect()
 
-    if filter_pks_for_unused_session_fields:
-        print(
-            "Filtering modified sessions that does not have a change in fields of interest..."
-        )
-        modified_pks = filter_modified_keys_session(data0, data1, modified_pks)
+    print("Finished creating created_pks, deleted_pks and modified_pks.")
 
     if filter_pks_for_unused_models:
         print("Remove modified entries in tables data.filerecord and jobs.task")
@@ -12,7 +12,7 @@ from tqdm import tqdm
 
 from ibl_pipeline import mode, update
 from ibl_pipeline.common import *
-from ibl_pipeline.ingest import QueryBuffer, ingest_utils, job
+from ibl_pipeline.ingest import delete_cascade, ingest_utils, job
 from ibl_pipeline.ingest.common import *
 from ibl_pipeline.process import get_important_pks
 from ibl_pipeline.process.ingest_membership import MEMBERSHIP_TABLES
@@ -78,8 +78,7 @@ def delete_entries_from_alyxraw(file_record_keys=[], alyxraw_keys=[]):
                 & file_record_keys
             )
 
-        for key in tqdm(file_record_fields):
-            (alyxraw.AlyxRaw.Field & key).delete_quick()
+        delete_cascade(alyxraw.AlyxRaw.Field, file_record_fields.fetch("KEY"))
 
     if alyxraw_keys:
         logger.log(25, "Deleting modified entries...")
@@ -87,27 +86,18 @@ def delete_entries_from_alyxraw(file_record_keys=[], alyxraw_keys=[]):
         pk_list = [k for k in alyxraw_keys if is_valid_uuid(k["uuid"])]
 
         # Delete from alyxraw.AlyxRaw (except for entries related to the Session table)
-        alyxraw_buffer = QueryBuffer(alyxraw.AlyxRaw & 'model != "actions.session"')
-        for pk in tqdm(pk_list):
-            alyxraw_buffer.add_to_queue1(pk)
-            alyxraw_buffer.flush_delete(chunksz=50, quick=False)
-        alyxraw_buffer.flush_delete(quick=False)
+        delete_cascade(alyxraw.AlyxRaw & 'model != "actions.session"', pk_list)
 
         # Special handling to the AlyxRaw corresponding to the Session table
         #   i.e. the case where uuid is not changed but start time changed for 1 sec
         #   delete only entries in the AlyxRaw.Field, except for the "start time" field.
-
-        alyxraw_field_buffer = QueryBuffer(
+        delete_cascade(
             alyxraw.AlyxRaw.Field
             & 'fname!="start_time"'
-            & (alyxraw.AlyxRaw & 'model="actions.session"')
+            & (alyxraw.AlyxRaw & 'model="actions.session"'),
+            pk_list,
         )
 
-        for pk in tqdm(pk_list):
-            alyxraw_field_buffer.add_to_queue1(pk)
-            alyxraw_field_buffer.flush_delete(chunksz=50, quick=True)
-        alyxraw_field_buffer.flush_delete(quick=True)
-
 
 def delete_entries_from_membership(pks_to_be_deleted):
     """
@@ -194,17 +184,48 @@ TABLES_TO_UPDATE = [
 # =================================== functions for update ==========================================
 
 
+def _update_attribute(real_table, shadow_table, attr, keys):
+    """Copy the value of attr from the shadow table into the real table for keys,
+    with a single UPDATE ... JOIN
+
+    Returns:
+        int: number of updated entries
+    """
+    pk = real_table.primary_key
+    row = "(" + ", ".join(["%s"] * len(pk)) + ")"
+    sql = (
+        f"UPDATE {real_table.full_table_name} AS r "
+        f"JOIN {shadow_table.full_table_name} AS s "
+        f"USING ({', '.join(f'`{a}`' for a in pk)}) "
+        f"SET r.`{attr}` = s.`{attr}` "
+        f"WHERE ({', '.join(f'r.`{a}`' for a in pk)}) IN ({', '.join([row] * len(keys))})"
+    )
+    args = [
+        key[a].bytes if isinstance(key[a], UUID) else key[a] for key in keys for a in pk
+    ]
+    return real_table.connection.query(sql, args=args).rowcount
+
+
 def update_fields(
-    real_schema, shadow_schema, table_name, pks, log_to_UpdateRecord=False
+    real_schema,
+    shadow_schema,
+    table_name,
+    pks,
+    log_to_UpdateRecord=False,
+    chunksz=1000,
 ):
     """
     Given a table and the primary key of real table,
         update the real table all the fields that have discrepancy from the shadow table
+    For each chunk of keys, the real and shadow entries are fetched in one joined query,
+        each modified field is updated with one UPDATE ... JOIN statement
+        and the update records are inserted at once
     Inputs: real_schema     : real schema module, e.g. reference
             shadow_schema   : shadow schema module, e.g. reference_ingest
             table_name      : string, name of a table, e.g. Subject
             pks             : list of dictionaries, primary keys of real table that contains modification
             log_to_UpdateRecord : boolean, if True, log the update history in the table ibl_update.UpdateRecord
+            chunksz         : int, number of keys handled at a time, default 1000
     """
 
     if "." in table_name:
@@ -227,70 +248,95 @@ def update_fields(
         ts_field = None
         log_to_UpdateRecord = False
 
-    # do the updating
-    for key in (real_table & pks).fetch("KEY"):
-        pk_hash = UUID(dj.hash.key_hash(key))
+    full_table_name = real_table.__module__ + "." + real_table.__name__
+    shadow_fields = fields_to_update + ([ts_field] if ts_field else [])
+
+    keys = (real_table & pks).fetch("KEY")
+    for i in tqdm(range(0, len(keys), chunksz), position=0, leave=False):
+        chunk = keys[i : i + chunksz]
 
-        if not shadow_table & key:
-            real_record = (real_table & key).fetch1()
+        # records that do not exist in the shadow table
+        missing_records = ((real_table & chunk) - shadow_table.proj()).fetch(
+            as_dict=True
+        )
+        update_records, update_errors = [], []
+        for real_record in missing_records:
+            key = {k: real_record[k] for k in real_table.primary_key}
+            update_error_msg = "Record does not exist in the shadow {}".format(key)
+            logger.log(25, f"Error updating entry: {update_error_msg}")
             if log_to_UpdateRecord:
                 update_record = dict(
-                    table=real_table.__module__ + "." + real_table.__name__,
+                    table=full_table_name,
                     attribute="unknown",
-                    pk_hash=pk_hash,
+                    pk_hash=UUID(dj.hash.key_hash(key)),
                     original_ts=real_record[ts_field],
                     update_ts=datetime.datetime.now(),
-                    pk_dict=key,
                 )
-                update.UpdateRecord.insert1(update_record)
-                update_record.pop("pk_dict")
-
-                update_error_msg = "Record does not exist in the shadow {}".format(key)
-                update_record_error = dict(
-                    **update_record,
-                    update_action_ts=datetime.datetime.now(),
-                    update_error_msg=update_error_msg,
+                update_records.append(dict(**update_record, pk_dict=key))
+                update_errors.append(
+                    dict(
+                        **update_record,
+                        update_action_ts=datetime.datetime.now(),
+                        update_error_msg=update_error_msg,
+                    )
                 )
-                update.UpdateError.insert1(update_record_error)
+        if update_records:
+            update.UpdateRecord.insert(update_records, skip_duplicates=True)
+            update.UpdateError.insert(update_errors, skip_duplicates=True)
 
-            logger.log(25, f"Error updating entry: {update_error_msg}")
-            continue
-        # if there are more than 1 record
-        elif len(shadow_table & key) > 1:
-            # delete the older record
-            lastest_record = (
-                dj.U().aggr(shadow_table & key, session_ts="max(session_ts)").fetch()
-            )
-
-            with dj.config(safemode=False):
-                ((shadow_table & key) - lastest_record).delete()
-
-        shadow_record = (shadow_table & key).fetch1()
-        real_record = (real_table & key).fetch1()
-
-        for f in fields_to_update:
-            if real_record[f] != shadow_record[f]:
-                try:
-                    (real_table & key)._update(f, shadow_record[f])
-                    update_narrative = (
-                        f"{table_name}.{f}: {shadow_record[f]} != {real_record[f]}"
+        # if there are more than 1 record, delete the older records
+        duplicated_keys = (
+            (real_table & chunk).proj().aggr(shadow_table, n="count(*)") & "n > 1"
+        ).fetch("KEY")
+        if ts_field:
+            for key in duplicated_keys:
+                lastest_record = (
+                    dj.U().aggr(shadow_table & key, **{ts_field: f"max({ts_field})"})
+                ).fetch()
+                with dj.config(safemode=False):
+                    ((shadow_table & key) - lastest_record).delete()
+
+        # real and shadow values in one query
+        records = (
+            (real_table & chunk)
+            * shadow_table.proj(**{f"s_{f}": f for f in shadow_fields})
+        ).fetch(as_dict=True)
+
+        modified = {f: [] for f in fields_to_update}
+        for record in records:
+            for f in fields_to_update:
+                if record[f] != record[f"s_{f}"]:
+                    modified[f].append(record)
+
+        update_records = []
+        for f, modified_records in modified.items():
+            if not modified_records:
+                continue
+            modified_keys = [
+                {k: r[k] for k in real_table.primary_key} for r in modified_records
+            ]
+            try:
+                _update_attribute(real_table, shadow_table, f, modified_keys)
+            except BaseException as e:
+                logger.log(25, f"Error while updating {table_name}.{f}: {str(e)}")
+                continue
+            if log_to_UpdateRecord:
+                update_records.extend(
+                    dict(
+                        table=full_table_name,
+                        attribute=f,
+                        pk_hash=UUID(dj.hash.key_hash(key)),
+                        original_ts=r[ts_field],
+                        update_ts=r[f"s_{ts_field}"],
+                        pk_dict=key,
+                        original_value=r[f],
+                        updated_value=r[f"s_{f}"],
+                        update_narrative=f"{table_name}.{f}: {r[f's_{f}']} != {r[f]}",
                     )
-                except BaseException as e:
-                    logger.log(25, f"Error while updating record {key}: {str(e)}")
-                else:
-                    if log_to_UpdateRecord:
-                        update_record = dict(
-                            table=real_table.__module__ + "." + real_table.__name__,
-                            attribute=f,
-                            pk_hash=pk_hash,
-                            original_ts=real_record[ts_field],
-                            update_ts=shadow_record[ts_field],
-                            pk_dict=key,
-                            original_value=real_record[f],
-                            updated_value=shadow_record[f],
-                            update_narrative=update_narrative,
-                        )
-                        update.UpdateRecord.insert1(update_record)
+                    for key, r in zip(modified_keys, modified_records)
+                )
+        if update_records:
+            update.UpdateRecord.insert(update_records, skip_duplicates=True)
 
 
 def update_entries_from_real_tables(modified_pks):
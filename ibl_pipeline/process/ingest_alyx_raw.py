@@ -6,6 +6,7 @@ import collections
 import json
 import logging
 import math
+import multiprocessing
 import os.path as path
 import re
 import sys
@@ -15,166 +16,310 @@ import datajoint as dj
 import numpy as np
 from tqdm import tqdm
 
-from ibl_pipeline.ingest import QueryBuffer, alyxraw
+from ibl_pipeline.ingest import (
+    BulkLoadBuffer,
+    QueryBuffer,
+    alyxraw,
+    get_alyxraw_hashes,
+)
+from ibl_pipeline.utils.json_dump import iter_json_array
 
 logger = logging.getLogger(__name__)
 
 
-def get_alyx_entries(filename=None, models=None, exclude=None, new_pks=None):
-
-    exclude_list = {
-        "auth.group",
-        "sessions.session",
-        "authtoken.token",
-        "experiments.brainregion",
-        "misc.note",
-        "jobs.task",
-        "actions.notificationrule",
-        "actions.notification",
-    }
-    if exclude:
-        exclude_list = exclude_list.union(set(exclude))
+EXCLUDED_MODELS = {
+    "auth.group",
+    "sessions.session",
+    "authtoken.token",
+    "experiments.brainregion",
+    "misc.note",
+    "jobs.task",
+    "actions.notificationrule",
+    "actions.notification",
+}
+
+EMOJI_PATTERN = re.compile(
+    "["
+    "\U0001F600-\U0001F64F"  # emoticons
+    "\U0001F300-\U0001F5FF"  # symbols & pictographs
+    "\U0001F680-\U0001F6FF"  # transport & map symbols
+    "\U0001F1E0-\U0001F1FF"  # flags (iOS)
+    "\U00002702-\U000027B0"
+    "\U000024C2-\U0001F251"
+    "]+",
+    flags=re.UNICODE,
+)
+
+
+def iter_alyx_entries(filename=None, models=None, exclude=None, new_pks=None):
+    """Stream the entries of an alyx json dump, one record at a time
 
+    Args:
+        filename (str, optional): filename of alyx json dump. Defaults to /data/alyxfull.json.
+        models (str or list of str, optional): only yield entries of these alyx models.
+            If not specified, yield entries of all models except for the excluded ones.
+        exclude (list of str, optional): additional models to exclude when models is not specified.
+        new_pks (list of str, optional): only yield entries with these pks.
+
+    Yields:
+        dict: alyx entry with keys "model", "pk" and "fields"
+    """
     if not filename:
         filename = path.join("/", "data", "alyxfull.json")
 
-    with open(filename, "r") as fid:
-        keys_all = json.load(fid)
-
-    print("Creating entries to insert into alyxraw...")
     if not models:
-        if new_pks:
-            return [
-                key
-                for key in tqdm(keys_all)
-                if key["model"] not in exclude_list and key["pk"] in new_pks
-            ]
-        else:
-            return [key for key in keys_all if key["model"] not in exclude_list]
+        exclude_list = EXCLUDED_MODELS.union(exclude or [])
+
+        def is_selected(model):
+            return model not in exclude_list
+
     elif isinstance(models, str):
-        if new_pks:
-            return [
-                key
-                for key in keys_all
-                if key["model"] == models and key["pk"] in new_pks
-            ]
-        else:
-            return [key for key in keys_all if key["model"] == models]
-    elif isinstance(models, list):
-        if new_pks:
-            return [
-                key
-                for key in keys_all
-                if key["model"] in models and key["pk"] in new_pks
-            ]
-        else:
-            return [key for key in keys_all if key["model"] in models]
+
+        def is_selected(model):
+            return model == models
+
+    elif isinstance(models, (list, tuple, set, np.ndarray)):
+        models = set(models)
+
+        def is_selected(model):
+            return model in models
+
     else:
         raise ValueError("models should be a str, list or numpy array")
 
+    new_pks = set(new_pks) if new_pks else None
 
-def insert_to_alyxraw(keys, alyxraw_module=alyxraw, alyx_type="all"):
+    for key in iter_json_array(filename):
+        if is_selected(key["model"]) and (new_pks is None or key["pk"] in new_pks):
+            yield key
 
-    # use insert buffer to speed up the insertion process
-    if alyx_type in ("all", "main"):
-
-        ib_main = QueryBuffer(alyxraw_module.AlyxRaw)
-        # insert into AlyxRaw table
-        for key in tqdm(keys, position=0):
-            try:
-                pk = uuid.UUID(key["pk"])
-            except Exception:
-                print("Error for key: {}".format(key))
+
+def get_alyx_entries(filename=None, models=None, exclude=None, new_pks=None):
+    print("Creating entries to insert into alyxraw...")
+    return list(
+        iter_alyx_entries(
+            filename=filename, models=models, exclude=exclude, new_pks=new_pks
+        )
+    )
+
+
+def create_field_entries(pk, fields):
+    """Create the AlyxRaw.Field entries of one alyx entry
+
+    Args:
+        pk (uuid.UUID): uuid of the alyx entry
+        fields (dict): "fields" of the alyx entry in the json dump
+
+    Returns:
+        list: list of AlyxRaw.Field entries
+    """
+    field_entries = []
+    for field_name, field_value in fields.items():
+        key_field = dict(uuid=pk, fname=field_name, value_idx=0)
+
+        if field_name == "json" and field_value is not None:
+            key_field["fvalue"] = json.dumps(field_value)
+            if len(key_field["fvalue"]) >= 10000:
                 continue
+            field_entries.append(key_field)
+        elif field_name == "narrative" and field_value is not None:
+            key_field["fvalue"] = EMOJI_PATTERN.sub(r"", field_value)
+            field_entries.append(key_field)
+        elif (
+            field_value is None
+            or field_value == ""
+            or field_value == []
+            or (isinstance(field_value, float) and math.isnan(field_value))
+        ):
+            key_field["fvalue"] = "None"
+            field_entries.append(key_field)
+        elif type(field_value) is list and (
+            type(field_value[0]) is dict or type(field_value[0]) is str
+        ):
+            field_entries.extend(
+                dict(key_field, value_idx=value_idx, fvalue=str(value))
+                for value_idx, value in enumerate(field_value)
+            )
+        else:
+            key_field["fvalue"] = str(field_value)
+            field_entries.append(key_field)
 
-            ib_main.add_to_queue1(dict(uuid=pk, model=key["model"]))
-            if ib_main.flush_insert(skip_duplicates=True, chunksz=10000):
-                logger.debug("Inserted 10000 raw tuples.")
+    return field_entries
 
-        if ib_main.flush_insert(skip_duplicates=True):
-            logger.debug("Inserted remaining raw tuples")
-            ib_main = QueryBuffer(alyxraw_module.AlyxRaw)
 
-    if alyx_type in ("all", "part"):
+def _insert_keys(keys, alyxraw_module, alyx_type="all", chunksz=10000, bulk_load=False):
+    """Insert alyx entries with uuid pks into AlyxRaw and AlyxRaw.Field, master
+    entries are always flushed before the part entries that reference them.
+
+    Returns:
+        int: number of field entries inserted
+    """
+    # use insert buffer to speed up the insertion process
+    ib_main = QueryBuffer(alyxraw_module.AlyxRaw)
+    if bulk_load:
+        ib_part = BulkLoadBuffer(alyxraw_module.AlyxRaw.Field)
+    else:
         ib_part = QueryBuffer(alyxraw_module.AlyxRaw.Field)
-        # insert into the part table AlyxRaw.Field
-        for ikey, key in tqdm(enumerate(keys), position=0):
-            try:
-                try:
-                    pk = uuid.UUID(key["pk"])
-                except ValueError:
-                    print("Error for key: {}".format(key))
-                    continue
-
-                key_field = dict(uuid=uuid.UUID(key["pk"]))
-                for field_name, field_value in key["fields"].items():
-                    key_field = dict(key_field, fname=field_name)
-
-                    if field_name == "json" and field_value is not None:
-
-                        key_field["value_idx"] = 0
-                        key_field["fvalue"] = json.dumps(field_value)
-                        if len(key_field["fvalue"]) < 10000:
-                            ib_part.add_to_queue1(key_field)
-                        else:
-                            continue
-                    if field_name == "narrative" and field_value is not None:
-                        # filter out emoji
-                        emoji_pattern = re.compile(
-                            "["
-                            "\U0001F600-\U0001F64F"  # emoticons
-                            "\U0001F300-\U0001F5FF"  # symbols & pictographs
-                            "\U0001F680-\U0001F6FF"  # transport & map symbols
-                            "\U0001F1E0-\U0001F1FF"  # flags (iOS)
-                            "\U00002702-\U000027B0"
-                            "\U000024C2-\U0001F251"
-                            "]+",
-                            flags=re.UNICODE,
-                        )
-
-                        key_field["value_idx"] = 0
-                        key_field["fvalue"] = emoji_pattern.sub(r"", field_value)
-
-                    elif (
-                        field_value is None
-                        or field_value == ""
-                        or field_value == []
-                        or (isinstance(field_value, float) and math.isnan(field_value))
-                    ):
-                        key_field["value_idx"] = 0
-                        key_field["fvalue"] = "None"
-                        ib_part.add_to_queue1(key_field)
-
-                    elif type(field_value) is list and (
-                        type(field_value[0]) is dict or type(field_value[0]) is str
-                    ):
-                        for value_idx, value in enumerate(field_value):
-                            key_field["value_idx"] = value_idx
-                            key_field["fvalue"] = str(value)
-                            ib_part.add_to_queue1(key_field)
-                    else:
-                        key_field["value_idx"] = 0
-                        key_field["fvalue"] = str(field_value)
-                        ib_part.add_to_queue1(key_field)
-
-                    if ib_part.flush_insert(skip_duplicates=True, chunksz=10000):
-                        logger.debug("Inserted 10000 raw field tuples")
-
-            except Exception:
-                print("Problematic entry:{}".format(ikey))
-                raise
-
-        if ib_part.flush_insert(skip_duplicates=True):
-            logger.debug("Inserted all remaining raw field tuples")
-
-
-def insert_to_update_alyxraw(models, filename=None, delete_tables=False):
+    n_fields = 0
+
+    for ikey, (pk, key) in enumerate(keys):
+        try:
+            field_entries = create_field_entries(pk, key["fields"])
+        except Exception:
+            print("Problematic entry:{}".format(ikey))
+            raise
+
+        if alyx_type in ("all", "main"):
+            ib_main.add_to_queue1(
+                dict(
+                    uuid=pk,
+                    model=key["model"],
+                    **get_alyxraw_hashes(key["model"], field_entries),
+                )
+            )
+
+        if alyx_type in ("all", "part"):
+            ib_part.add_to_queue(field_entries)
+            n_fields += len(field_entries)
+
+        if len(ib_main._queue) >= chunksz or len(ib_part._queue) >= chunksz:
+            if ib_main.flush_insert(skip_duplicates=True):
+                logger.debug("Inserted raw tuples.")
+            if ib_part.flush_insert(skip_duplicates=True, chunksz=chunksz):
+                logger.debug("Inserted {} raw field tuples".format(chunksz))
+
+    if ib_main.flush_insert(skip_duplicates=True):
+        logger.debug("Inserted remaining raw tuples")
+    if ib_part.flush_insert(skip_duplicates=True):
+        logger.debug("Inserted all remaining raw field tuples")
+
+    return n_fields
+
+
+def _iter_uuid_keys(keys):
+    for key in keys:
+        try:
+            pk = uuid.UUID(key["pk"])
+        except Exception:
+            print("Error for key: {}".format(key))
+            continue
+        yield pk, key
+
+
+def _iter_shards(keys, shard_size):
+    """Group (uuid, key) pairs into shards of one model, sorted by uuid,
+    so that each shard covers a contiguous uuid range of a single model"""
+    buffers = collections.defaultdict(list)
+    for pk, key in keys:
+        buffer = buffers[key["model"]]
+        buffer.append((pk, key))
+        if len(buffer) >= shard_size:
+            yield sorted(buffer, key=lambda k: k[0])
+            buffer.clear()
+
+    for buffer in buffers.values():
+        if buffer:
+            yield sorted(buffer, key=lambda k: k[0])
+
+
+# alyxraw module and settings of the insertion worker processes
+_worker_settings = {}
+
+# shards submitted to the pool of insert_to_alyxraw at a time, per worker process
+_PENDING_SHARDS_PER_PROCESS = 2
+
+
+def _init_worker(alyxraw_module, alyx_type, chunksz, bulk_load):
+    # forked workers must not share the database connection of the parent process
+    alyxraw_module.AlyxRaw.connection.connect()
+    _worker_settings.update(
+        alyxraw_module=alyxraw_module,
+        alyx_type=alyx_type,
+        chunksz=chunksz,
+        bulk_load=bulk_load,
+    )
+
+
+def _insert_shard(shard):
+    n_fields = _insert_keys(shard, **_worker_settings)
+    return shard[0][1]["model"], shard[0][0], shard[-1][0], len(shard), n_fields
+
+
+def insert_to_alyxraw(
+    keys,
+    alyxraw_module=alyxraw,
+    alyx_type="all",
+    chunksz=10000,
+    processes=None,
+    shard_size=5000,
+    bulk_load=False,
+):
+    """Insert alyx entries into AlyxRaw and AlyxRaw.Field in a single pass over keys
+
+    Args:
+        keys (iterable of dict): alyx entries, e.g. a list from get_alyx_entries or
+            the generator iter_alyx_entries
+        alyxraw_module (datajoint module, optional): module containing the AlyxRaw tables. Defaults to alyxraw.
+        alyx_type (str, optional): "all", "main" (AlyxRaw only) or "part" (AlyxRaw.Field only). Defaults to "all".
+        chunksz (int, optional): number of tuples inserted at a time. Defaults to 10000.
+        processes (int, optional): number of worker processes. If larger than 1, entries are
+            grouped into shards of a single model and contiguous uuid range, and the shards
+            are inserted in parallel, each worker with its own database connection.
+            Defaults to None, inserting in the current process.
+        shard_size (int, optional): number of alyx entries per shard. Defaults to 5000.
+        bulk_load (bool, optional): if True, load the AlyxRaw.Field entries with
+            LOAD DATA LOCAL INFILE through a BulkLoadBuffer. Defaults to False.
+    """
+    keys = _iter_uuid_keys(keys)
+
+    if not processes or processes < 2:
+        _insert_keys(
+            tqdm(keys, position=0),
+            alyxraw_module,
+            alyx_type=alyx_type,
+            chunksz=chunksz,
+            bulk_load=bulk_load,
+        )
+        return
+
+    # fork so that the workers inherit alyxraw_module, only the shards are pickled
+    ctx = multiprocessing.get_context("fork")
+    with ctx.Pool(
+        processes,
+        initializer=_init_worker,
+        initargs=(alyxraw_module, alyx_type, chunksz, bulk_load),
+    ) as pool:
+        progress = tqdm(unit="entries", position=0)
+        # bounded number of shards submitted at a time, so that the dump is read
+        # no faster than the shards are inserted
+        pending = collections.deque()
+        for shard in _iter_shards(keys, shard_size):
+            if len(pending) >= _PENDING_SHARDS_PER_PROCESS * processes:
+                _log_shard(progress, *pending.popleft().get())
+            pending.append(pool.apply_async(_insert_shard, (shard,)))
+        while pending:
+            _log_shard(progress, *pending.popleft().get())
+        progress.close()
+
+
+def _log_shard(progress, model, first_uuid, last_uuid, n_keys, n_fields):
+    progress.update(n_keys)
+    logger.debug(
+        f"Inserted shard of {model} [{first_uuid} - {last_uuid}]: "
+        f"{n_keys} entries, {n_fields} field entries"
+    )
+
+
+def insert_to_update_alyxraw(
+    models, filename=None, delete_tables=False, processes=None
+):
     """Ingest data to alyxraw datajoint tables, json dump based
 
     Args:
         models (str or list of str): alyx model names, str or a list of str.
         filename (str, optional): filename of alyx json dump. Defaults to None.
         delete_tables (bool, optional): whether to delete the update module alyx raw tables first. Defaults to False.
+        processes (int, optional): number of worker processes used by insert_to_alyxraw. Defaults to None.
     """
 
     alyxraw_update = dj.create_virtual_module(
@@ -190,8 +335,9 @@ def insert_to_update_alyxraw(models, filename=None, delete_tables=False):
             alyxraw_update.AlyxRaw.delete_quick()
 
     insert_to_alyxraw(
-        get_alyx_entries(filename=filename, models=models),
+        iter_alyx_entries(filename=filename, models=models),
         alyxraw_module=alyxraw_update,
+        processes=processes,
     )
 
 
@@ -208,4 +354,4 @@ if __name__ == "__main__":
     with open(new_pks_file, "r") as fid:
         new_pks = json.load(fid)
 
-    insert_to_alyxraw(get_alyx_entries(filename, new_pks=new_pks))
+    insert_to_alyxraw(iter_alyx_entries(filename, new_pks=new_pks))
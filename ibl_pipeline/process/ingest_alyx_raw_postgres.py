@@ -1,21 +1,31 @@
 """
 This script loads the data from alyx postgres database and insert the entries into the alyxraw table.
 """
+import collections
 import datetime
+import functools
 import json
 import logging
 import math
 import os
 import pathlib
-import re
+import time
+import uuid
 import warnings
 
 import datajoint as dj
 import django
 import numpy as np
+from django.db.models import Max
 from tqdm import tqdm
 
-from ibl_pipeline.ingest import QueryBuffer, alyxraw
+from ibl_pipeline.ingest import (
+    BulkLoadBuffer,
+    QueryBuffer,
+    alyxraw,
+    get_alyxraw_hashes,
+)
+from ibl_pipeline.process.ingest_alyx_raw import EMOJI_PATTERN
 
 django.setup()
 
@@ -48,9 +58,6 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-# Currently I'm not aware of a way to get all ManyToMany fields in a django model,
-# so have to pre-know the ManyToMany field names
-
 # TODO: for public database, there are some tables that do not get released
 # for a list, check the internal v.s. shared modules
 
@@ -103,6 +110,44 @@ ALYX_MODELS_OF_INTEREST = (
 )
 
 
+AlyxModelSchema = collections.namedtuple(
+    "AlyxModelSchema",
+    ["model_name", "field_names", "many_to_many_field_names", "has_auto_datetime"],
+)
+
+
+@functools.lru_cache(maxsize=None)
+def get_model_schema(alyx_model):
+    """Get the field names of an alyx model from its django _meta options,
+    computed once per process and model
+
+    Args:
+        alyx_model (django.model object): alyx model
+
+    Returns:
+        [AlyxModelSchema]: model_name, field_names, many_to_many_field_names and has_auto_datetime
+    """
+    field_names = tuple(field.name for field in alyx_model._meta.fields)
+
+    # forward ManyToMany fields, and reverse ManyToMany relations with a related_name
+    many_to_many_field_names = [
+        field.name for field in alyx_model._meta.many_to_many
+    ] + [
+        rel.get_accessor_name()
+        for rel in alyx_model._meta.related_objects
+        if rel.many_to_many
+        and rel.get_accessor_name()
+        and not rel.get_accessor_name().endswith("_set")
+    ]
+
+    return AlyxModelSchema(
+        model_name=alyx_model._meta.db_table.replace("_", "."),
+        field_names=field_names,
+        many_to_many_field_names=tuple(many_to_many_field_names),
+        has_auto_datetime="auto_datetime" in field_names,
+    )
+
+
 def get_alyx_model_name(alyx_model):
     """get alyx model name ("model" field in alyxraw.AlyxRaw) from an alyx model object
 
@@ -112,7 +157,7 @@ def get_alyx_model_name(alyx_model):
     Returns:
         [str]: "model" field in alyxraw.AlyxRaw, e.g. misc.lab
     """
-    return alyx_model._meta.db_table.replace("_", ".")
+    return get_model_schema(alyx_model).model_name
 
 
 def get_field_names(alyx_model):
@@ -124,11 +169,11 @@ def get_field_names(alyx_model):
     Returns:
         [list]: list of field names (property name), including foreign key references, not ManyToMany fields
     """
-    return [field.name for field in alyx_model._meta.fields]
+    return list(get_model_schema(alyx_model).field_names)
 
 
 def get_many_to_many_field_names(alyx_model):
-    """Get all ManyToMany field names of an alyx modelinclude
+    """Get all ManyToMany field names of an alyx model
 
     Args:
         alyx_model (django.model object): alyx model
@@ -136,21 +181,7 @@ def get_many_to_many_field_names(alyx_model):
     Returns:
         [list]: list of ManyToMany field names (property name), including foreign key references
     """
-    one_entry = next(alyx_model.objects.iterator())
-    many_to_many_field_names = []
-    for field_name in dir(one_entry):
-        try:
-            obj = getattr(one_entry, field_name)
-        except:
-            pass
-        else:
-            if (
-                obj.__class__.__name__ == "ManyRelatedManager"
-                and not field_name.endswith("_set")
-            ):
-                many_to_many_field_names.append(field_name)
-
-    return many_to_many_field_names
+    return list(get_model_schema(alyx_model).many_to_many_field_names)
 
 
 def get_tables_with_auto_datetime(tables=None):
@@ -158,7 +189,10 @@ def get_tables_with_auto_datetime(tables=None):
     if tables is None:
         tables = ALYX_MODELS_OF_INTEREST
 
-    return [t for t in tables if "auto_datetime" in get_field_names(t)]
+    return [t for t in tables if get_model_schema(t).has_auto_datetime]
+
+
+TABLES_WITH_AUTO_DATETIME = set(get_tables_with_auto_datetime())
 
 
 def insert_alyx_entries_model(
@@ -166,6 +200,10 @@ def insert_alyx_entries_model(
     AlyxRawTable=alyxraw.AlyxRaw,
     backtrack_days=None,
     skip_existing_alyxraw=False,
+    bulk_load=False,
+    chunk_size=2000,
+    keepalive_interval=60,
+    incremental=False,
 ):
     """Insert alyx entries into alyxraw tables for a particular alyx model
 
@@ -176,10 +214,21 @@ def insert_alyx_entries_model(
             just applicable to tables with auto_datetime field
         skip_existing_alyxraw: if True, skip over the entries already existed in the AlyxRaw table,
             else, load and insert everything again (but still with `skip_duplicates=True`)
+        bulk_load: if True, load the AlyxRaw.Field entries with LOAD DATA LOCAL INFILE
+            through a BulkLoadBuffer, the AlyxRaw entries are then committed before
+            their fields are loaded instead of both being inserted in one transaction
+        chunk_size (int, optional): number of entries fetched at a time from the postgres
+            server-side cursor, ManyToMany fields are fetched per chunk. Defaults to 2000.
+        keepalive_interval (float, optional): seconds between pings that keep the
+            datajoint connection alive while reading from postgres. Defaults to 60.
+        incremental (bool, optional): if True, for models with auto_datetime (and FileRecord),
+            only read the entries modified after the watermark recorded in
+            alyxraw.AlyxRawWatermark by the previous run, and record the new watermark.
+            backtrack_days applies when there is no watermark yet. Defaults to False.
     """
-    model_name = get_alyx_model_name(alyx_model)
-    field_names = get_field_names(alyx_model)
-    many_to_many_field_names = get_many_to_many_field_names(alyx_model)
+    model_schema = get_model_schema(alyx_model)
+    model_name = model_schema.model_name
+    many_to_many_field_names = model_schema.many_to_many_field_names
 
     if model_name == "actions.session":
         backtrack_days = backtrack_days or 30
@@ -191,7 +240,7 @@ def insert_alyx_entries_model(
             datetime.datetime.now().date() - datetime.timedelta(days=backtrack_days)
         ).strftime("%Y-%m-%d")
 
-        if alyx_model in get_tables_with_auto_datetime():
+        if alyx_model in TABLES_WITH_AUTO_DATETIME:
             # actions.models.Session, data.models.Dataset, experiments.models.ProbeInsertion
             entries = alyx_model.objects.filter(auto_datetime__date__gte=date_cutoff)
         elif alyx_model == data.models.FileRecord:
@@ -206,137 +255,294 @@ def insert_alyx_entries_model(
     else:
         entries = alyx_model.objects.all()
 
+    watermark_field = _get_watermark_field(alyx_model)
+    if incremental and watermark_field:
+        watermark_key = {"alyxraw_table": AlyxRawTable.__name__, "model": model_name}
+        watermark_query = alyxraw.AlyxRawWatermark & watermark_key
+        if watermark_query:
+            # only the entries created or modified since the last ingestion
+            watermark = watermark_query.fetch1("watermark")
+            if django.conf.settings.USE_TZ:
+                watermark = watermark.replace(tzinfo=datetime.timezone.utc)
+            entries = alyx_model.objects.filter(**{f"{watermark_field}__gt": watermark})
+            if alyx_model == data.models.FileRecord:
+                entries = entries.filter(exists=True)
+        # taken before reading the entries, later modifications are picked up next time
+        new_watermark = entries.aggregate(watermark=Max(watermark_field))["watermark"]
+
     # Ingest into main table
     if skip_existing_alyxraw:
-        existing_uuids = (AlyxRawTable & {"model": model_name}).fetch("uuid")
-        new_uuids = np.setxor1d(
-            list(entries.values_list("id", flat=True)),
-            existing_uuids,
-            assume_unique=True,
-        )
-    else:
-        new_uuids = entries.values_list("id", flat=True)
-
-    # convert to dict to make use of indexing for speed
-    new_uuids = {eid: None for eid in new_uuids}
-
-    if not new_uuids:
+        # diff on sorted arrays of 16-byte uuids instead of lists of uuid objects
+        existing_uuids = _get_alyxraw_uuids(AlyxRawTable, model_name)
+        entry_uuids = _pack_uuids(entries.values_list("id", flat=True).iterator())
+        new_uuids = np.setdiff1d(entry_uuids, existing_uuids, assume_unique=True)
+        del existing_uuids, entry_uuids
+        if not len(new_uuids):
+            if incremental and watermark_field:
+                _set_alyxraw_watermark(watermark_key, new_watermark)
+            return
+        new_uuids = {_unpack_uuid(u) for u in new_uuids}
+    elif not entries.exists():
         return
+    else:
+        new_uuids = None
 
     # using QueryBuffer, ingest into table AlyxRaw
     alyxraw_buffer = QueryBuffer(AlyxRawTable & {"model": model_name}, verbose=False)
     # using QueryBuffer, ingest into part table AlyxRaw.Field
-    alyxraw_field_buffer = QueryBuffer(AlyxRawTable.Field, verbose=True)
+    if bulk_load:
+        alyxraw_field_buffer = BulkLoadBuffer(AlyxRawTable.Field, verbose=True)
+    else:
+        alyxraw_field_buffer = QueryBuffer(AlyxRawTable.Field, verbose=True)
     # cancel on-going transaction, if any
     AlyxRawTable.connection.cancel_transaction()
 
-    # ingest fields and single foreign key references in alyxraw.AlyxRaw.Field
-    for r in tqdm(entries):
-        if r.id not in new_uuids:
+    # fetch plain values with a server-side cursor instead of model instances,
+    # foreign keys are fetched as ids (attname) without querying the related table
+    fields = [field for field in alyx_model._meta.fields if field.name != "id"]
+    attnames = [field.attname for field in fields]
+    # watermark values of the entries that failed, the watermark is kept below them
+    track_watermark = incremental and watermark_field
+    if track_watermark and watermark_field not in attnames:
+        attnames.append(watermark_field)
+    failed_watermarks = []
+    rows = entries.values("id", *attnames).iterator(chunk_size=chunk_size)
+
+    last_ping = time.time()
+    for chunk in _iter_chunks(tqdm(rows), chunk_size):
+        if new_uuids is not None:
+            chunk = [row for row in chunk if row["id"] in new_uuids]
+        if not chunk:
             continue
 
-        alyxraw_buffer.add_to_queue1({"uuid": r.id, "model": model_name})
-        # e.g. for table subjects.models.Subject, each r is a subject queryset
-        # for one subject
-        try:
-            field_entries = []
-            for field_name in field_names:
-                if field_name == "id":
-                    continue
+        # ManyToMany values of the whole chunk, one query per field
+        many_to_many_values = _get_many_to_many_values(
+            alyx_model, many_to_many_field_names, [row["id"] for row in chunk]
+        )
 
-                field_entry = {"uuid": r.id, "fname": field_name}
-                field_value = getattr(r, field_name)
-
-                if field_name == "json" and field_value:
-                    # handles the 'json' field - store the json dump
-                    field_entry["value_idx"] = 0
-                    field_entry["fvalue"] = json.dumps(field_value)
-                    if len(field_entry["fvalue"]) >= 10000:
-                        # if the json dump is too large, store fvalue as null
-                        field_entry.pop("fvalue")
-                elif field_name == "narrative" and field_value is not None:
-                    # handles 'narrative' field with emoji - filter out emoji
-                    emoji_pattern = re.compile(
-                        "["
-                        "\U0001F600-\U0001F64F"  # emoticons
-                        "\U0001F300-\U0001F5FF"  # symbols & pictographs
-                        "\U0001F680-\U0001F6FF"  # transport & map symbols
-                        "\U0001F1E0-\U0001F1FF"  # flags (iOS)
-                        "\U00002702-\U000027B0"
-                        "\U000024C2-\U0001F251"
-                        "]+",
-                        flags=re.UNICODE,
+        for row in chunk:
+            hashes = {}
+            try:
+                field_entries = [
+                    _create_field_entry(
+                        row["id"], field.name, row[field.attname], field.is_relation
                     )
-
-                    field_entry["value_idx"] = 0
-                    field_entry["fvalue"] = emoji_pattern.sub(r"", field_value)
-                elif (
-                    not isinstance(field_value, (float, int)) and not field_value
-                ) or (
-                    isinstance(field_value, (float, int)) and math.isnan(field_value)
-                ):
-                    # handle "falsy" field value - store as string 'None'
-                    field_entry["value_idx"] = 0
-                    field_entry["fvalue"] = "None"
-                elif isinstance(field_value, str):
-                    field_entry["value_idx"] = 0
-                    field_entry["fvalue"] = field_value
-                elif isinstance(
-                    field_value, (bool, float, int, datetime.datetime, datetime.date)
-                ):
-                    field_entry["value_idx"] = 0
-                    field_entry["fvalue"] = str(field_value)
-                elif isinstance(field_value, dict):
-                    field_entry["value_idx"] = 0
-                    field_entry["fvalue"] = json.dumps(field_value, default=str)
-                else:
-                    # special handling for foreign key object
-                    field_entry["value_idx"] = 0
-                    fk_id = field_name + "_id"
-                    if hasattr(r, fk_id):
-                        field_entry["fvalue"] = str(getattr(r, fk_id))
-
-                field_entries.append(field_entry)
-            # ingest many to many fields into alyxraw.AlyxRaw.Field
-            for field_name in many_to_many_field_names:
-                many_to_many_entries = getattr(r, field_name).all()
-                if len(many_to_many_entries) > 200:
-                    print(
-                        f"\tmany-to-many field {field_name} with {len(many_to_many_entries)} entries - skipping..."
+                    for field in fields
+                ]
+                # ingest many to many fields into alyxraw.AlyxRaw.Field
+                for field_name in many_to_many_field_names:
+                    related_ids = many_to_many_values[field_name].get(row["id"], [])
+                    if len(related_ids) > 200:
+                        print(
+                            f"\tmany-to-many field {field_name} with {len(related_ids)} entries - skipping..."
+                        )
+                        continue
+                    field_entries.extend(
+                        [
+                            dict(
+                                uuid=row["id"],
+                                fname=field_name,
+                                value_idx=obj_idx,
+                                fvalue=str(related_id),
+                            )
+                            for obj_idx, related_id in enumerate(related_ids)
+                        ]
                     )
+
+                hashes = get_alyxraw_hashes(model_name, field_entries)
+                alyxraw_field_buffer.add_to_queue(field_entries)
+                del field_entries  # to be cleaned by garbage collector, improve memory management
+
+            except Exception as e:
+                logger.log(
+                    25,
+                    "Problematic entry {} of model {} with error {}".format(
+                        row["id"], model_name, str(e)
+                    ),
+                )
+                if track_watermark:
+                    # read again by the next run, as a new entry
+                    if row[watermark_field] is not None:
+                        failed_watermarks.append(row[watermark_field])
                     continue
-                field_entries.extend(
-                    [
-                        dict(
-                            uuid=r.id,
-                            fname=field_name,
-                            value_idx=obj_idx,
-                            fvalue=str(obj.id),
-                        )
-                        for obj_idx, obj in enumerate(many_to_many_entries)
-                    ]
+
+            # entries without hashes are compared field by field in get_modified_alyxraw
+            alyxraw_buffer.add_to_queue1(
+                {"uuid": row["id"], "model": model_name, **hashes}
+            )
+
+            if len(alyxraw_field_buffer._queue) >= 7500:
+                _flush_alyxraw_buffers(
+                    alyxraw_buffer, alyxraw_field_buffer, bulk_load, chunksz=7500
                 )
+                last_ping = time.time()
+
+        # keep the mysql connection alive while reading from postgres
+        if time.time() - last_ping > keepalive_interval:
+            AlyxRawTable.connection.ping()
+            last_ping = time.time()
 
-            alyxraw_field_buffer.add_to_queue(field_entries)
-            dj.conn().ping()
-            del field_entries  # to be cleaned by garbage collector, improve memory management
+    _flush_alyxraw_buffers(alyxraw_buffer, alyxraw_field_buffer, bulk_load)
 
-        except Exception as e:
-            logger.log(
-                25,
-                "Problematic entry {} of model {} with error {}".format(
-                    r.id, model_name, str(e)
-                ),
+    if track_watermark:
+        if failed_watermarks and new_watermark is not None:
+            new_watermark = min(
+                new_watermark,
+                min(failed_watermarks) - datetime.timedelta(microseconds=1),
             )
+        _set_alyxraw_watermark(watermark_key, new_watermark)
+
+
+def _set_alyxraw_watermark(watermark_key, watermark):
+    """Record the watermark of an alyx model in AlyxRawWatermark, as naive UTC"""
+    if watermark is None:
+        return
+    if watermark.tzinfo is not None:
+        watermark = watermark.astimezone(datetime.timezone.utc)
+    alyxraw.AlyxRawWatermark.insert1(
+        {**watermark_key, "watermark": watermark.replace(tzinfo=None)},
+        replace=True,
+    )
+
+
+def _get_watermark_field(alyx_model):
+    """Get the lookup of the modification time used as watermark of an alyx model,
+    None if the model has no modification time"""
+    if get_model_schema(alyx_model).has_auto_datetime:
+        return "auto_datetime"
+    elif alyx_model == data.models.FileRecord:
+        return "dataset__auto_datetime"
+
+
+def _pack_uuids(uuids):
+    """Pack uuid objects into a sorted numpy array of 16-byte strings"""
+    return np.unique(np.frombuffer(b"".join(u.bytes for u in uuids), dtype="S16"))
+
 
-        if len(alyxraw_field_buffer._queue) >= 7500:
-            with AlyxRawTable.connection.transaction:
-                alyxraw_buffer.flush_insert(skip_duplicates=True)
-                alyxraw_field_buffer.flush_insert(skip_duplicates=True, chunksz=7500)
+def _unpack_uuid(packed_uuid):
+    # numpy strips trailing null bytes of fixed-size byte strings
+    return uuid.UUID(bytes=packed_uuid.ljust(16, b"\0"))
 
-    with AlyxRawTable.connection.transaction:
+
+def _get_alyxraw_uuids(AlyxRawTable, model_name):
+    """Fetch the uuids of a model in an AlyxRaw table as a sorted numpy array of
+    16-byte strings, without converting them to uuid objects"""
+    cursor = AlyxRawTable.connection.query(
+        f"SELECT uuid FROM {AlyxRawTable.full_table_name} WHERE model = %s",
+        args=(model_name,),
+    )
+    return np.unique(np.frombuffer(b"".join(row[0] for row in cursor), dtype="S16"))
+
+
+def _iter_chunks(iterable, chunk_size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _get_many_to_many_values(alyx_model, many_to_many_field_names, uuids):
+    """Get the ids of the related objects of ManyToMany fields for a chunk of entries,
+    with one query per field on the intermediate table. Related ids are ordered as
+    returned by the related manager, i.e. by the ordering of the related model.
+
+    Args:
+        alyx_model (django.model object): alyx model
+        many_to_many_field_names (list): ManyToMany field names (property name)
+        uuids (list): ids of the entries
+
+    Returns:
+        [dict]: {field_name: {uuid: [related ids]}}
+    """
+    values = {}
+    for field_name in many_to_many_field_names:
+        field = alyx_model._meta.get_field(field_name)
+        if field.auto_created:
+            # reverse relation of a ManyToMany field defined on the related model
+            through = field.through
+            source = field.field.m2m_reverse_field_name()
+            target = field.field.m2m_field_name()
+        else:
+            through = field.remote_field.through
+            source = field.m2m_field_name()
+            target = field.m2m_reverse_field_name()
+
+        ordering = [
+            f"-{target}__{o[1:]}" if o.startswith("-") else f"{target}__{o}"
+            for o in field.related_model._meta.ordering
+        ] or ["pk"]
+
+        related_ids = collections.defaultdict(list)
+        for source_id, target_id in (
+            through.objects.filter(**{f"{source}__in": uuids})
+            .order_by(*ordering)
+            .values_list(
+                through._meta.get_field(source).attname,
+                through._meta.get_field(target).attname,
+            )
+        ):
+            related_ids[source_id].append(target_id)
+        values[field_name] = related_ids
+
+    return values
+
+
+def _create_field_entry(uuid, field_name, field_value, is_relation=False):
+    """Create an AlyxRaw.Field entry from the value of a field
+
+    Args:
+        uuid (uuid.UUID): id of the alyx entry
+        field_name (str): field name (property name)
+        field_value: value of the field, the id of the related object for a foreign key
+        is_relation (bool, optional): whether the field is a foreign key. Defaults to False.
+
+    Returns:
+        [dict]: AlyxRaw.Field entry
+    """
+    field_entry = {"uuid": uuid, "fname": field_name, "value_idx": 0}
+
+    if is_relation:
+        # foreign key - store the id of the related object
+        field_entry["fvalue"] = "None" if field_value is None else str(field_value)
+    elif field_name == "json" and field_value:
+        # handles the 'json' field - store the json dump
+        field_entry["fvalue"] = json.dumps(field_value)
+        if len(field_entry["fvalue"]) >= 10000:
+            # if the json dump is too large, store fvalue as null
+            field_entry.pop("fvalue")
+    elif field_name == "narrative" and field_value is not None:
+        # handles 'narrative' field with emoji - filter out emoji
+        field_entry["fvalue"] = EMOJI_PATTERN.sub(r"", field_value)
+    elif (not isinstance(field_value, (float, int)) and not field_value) or (
+        isinstance(field_value, (float, int)) and math.isnan(field_value)
+    ):
+        # handle "falsy" field value - store as string 'None'
+        field_entry["fvalue"] = "None"
+    elif isinstance(field_value, str):
+        field_entry["fvalue"] = field_value
+    elif isinstance(field_value, (bool, float, int, datetime.datetime, datetime.date)):
+        field_entry["fvalue"] = str(field_value)
+    elif isinstance(field_value, dict):
+        field_entry["fvalue"] = json.dumps(field_value, default=str)
+
+    return field_entry
+
+
+def _flush_alyxraw_buffers(
+    alyxraw_buffer, alyxraw_field_buffer, bulk_load, chunksz=None
+):
+    if bulk_load:
+        # bulk load uses its own connection, AlyxRaw entries are committed first
         alyxraw_buffer.flush_insert(skip_duplicates=True)
-        alyxraw_field_buffer.flush_insert(skip_duplicates=True)
+        alyxraw_field_buffer.flush_insert(skip_duplicates=True, chunksz=chunksz)
+    else:
+        with alyxraw_buffer._rel.connection.transaction:
+            alyxraw_buffer.flush_insert(skip_duplicates=True)
+            alyxraw_field_buffer.flush_insert(skip_duplicates=True, chunksz=chunksz)
 
 
 def insert_to_update_alyxraw_postgres(
@@ -378,7 +584,9 @@ def insert_to_update_alyxraw_postgres(
         )
 
 
-def main(backtrack_days=3, skip_existing_alyxraw=False):
+def main(
+    backtrack_days=3, skip_existing_alyxraw=False, bulk_load=False, incremental=False
+):
     for alyx_model in ALYX_MODELS_OF_INTEREST:
         logger.log(
             25,
@@ -393,6 +601,8 @@ def main(backtrack_days=3, skip_existing_alyxraw=False):
             AlyxRawTable=alyxraw.AlyxRaw,
             backtrack_days=backtrack_days,
             skip_existing_alyxraw=skip_existing_alyxraw,
+            bulk_load=bulk_load,
+            incremental=incremental,
         )
 
 
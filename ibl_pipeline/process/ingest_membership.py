@@ -3,15 +3,13 @@ This script inserts membership tuples into the membership shadow tables, \
 which cannot be inserted with auto-population.
 """
 
-import itertools
+import contextlib
 import os
 
-import datajoint as dj
-import pymysql
 from tqdm import tqdm
 
 from ibl_pipeline import mode
-from ibl_pipeline.ingest import QueryBuffer, acquisition, action, alyxraw, data
+from ibl_pipeline.ingest import acquisition, action, alyxraw, data
 from ibl_pipeline.ingest import get_raw_field as grf
 from ibl_pipeline.ingest import reference, subject
 from ibl_pipeline.utils import is_valid_uuid
@@ -192,11 +190,15 @@ def ingest_membership_table(
     dj_other_uuid_name,
     renamed_other_field_name=None,
     new_pks=None,
+    chunksz=5000,
 ):
     """
     Ingest shadow membership table.
     This function works for the pattern that an alyx parent model contain one or multiple entries of one field
     that have the information in the membership table.
+    The parent and other tables are first copied into temporary tables indexed by their uuid, then the membership
+    entries are inserted server side with one INSERT ... SELECT per chunk of parent uuids, joining AlyxRaw.Field
+    on these indexes.
 
     Arguments:  dj_current_table : datajoint table object, current membership table to ingest
                 alyx_parent_model: string, model name inside alyx that contains information of the current table.
@@ -211,6 +213,7 @@ def ingest_membership_table(
                                         the default is None if the field is not renamed
                 new_pks          : list of strings of valid uuids, this is the new entries to process, the
                                 default is None if all entries are inserted.
+                chunksz          : int, number of parent uuids per INSERT ... SELECT, default 5000
     """
     if new_pks:
         restr = [{"uuid": pk} for pk in new_pks if is_valid_uuid(pk)]
@@ -219,70 +222,76 @@ def ingest_membership_table(
 
     alyxraw_to_insert = alyxraw.AlyxRaw & restr & {"model": alyx_parent_model}
 
-    if not alyxraw_to_insert:
+    # sorted, so that each chunk covers a contiguous range of the AlyxRaw.Field index
+    parent_uuids = alyxraw_to_insert.fetch("uuid", order_by="uuid")
+    if not len(parent_uuids):
         return
 
-    uuid_to_str_mysql = (
-        f"CONVERT(LOWER(CONCAT("
-        f"SUBSTR(HEX({dj_other_uuid_name}), 1, 8), '-',"
-        f"SUBSTR(HEX({dj_other_uuid_name}), 9, 4), '-',"
-        f"SUBSTR(HEX({dj_other_uuid_name}), 13, 4), '-',"
-        f"SUBSTR(HEX({dj_other_uuid_name}), 17, 4), '-',"
-        f"SUBSTR(HEX({dj_other_uuid_name}), 21))) USING utf8)"
-    )
-
-    if dj_other_uuid_name == dj_parent_uuid_name:
-        dj_other_uuid_name = "other_" + dj_other_uuid_name
-
-    # other table
-    other_table_query = dj.U(
-        dj_other_uuid_name, renamed_other_field_name or dj_other_field
-    ) & dj_other_table.proj(
-        **{
-            dj_other_uuid_name: uuid_to_str_mysql,
-            renamed_other_field_name or dj_other_field: dj_other_field,
-        }
-    )
-
-    # parent-table
     if isinstance(dj_parent_fields, str):
         dj_parent_fields = [dj_parent_fields]
+    other_field_name = renamed_other_field_name or dj_other_field
 
-    parent_table_query = dj_parent_table.proj(*dj_parent_fields) * (
-        alyxraw.AlyxRaw.Field
-        & alyxraw_to_insert
-        & {"fname": alyx_field}
-        & 'fvalue!="None"'
-    ).proj(..., **{dj_parent_uuid_name: "uuid", dj_other_uuid_name: "fvalue"})
+    current_attrs = dj_current_table.heading.names
+    columns = {f: f"p.`{f}`" for f in dj_parent_fields if f in current_attrs}
+    if other_field_name in current_attrs:
+        columns[other_field_name] = "o.`value`"
 
-    # join
-    joined_tables = parent_table_query * other_table_query
-    # insert
-    try:
-        dj_current_table.insert(
-            joined_tables, ignore_extra_fields=True, skip_duplicates=True
+    connection = dj_current_table.connection
+    with _uuid_map(
+        dj_parent_table, dj_parent_uuid_name, dj_parent_fields, "_membership_parent"
+    ) as parent_map, _uuid_map(
+        dj_other_table,
+        dj_other_uuid_name,
+        {"value": dj_other_field},
+        "_membership_other",
+    ) as other_map:
+        sql = (
+            f"INSERT INTO {dj_current_table.full_table_name} "
+            f"({', '.join(f'`{c}`' for c in columns)}) "
+            f"SELECT {', '.join(columns.values())} "
+            f"FROM {alyxraw.AlyxRaw.Field.full_table_name} AS f "
+            f"JOIN {parent_map} AS p ON p.`uuid` = f.`uuid` "
+            f"JOIN {other_map} AS o "
+            f"ON o.`uuid` = UNHEX(REPLACE(f.`fvalue`, '-', '')) "
+            f"WHERE f.`fname` = %s AND f.`fvalue` != 'None' AND f.`uuid` IN ({{}}) "
+            f"ON DUPLICATE KEY UPDATE `{dj_current_table.primary_key[0]}`"
+            f" = VALUES(`{dj_current_table.primary_key[0]}`)"
         )
-    except (pymysql.err.OperationalError, dj.errors.LostConnectionError) as e:
-        # too many records to insert all at once on server side - do this in chunks
-        attrs = [n for n in dj_current_table.heading.names if not n.endswith("_ts")]
+        for i in tqdm(range(0, len(parent_uuids), chunksz), position=0, leave=False):
+            chunk = [u.bytes for u in parent_uuids[i : i + chunksz]]
+            connection.query(
+                sql.format(", ".join(["%s"] * len(chunk))), args=(alyx_field, *chunk)
+            )
+
 
-        parent_table_entries = (
-            dj.U(*[a for a in attrs if a in parent_table_query.heading.names])
-            & parent_table_query
-        ).fetch(as_dict=True)
-        other_table_entries = (
-            dj.U(*[a for a in attrs if a in other_table_query.heading.names])
-            & other_table_query
-        ).fetch(as_dict=True)
+@contextlib.contextmanager
+def _uuid_map(table, uuid_name, fields, map_name):
+    """Copy the uuid and fields of a table into a temporary table with the uuid as
+    primary key, dropped on exit
 
-        current_table_buffer = QueryBuffer(dj_current_table)
-        for parent_entry, other_entry in itertools.product(
-            parent_table_entries, other_table_entries
-        ):
-            current_table_buffer.add_to_queue1({**parent_entry, **other_entry})
-            current_table_buffer.flush_insert(skip_duplicates=True, chunksz=7500)
+    Args:
+        table (datajoint table): table to copy from
+        uuid_name (str): uuid attribute of the table, stored as "uuid"
+        fields (list or dict): attributes of the table to copy, a dict renames them
+        map_name (str): name of the temporary table
 
-        current_table_buffer.flush_insert(skip_duplicates=True)
+    Yields:
+        str: name of the temporary table
+    """
+    if not isinstance(fields, dict):
+        fields = {f: f for f in fields}
+    connection = table.connection
+    connection.query(f"DROP TEMPORARY TABLE IF EXISTS `{map_name}`")
+    connection.query(
+        f"CREATE TEMPORARY TABLE `{map_name}` (PRIMARY KEY (`uuid`)) IGNORE "
+        f"SELECT `{uuid_name}` AS `uuid`, "
+        + ", ".join(f"`{attr}` AS `{name}`" for name, attr in fields.items())
+        + f" FROM {table.full_table_name} WHERE `{uuid_name}` IS NOT NULL"
+    )
+    try:
+        yield f"`{map_name}`"
+    finally:
+        connection.query(f"DROP TEMPORARY TABLE IF EXISTS `{map_name}`")
 
 
 if __name__ == "__main__":
@@ -3,7 +3,10 @@ This script copies tuples in the shadow tables into the real tables for alyx.
 """
 
 import datetime
+import importlib
+import multiprocessing
 import os
+import time
 import traceback
 
 import datajoint as dj
@@ -111,6 +114,66 @@ DATA_TABLES = (
 EPHYS_TABLES = ("Probe",)
 
 
+def _get_table(schema, table_name):
+    if "." in table_name:
+        # handling part-table
+        master_name, part_name = table_name.split(".")
+        return getattr(getattr(schema, master_name), part_name)
+    return getattr(schema, table_name)
+
+
+def _insert_select(target_table, query, fields, skip_duplicates):
+    """Insert the entries of query into target_table with one INSERT ... SELECT
+
+    Returns:
+        int: number of inserted entries, from the cursor rowcount
+    """
+    sql = "INSERT INTO {table} ({fields}) {select}{duplicate}".format(
+        table=target_table.full_table_name,
+        fields=", ".join(f"`{f}`" for f in fields),
+        select=query.make_sql(fields),
+        duplicate=(
+            " ON DUPLICATE KEY UPDATE `{pk}`={table}.`{pk}`".format(
+                table=target_table.full_table_name, pk=target_table.primary_key[0]
+            )
+            if skip_duplicates
+            else ""
+        ),
+    )
+    return target_table.connection.query(sql).rowcount
+
+
+def _insert_chunk(target_table, q_insert, attr, values, fields, skip_duplicates):
+    """Insert q_insert restricted to the values of attr, bisecting the values on
+    error, then inserting the entries of a single value in error one by one
+
+    Returns:
+        int: number of inserted entries
+    """
+    query = q_insert & [{attr: v} for v in values]
+    try:
+        return _insert_select(target_table, query, fields, skip_duplicates)
+    except Exception:
+        if len(values) > 1:
+            half = len(values) // 2
+            return _insert_chunk(
+                target_table, q_insert, attr, values[:half], fields, skip_duplicates
+            ) + _insert_chunk(
+                target_table, q_insert, attr, values[half:], fields, skip_duplicates
+            )
+
+    transferred_count = 0
+    for key in query.fetch("KEY"):
+        try:
+            transferred_count += _insert_select(
+                target_table, q_insert & key, fields, skip_duplicates
+            )
+        except Exception:
+            print("Error when inserting {}".format((q_insert & key).fetch1()))
+            traceback.print_exc()
+    return transferred_count
+
+
 def copy_table(
     target_schema,
     src_schema,
@@ -118,16 +181,20 @@ def copy_table(
     fresh=False,
     use_uuid=True,
     backtrack_days=None,
+    chunksz=10000,
     **kwargs,
 ):
-    if "." in table_name:
-        # handling part-table
-        master_name, part_name = table_name.split(".")
-        target_table = getattr(getattr(target_schema, master_name), part_name)
-        src_table = getattr(getattr(src_schema, master_name), part_name)
-    else:
-        target_table = getattr(target_schema, table_name)
-        src_table = getattr(src_schema, table_name)
+    """Copy the entries of a shadow table missing in the real table
+
+    The entries are inserted server side with one INSERT ... SELECT. If it fails,
+    they are inserted in chunks of the values of the first primary key attribute,
+    and a chunk that fails is bisected down to the entries in error.
+
+    Returns:
+        int: number of inserted entries, counted from the cursor rowcount
+    """
+    target_table = _get_table(target_schema, table_name)
+    src_table = _get_table(src_schema, table_name)
 
     if fresh:
         target_table.insert(src_table, **kwargs)
@@ -173,57 +240,129 @@ def copy_table(
             parent_table = parent_table.proj(**parent_fk_info["attr_map"])
             q_insert &= parent_table
 
-        kwargs = {
-            **kwargs,
-            "skip_duplicates": True,
-            "ignore_extra_fields": True,
-            "allow_direct_insert": True,
-        }
-
-        transferred_count = len(q_insert)
-
+        # ignore_extra_fields
+        fields = [f for f in target_table.heading.names if f in q_insert.heading.names]
+        skip_duplicates = kwargs.get("skip_duplicates", True)
         try:
-            target_table.insert(q_insert, **kwargs)
+            return _insert_select(target_table, q_insert, fields, skip_duplicates)
         except Exception:
-            for key in q_insert.fetch("KEY"):
-                try:
-                    target_table.insert(q_insert & key, **kwargs)
-                except Exception:
-                    transferred_count -= 1
-                    print("Error when inserting {}".format((q_insert & key).fetch1()))
-                    traceback.print_exc()
+            print(f"Error when inserting {table_name}, inserting in chunks")
+
+        attr = target_table.primary_key[0]
+        values = (dj.U(attr) & q_insert).fetch(attr, order_by=attr)
+        transferred_count = 0
+        for i in range(0, len(values), chunksz):
+            transferred_count += _insert_chunk(
+                target_table,
+                q_insert,
+                attr,
+                values[i : i + chunksz],
+                fields,
+                skip_duplicates,
+            )
 
         return transferred_count
 
 
-def main(excluded_tables=[]):
+def get_copy_waves(tables):
+    """Group the tables to copy into waves, each table being in a later wave than
+    its parents, so that the tables of a wave can be copied concurrently
+
+    Args:
+        tables (list): (target_schema, src_schema, table_name) of the tables to copy
+
+    Returns:
+        list: waves, lists of items of tables
+    """
+    full_names = {
+        _get_table(target, table_name).full_table_name: (target, source, table_name)
+        for target, source, table_name in tables
+    }
+    parents = {
+        name: set(_get_table(target, table_name).parents()) & full_names.keys()
+        for name, (target, source, table_name) in full_names.items()
+    }
+    waves, copied = [], set()
+    while len(copied) < len(full_names):
+        wave = [n for n in full_names if n not in copied and parents[n] <= copied]
+        if not wave:
+            raise dj.DataJointError(
+                f"Cyclic dependencies in {full_names.keys() - copied}"
+            )
+        waves.append([full_names[n] for n in wave])
+        copied.update(wave)
+    return waves
+
+
+def _init_copy_worker():
+    # forked workers must not share the database connection of the parent process
+    dj.conn().connect()
+
+
+def _copy_table(target_name, source_name, table_name, kwargs):
+    start_time = time.time()
+    count = copy_table(
+        importlib.import_module(target_name),
+        importlib.import_module(source_name),
+        table_name,
+        **kwargs,
+    )
+    return table_name, count, time.time() - start_time
+
+
+def main(excluded_tables=[], processes=None):
+    """Copy the shadow tables into the real tables, in waves of tables whose parents
+    are copied. With processes larger than 1, the tables of a wave are copied
+    concurrently, each worker process with its own database connection.
+    """
     mods = [
         [reference, reference_ingest, REF_TABLES],
         [subject, subject_ingest, SUBJECT_TABLES],
         [action, action_ingest, ACTION_TABLES],
         [acquisition, acquisition_ingest, ACQUISITION_TABLES],
         [data, data_ingest, DATA_TABLES],
+        [ephys, ephys_ingest, ("ProbeModel", "ProbeInsertion")],
     ]
     if mode == "public":
         backtrack_days = None
     else:
         backtrack_days = 30
 
-    for (target, source, table_list) in mods:
-        for table in table_list:
-            if table in excluded_tables:
-                continue
-            print(table)
-            copy_table(target, source, table, backtrack_days=backtrack_days)
-
-    # ephys tables
-    table = "ProbeModel"
-    print(table)
-    copy_table(ephys, ephys_ingest, table)
+    tables = [
+        (target, source, table)
+        for (target, source, table_list) in mods
+        for table in table_list
+        if table not in excluded_tables
+    ]
 
-    table = "ProbeInsertion"
-    print(table)
-    copy_table(ephys, ephys_ingest, table, allow_direct_insert=True)
+    pool = None
+    if processes and processes > 1:
+        pool = multiprocessing.get_context("fork").Pool(
+            processes, initializer=_init_copy_worker
+        )
+    try:
+        for wave in get_copy_waves(tables):
+            tasks = [
+                (
+                    target.__name__,
+                    source.__name__,
+                    table,
+                    # ephys tables are copied in full
+                    dict(backtrack_days=None if target is ephys else backtrack_days),
+                )
+                for target, source, table in wave
+            ]
+            results = (
+                pool.starmap(_copy_table, tasks)
+                if pool
+                else (_copy_table(*task) for task in tasks)
+            )
+            for table, count, duration in results:
+                print(f"{table}: {count} entries copied in {duration:.1f} s")
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
 
 
 if __name__ == "__main__":
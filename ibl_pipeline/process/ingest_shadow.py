@@ -8,6 +8,7 @@ from ibl_pipeline.ingest import (
     action,
     alyxraw,
     data,
+    populate_chunks,
     reference,
     subject,
 )
@@ -76,7 +77,7 @@ if mode != "public":
     SHADOW_TABLES = SHADOW_TABLES + [ephys.ProbeModel, ephys.ProbeInsertion]
 
 
-def main(excluded_tables=[], modified_sessions_pks=None):
+def main(excluded_tables=[], modified_sessions_pks=None, relational=True):
     kwargs = dict(display_progress=True, suppress_errors=True)
 
     for t in SHADOW_TABLES:
@@ -111,45 +112,57 @@ def main(excluded_tables=[], modified_sessions_pks=None):
                         for entry in modified_session_entries:
                             t.insert1(entry, allow_direct_insert=True, replace=True)
 
-        t.populate(**kwargs)
+        populate_chunks(t, **kwargs)
 
     # ---- populate `DataSet` and `FileRecord` ----
-    # essentially calling their respective `.make()`
+    # relational: one INSERT ... SELECT per chunk of keys, see insert_from_alyxraw
+    # otherwise: essentially calling their respective `.make()`
     # but using the QueryBuffer to do batch insertion
 
     if "DataSet" not in excluded_tables:
         print("Ingesting dataset entries...")
-        data_set_buffer = QueryBuffer(data.DataSet)
-        for key in tqdm(
-            (data.DataSet.key_source - data.DataSet).fetch("KEY"), position=0
-        ):
-            data_set_buffer.add_to_queue1(data.DataSet.create_entry(key))
+        if relational:
+            n_inserted = data.DataSet.insert_from_alyxraw()
+            print(f"Inserted {n_inserted} dataset tuples")
+        else:
+            data_set_buffer = QueryBuffer(data.DataSet)
+            for key in tqdm(
+                (data.DataSet.key_source - data.DataSet).fetch("KEY"), position=0
+            ):
+                data_set_buffer.add_to_queue1(data.DataSet.create_entry(key))
+
+                if data_set_buffer.flush_insert(
+                    skip_duplicates=True, allow_direct_insert=True, chunksz=100
+                ):
+                    print("Inserted 100 dataset tuples")
 
             if data_set_buffer.flush_insert(
-                skip_duplicates=True, allow_direct_insert=True, chunksz=100
+                skip_duplicates=True, allow_direct_insert=True
             ):
-                print("Inserted 100 dataset tuples")
-
-        if data_set_buffer.flush_insert(skip_duplicates=True, allow_direct_insert=True):
-            print("Inserted all remaining dataset tuples")
+                print("Inserted all remaining dataset tuples")
 
     if "FileRecord" not in excluded_tables:
         print("Ingesting file record entries...")
-        file_record_buffer = QueryBuffer(data.FileRecord)
-        for key in tqdm(
-            (data.FileRecord.key_source - data.FileRecord).fetch("KEY"), position=0
-        ):
-            file_record_buffer.add_to_queue1(data.FileRecord.create_entry(key))
+        if relational:
+            n_inserted = data.FileRecord.insert_from_alyxraw()
+            print(f"Inserted {n_inserted} file record tuples")
+        else:
+            file_record_buffer = QueryBuffer(data.FileRecord)
+            for key in tqdm(
+                (data.FileRecord.key_source - data.FileRecord).fetch("KEY"),
+                position=0,
+            ):
+                file_record_buffer.add_to_queue1(data.FileRecord.create_entry(key))
+
+                if file_record_buffer.flush_insert(
+                    skip_duplicates=True, allow_direct_insert=True, chunksz=1000
+                ):
+                    print("Inserted 1000 raw field tuples")
 
             if file_record_buffer.flush_insert(
-                skip_duplicates=True, allow_direct_insert=True, chunksz=1000
+                skip_duplicates=True, allow_direct_insert=True
             ):
-                print("Inserted 1000 raw field tuples")
-
-        if file_record_buffer.flush_insert(
-            skip_duplicates=True, allow_direct_insert=True
-        ):
-            print("Inserted all remaining file record tuples")
+                print("Inserted all remaining file record tuples")
 
 
 if __name__ == "__main__":
@@ -7,7 +7,16 @@ import time
 import datajoint as dj
 from tqdm import tqdm
 
-from ibl_pipeline import acquisition, action, behavior, data, mode, reference, subject
+from ibl_pipeline import (
+    acquisition,
+    action,
+    behavior,
+    data,
+    mode,
+    reference,
+    subject,
+    update,
+)
 from ibl_pipeline.analyses import behavior as behavior_analyses
 from ibl_pipeline.plotting import behavior as behavior_plotting
 
@@ -15,6 +24,7 @@ BEHAVIOR_TABLES = [
     behavior.CompleteWheelSession,
     behavior.CompleteTrialSession,
     behavior.TrialSet,
+    behavior.TrialSetColumns,
     behavior.AmbientSensorData,
     behavior.Settings,
     behavior.SessionDelay,
@@ -39,18 +49,29 @@ if mode != "public":
 
 gkwargs = dict(suppress_errors=True, display_progress=True)
 
+# new sessions and datasets come from the ingestion
+WAKE_UP_EVENTS = ["ingestion"]
+
 
 def main(
     backtrack_days=30,
     excluded_tables=None,
     run_duration=3600 * 3,
     sleep_duration=60 * 10,
+    processes=None,
     **kwargs,
 ):
+    """Populate the behavior tables, then wait until one of WAKE_UP_EVENTS is notified,
+    or for at most sleep_duration seconds, before populating again.
+    Notify the event "behavior" when new trials or wheel sessions were populated.
+    PsychResults and PsychResultsBlock are first populated in batches fitted by
+    "processes" worker processes, see populate_psych_results.
+    """
     if excluded_tables is None:
         excluded_tables = []
 
     start_time = time.time()
+    event_counts = update.PipelineEvent.get_counts(WAKE_UP_EVENTS)
     while (
         (time.time() - start_time < run_duration)
         or (run_duration is None)
@@ -67,8 +88,10 @@ def main(
         # ingest those dataset and file records where exists=False when json gets dumped
         # only check those sessions where required datasets are missing.
         # populate CompleteTrialSession first with existing file records
-        behavior.CompleteTrialSession.populate(
-            f'session_start_time > "{date_cutoff}"', **gkwargs
+        update.populate_incremental(
+            behavior.CompleteTrialSession,
+            f'session_start_time > "{date_cutoff}"',
+            **gkwargs,
         )
         sessions_missing = (
             (acquisition.Session - behavior.CompleteTrialSession)
@@ -83,6 +106,11 @@ def main(
             + behavior.CompleteTrialSession.other_datasets,
         )
 
+        date_range = f'session_start_time > "{date_cutoff}"'
+        previous_count = len(behavior.TrialSet & date_range) + len(
+            behavior.CompleteWheelSession & date_range
+        )
+
         for table in BEHAVIOR_TABLES:
 
             if table.__name__ in excluded_tables:
@@ -98,7 +126,18 @@ def main(
             else:
                 restrictor = {}
 
-            table.populate(restrictor, **gkwargs)
+            if table is behavior_analyses.PsychResults:
+                # batched fits, the sessions left are populated below
+                behavior_analyses.populate_psych_results(
+                    restrictor, processes=processes
+                )
+
+            update.populate_incremental(table, restrictor, **gkwargs)
+
+        if previous_count != len(behavior.TrialSet & date_range) + len(
+            behavior.CompleteWheelSession & date_range
+        ):
+            update.PipelineEvent.notify("behavior")
 
         print("Populating SubjectLatestEvent...")
         for key in tqdm(subject.Subject.fetch("KEY"), position=0):
@@ -145,7 +184,10 @@ def main(
                 ).delete()
             behavior_plotting.DailyLabSummary.populate(**gkwargs)
 
-        time.sleep(sleep_duration)
+        event_counts, notified = update.PipelineEvent.wait(
+            WAKE_UP_EVENTS, event_counts, timeout=sleep_duration
+        )
+        print(f"Woken up by: {notified or 'timeout'}")
 
 
 if __name__ == "__main__":
@@ -15,7 +15,7 @@ import logging
 import pathlib
 import time
 
-from ibl_pipeline import ephys, histology, mode
+from ibl_pipeline import ephys, histology, mode, update
 from ibl_pipeline.analyses import ephys as ephys_analyses
 from ibl_pipeline.plotting import ephys as ephys_plotting
 from ibl_pipeline.plotting import histology as histology_plotting
@@ -72,10 +72,17 @@ if mode != "public":
 
 gkwargs = dict(display_progress=True, suppress_errors=True)
 
+# new clusters come from the ingestion, the trials from populate_behavior
+WAKE_UP_EVENTS = ["ingestion", "behavior"]
 
-def main(exclude_plottings=False, run_duration=3600 * 3, sleep_duration=60, **kwargs):
+
+def main(exclude_plottings=False, run_duration=3600 * 3, sleep_duration=3600, **kwargs):
+    """Populate the ephys and histology tables, then wait until one of WAKE_UP_EVENTS
+    is notified, or for at most sleep_duration seconds, before populating again
+    """
 
     start_time = time.time()
+    event_counts = update.PipelineEvent.get_counts(WAKE_UP_EVENTS)
     while (
         (time.time() - start_time < run_duration)
         or (run_duration is None)
@@ -91,7 +98,7 @@ def main(exclude_plottings=False, run_duration=3600 * 3, sleep_duration=60, **kw
             if exclude_plottings and table.__module__ == "ibl_pipeline.plotting.ephys":
                 continue
             logger.log(30, "Ingesting {}...".format(table.__name__))
-            table.populate(**gkwargs)
+            update.populate_incremental(table, **gkwargs)
             logger.log(
                 30,
                 "Ingestion time of {} is {}".format(
@@ -106,7 +113,10 @@ def main(exclude_plottings=False, run_duration=3600 * 3, sleep_duration=60, **kw
             logger.log(30, f"Populating {table.__name__}...")
             table.populate(**gkwargs)
 
-        time.sleep(sleep_duration)
+        event_counts, notified = update.PipelineEvent.wait(
+            WAKE_UP_EVENTS, event_counts, timeout=sleep_duration
+        )
+        logger.log(30, f"Woken up by: {notified or 'timeout'}")
 
 
 if __name__ == "__main__":
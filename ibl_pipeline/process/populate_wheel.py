@@ -3,7 +3,7 @@ import logging
 import pathlib
 import time
 
-from ibl_pipeline import ephys, mode
+from ibl_pipeline import ephys, mode, update
 from ibl_pipeline.group_shared import wheel
 
 log_path = pathlib.Path(__file__).parent / "logs"
@@ -21,9 +21,16 @@ logger = logging.getLogger(__name__)
 
 gkwargs = dict(display_progress=True, suppress_errors=True)
 
+# new sessions come from the ingestion, CompleteWheelSession from populate_behavior
+WAKE_UP_EVENTS = ["ingestion", "behavior"]
 
-def main(backtrack_days=30, run_duration=3600 * 3, sleep_duration=60, **kwargs):
+
+def main(backtrack_days=30, run_duration=3600 * 3, sleep_duration=3600, **kwargs):
+    """Populate the wheel tables, then wait until one of WAKE_UP_EVENTS is notified,
+    or for at most sleep_duration seconds, before populating again
+    """
     start_time = time.time()
+    event_counts = update.PipelineEvent.get_counts(WAKE_UP_EVENTS)
     while (
         (time.time() - start_time < run_duration)
         or (run_duration is None)
@@ -41,7 +48,10 @@ def main(backtrack_days=30, run_duration=3600 * 3, sleep_duration=60, **kwargs):
         logger.log(25, "Populating MovementTimes...")
         wheel.MovementTimes.populate(date_range, ephys.ProbeInsertion, **gkwargs)
 
-        time.sleep(sleep_duration)
+        event_counts, notified = update.PipelineEvent.wait(
+            WAKE_UP_EVENTS, event_counts, timeout=sleep_duration
+        )
+        logger.log(25, f"Woken up by: {notified or 'timeout'}")
 
 
 if __name__ == "__main__":
@@ -216,7 +216,12 @@ def delete_non_published_records():
 
 
 # TODO: change /data /tmp to use dj.config
-def main(populate_only=False, populate_wheel=False, populate_ephys_histology=False):
+def main(
+    populate_only=False,
+    populate_wheel=False,
+    populate_ephys_histology=False,
+    processes=None,
+):
     """This function process the all the steps to get data ingested into the public database, needs rewriting
         to load data from sql dump instead.
 
@@ -225,6 +230,7 @@ def main(populate_only=False, populate_wheel=False, populate_ephys_histology=Fal
             and load entries from alyx dump in the folder /data. Defaults to False.
         populate_wheel (bool, optional): If True, populate wheel
         populate_ephys_histology (bool, optional): If True, populate ephys and histology tables
+        processes (int, optional): number of worker processes copying the real tables. Defaults to None.
     """
 
     if not populate_only:
@@ -236,7 +242,7 @@ def main(populate_only=False, populate_wheel=False, populate_ephys_histology=Fal
         logger.log(25, "Ingesting shadow membership...")
         ingest_membership.main()
         logger.log(25, "Copying to real tables...")
-        ingest_real.main()
+        ingest_real.main(processes=processes)
 
         logger.log(25, "Deleting the non published records...")
         delete_non_published_records()
@@ -1,7 +1,4 @@
-import datajoint as dj
-from tqdm import tqdm
-
-from ibl_pipeline.ingest import alyxraw
+from ibl_pipeline.ingest import alyxraw, delete_cascade, get_modified_alyxraw
 
 
 def get_created_keys(model):
@@ -40,35 +37,21 @@ def get_updated_keys(model, fields=None):
 
     Args:
         model [str]: alyx model name in table alyxraw.AlyxRaw, e.g. 'actions.session'
-        fields [list of strs]: alyx model field names that updates need to be detected
+        fields [list of strs]: alyx model field names that updates need to be detected.
+            Entries are compared by content hash unless fields is given and differs from
+            the fields of interest of the model, see ingest.ALYXRAW_FIELDS_OF_INTEREST
 
     Returns:
         modified_pks [list]: list of deleted uuids, existing in the AlyxRaw but not UpdateAlyxRaw
     """
-    fields_original = alyxraw.AlyxRaw.Field & (alyxraw.AlyxRaw & f'model="{model}"')
-    fields_update = alyxraw.UpdateAlyxRaw.Field & (
-        alyxraw.UpdateAlyxRaw & f'model="{model}"'
-    )
-
-    fields_restr = [{"fname": f} for f in fields] if fields else {}
+    return get_modified_alyxraw(model, fields=fields).fetch("KEY")
 
-    return (
-        alyxraw.AlyxRaw
-        & (
-            fields_update.proj(fvalue_new="fvalue") * fields_original
-            & "fvalue_new != fvalue"
-            & 'fname not in ("json")'
-            & fields_restr
-        )
-    ).fetch("KEY")
 
+def delete_from_alyxraw(keys, chunksz=1000):
+    """delete entries from AlyxRaw, with their AlyxRaw.Field and the dependent shadow table entries
 
-def delete_from_alyxraw(keys):
-    with dj.config(safemode=False):
-        if len(keys) < 50:
-            (alyxraw.AlyxRaw.Field & keys).delete_quick()
-            (alyxraw.AlyxRaw & keys).delete()
-        else:
-            for key in tqdm(keys, position=0):
-                (alyxraw.AlyxRaw.Field & key).delete_quick()
-                (alyxraw.AlyxRaw & key).delete()
+    Args:
+        keys [list of dicts]: keys of AlyxRaw
+        chunksz [int]: number of keys deleted per transaction, see ingest.delete_cascade
+    """
+    delete_cascade(alyxraw.AlyxRaw, keys, chunksz=chunksz)
@@ -189,10 +189,12 @@ BEHAVIOR_TABLES = [
     behavior.TrialSet,
     behavior.TrialSet.Trial,
     behavior.TrialSet.ExcludedTrial,
+    behavior.TrialSetColumns,
     behavior.AmbientSensorData,
     behavior.Settings,
     behavior.SessionDelay,
     behavior_analyses.PsychResults,
+    behavior_analyses.PsychFitCache,
     behavior_analyses.PsychResultsBlock,
     behavior_analyses.ReactionTime,
     behavior_analyses.ReactionTimeContrastBlock,
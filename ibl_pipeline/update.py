@@ -1,6 +1,11 @@
 """
-schema for update records
+schema for update records, change notifications between pipeline stages
+and watermarks of incremental populate
 """
+import datetime
+import time
+from uuid import UUID
+
 import datajoint as dj
 
 schema = dj.schema(dj.config.get("database.prefix", "") + "ibl_update")
@@ -52,3 +57,187 @@ class DeletionRecord(dj.Manual):
     notified=0:         boolean
     deleted=0:          boolean
     """
+
+
+@schema
+class PipelineEvent(dj.Manual):
+    definition = """  # change notification of a stage of the pipeline, bumped by its producer
+    event:              varchar(32)         # e.g. "ingestion", "behavior"
+    ---
+    event_count=0:      int unsigned        # incremented on every notification
+    event_ts=CURRENT_TIMESTAMP :   timestamp   # time of the latest notification
+    """
+
+    @classmethod
+    def notify(cls, event):
+        """Bump the count of an event, waking up the processes waiting for it"""
+        cls.connection.query(
+            f"INSERT INTO {cls.full_table_name} (event, event_count) VALUES (%s, 1) "
+            "ON DUPLICATE KEY UPDATE "
+            "event_count = event_count + 1, event_ts = CURRENT_TIMESTAMP",
+            args=(event,),
+        )
+
+    @classmethod
+    def get_counts(cls, events):
+        """
+        Returns:
+            dict: event -> event_count, 0 for events never notified
+        """
+        counts = dict.fromkeys(events, 0)
+        names, event_counts = (cls & [{"event": e} for e in events]).fetch(
+            "event", "event_count"
+        )
+        counts.update(zip(names, event_counts))
+        return counts
+
+    @classmethod
+    def wait(cls, events, counts=None, timeout=None, poll_interval=10):
+        """Block until one of the events is notified, only reading this small table
+        in the meantime
+
+        Args:
+            events (list of str): names of the events to wait for
+            counts (dict, optional): event counts seen by the caller, as returned by
+                get_counts or a previous call. Defaults to the current counts.
+            timeout (float, optional): maximum number of seconds to wait.
+                Defaults to None, waiting until an event is notified.
+            poll_interval (float, optional): seconds between two reads of the counts.
+                Defaults to 10.
+
+        Returns:
+            counts (dict): event counts when returning
+            notified (list): events notified since counts, empty on timeout
+        """
+        if counts is None:
+            counts = cls.get_counts(events)
+
+        start_time = time.time()
+        while True:
+            new_counts = cls.get_counts(events)
+            notified = [e for e in events if new_counts[e] != counts.get(e, 0)]
+            if notified:
+                return new_counts, notified
+
+            remaining = (
+                poll_interval
+                if timeout is None
+                else min(poll_interval, timeout - (time.time() - start_time))
+            )
+            if remaining <= 0:
+                return new_counts, []
+            time.sleep(remaining)
+
+
+@schema
+class PopulateWatermark(dj.Manual):
+    definition = """  # latest watermark attribute value of the keys considered by populate_incremental
+    table_name:         varchar(255)        # full table name
+    ---
+    watermark:          datetime(6)
+    watermark_ts=CURRENT_TIMESTAMP :   timestamp
+    """
+
+    @classmethod
+    def get_watermark(cls, table):
+        """
+        Returns:
+            datetime: watermark of table, None if it has not been recorded yet
+        """
+        watermark = (cls & {"table_name": table.full_table_name}).fetch("watermark")
+        return watermark[0] if len(watermark) else None
+
+    @classmethod
+    def set_watermark(cls, table, watermark):
+        cls.insert1(
+            {"table_name": table.full_table_name, "watermark": watermark}, replace=True
+        )
+
+
+@schema
+class PopulateErrorKey(dj.Manual):
+    definition = """  # keys whose populate failed, considered again by populate_incremental
+    table_name:         varchar(255)        # full table name
+    pk_hash:            uuid                # hash of the primary key
+    ---
+    pk_dict:            longblob
+    error_message=null: varchar(2047)
+    error_ts=CURRENT_TIMESTAMP :   timestamp
+    """
+
+    @classmethod
+    def get_keys(cls, table):
+        return list((cls & {"table_name": table.full_table_name}).fetch("pk_dict"))
+
+    @classmethod
+    def set_keys(cls, table, errors):
+        """Replace the error keys of table with the keys of errors
+
+        Args:
+            table (datajoint table): populated table
+            errors (list): (key, error message) tuples returned by populate
+        """
+        (cls & {"table_name": table.full_table_name}).delete_quick()
+        cls.insert(
+            [
+                dict(
+                    table_name=table.full_table_name,
+                    pk_hash=UUID(dj.hash.key_hash(key)),
+                    pk_dict=key,
+                    error_message=str(error)[:2047],
+                )
+                for key, error in errors
+            ],
+            skip_duplicates=True,
+        )
+
+
+# keys within this window of the watermark are considered again by populate_incremental,
+# the backtrack_days of the regular populate
+WATERMARK_LOOKBACK = datetime.timedelta(days=30)
+
+
+def populate_incremental(table, *restrictions, lookback=WATERMARK_LOOKBACK, **kwargs):
+    """Populate only the keys of table that are new since the previous call,
+    instead of evaluating the whole key_source against the table.
+
+    The table defines the class attributes
+        watermark_source: query whose primary key restricts the key_source
+        watermark_attr: datetime attribute of watermark_source recording new keys
+        watermark_retry: keys considered regardless of the watermark, for keys
+            missing because their dependencies arrive late, e.g. the log of the
+            incomplete keys
+    Keys whose watermark_attr is within lookback of the watermark are considered
+    again, as well as the keys whose populate failed, recorded in PopulateErrorKey.
+    Tables without watermark_attr are populated as usual.
+
+    Args:
+        table (datajoint table): table to populate
+        restrictions: restrictions passed to populate
+        lookback (datetime.timedelta, optional): Defaults to WATERMARK_LOOKBACK.
+        kwargs: settings passed to populate
+    """
+    table = table() if isinstance(table, type) else table
+    if not hasattr(table, "watermark_attr"):
+        return table.populate(*restrictions, **kwargs)
+
+    source, attr = table.watermark_source, table.watermark_attr
+    watermark = PopulateWatermark.get_watermark(table)
+
+    if watermark is not None:
+        new_keys = source & f'{attr} > "{watermark - lookback}"'
+        restrictions += (
+            [new_keys, table.watermark_retry, *PopulateErrorKey.get_keys(table)],
+        )
+        source = source & f'{attr} > "{watermark}"'
+
+    # taken before populating, keys arriving in the meantime are picked up next time
+    new_watermark = source.fetch(attr, order_by=f"{attr} DESC", limit=1)
+
+    result = table.populate(*restrictions, **kwargs)
+
+    if kwargs.get("suppress_errors"):
+        PopulateErrorKey.set_keys(table, result or [])
+    if len(new_watermark):
+        PopulateWatermark.set_watermark(table, new_watermark[0])
+    return result
@@ -0,0 +1,70 @@
+"""
+Utilities to read the alyx json dump (output of django `dumpdata`) incrementally.
+
+The dump is a single json array of records of the form
+{"model": ..., "pk": ..., "fields": {...}}. Loading the whole array with `json.load`
+requires memory in the order of several times the file size, the helpers here decode
+one record at a time so memory is bounded by the largest record.
+"""
+
+import json
+
+_decoder = json.JSONDecoder()
+_whitespace = " \t\n\r"
+
+
+def iter_json_array(filename, chunk_size=2**20):
+    """Stream the elements of a top-level json array from a file, one at a time.
+
+    Args:
+        filename (str or pathlib.Path): path to the json file
+        chunk_size (int, optional): number of characters read from disk at a time. Defaults to 1 MB.
+
+    Yields:
+        decoded json element (a dict for alyx dumps)
+    """
+    with open(filename, "r") as f:
+        buf = f.read(chunk_size)
+        idx = _skip(buf, 0, _whitespace)
+        if idx == len(buf) or buf[idx] != "[":
+            raise ValueError(f"{filename} does not contain a json array")
+        idx += 1
+        eof = False
+        read_size = chunk_size
+
+        while True:
+            idx = _skip(buf, idx, _whitespace + ",")
+            if idx < len(buf) and buf[idx] == "]":
+                return
+            try:
+                obj, end = _decoder.raw_decode(buf, idx)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                # element truncated at the end of the buffer, read more.
+                # grow the read size so that huge elements are not re-parsed too often
+                buf = buf[idx:]
+                idx = 0
+                more = f.read(read_size)
+                eof = not more
+                buf += more
+                read_size *= 2
+                continue
+
+            read_size = chunk_size
+            yield obj
+            idx = end
+
+            if idx >= chunk_size:
+                buf = buf[idx:]
+                idx = 0
+            if not eof and len(buf) - idx < chunk_size:
+                more = f.read(chunk_size)
+                eof = not more
+                buf += more
+
+
+def _skip(buf, idx, chars):
+    while idx < len(buf) and buf[idx] in chars:
+        idx += 1
+    return idx
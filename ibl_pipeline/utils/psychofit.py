@@ -14,7 +14,9 @@ these functions:
 
 Functions in the toolbox are:
   mle_fit_psycho     - Maximumum likelihood fit of psychometric function
+  mle_fit_psycho_lbfgsb - Same fit, with analytic gradients and L-BFGS-B
   neg_likelihood     - Negative likelihood of a psychometric function
+  neg_likelihood_grad - Negative likelihood and its gradient
 
 For more info, see:
   Examples           - Examples of use of psychofit toolbox
@@ -204,6 +206,202 @@ def neg_likelihood(pars, data, P_model="weibull", parmin=None, parmax=None):
     return l
 
 
+def mle_fit_psycho_lbfgsb(
+    data,
+    P_model="weibull",
+    parstart=None,
+    parmin=None,
+    parmax=None,
+    nfits=5,
+    warm_start=None,
+    seed=0,
+):
+    """
+    Maximumum likelihood fit of psychometric function with the analytic gradient
+    of the negative likelihood and the bounded quasi-Newton optimizer L-BFGS-B.
+
+    Same arguments and defaults as mle_fit_psycho. The fits start from warm_start
+    if given, then parstart, then random points within the bounds drawn with a
+    fixed seed, so that the result is deterministic.
+
+    Args:
+        data: 3 x n matrix where first row corrsponds to stim levels (%),
+            the second to number of trials for each stim level (int),
+            the third to proportion correct (float between 0 and 1)
+        P_model: The psychometric function. Possibilities include 'weibull'
+            (DEFAULT), 'weibull50', 'erf_psycho' and 'erf_psycho_2gammas'
+        parstart: Non-zero starting parameters. If None, some reasonable defaults
+            are used.
+        parmin: Minimum parameter values.  If None, some reasonable defaults
+            are used
+        parmax: Maximum parameter values.  If None, some reasonable defaults
+            are used
+        nfits: the number of fits
+        warm_start: parameters of a previous fit, e.g. of the previous session,
+            used as the first starting point. Defaults to None.
+        seed: seed of the random starting points. Defaults to 0.
+
+    Returns:
+        pars: The parameters from the best of the fits
+        L: The likliehood of the best fit
+
+    Raises:
+        TypeError: data must be a list or numpy array
+        ValueError: data must be m by 3 matrix
+    """
+    # Input validation
+    if isinstance(data, (list, tuple)):
+        data = np.array(data)
+    elif not isinstance(data, np.ndarray):
+        raise TypeError("data must be a list or numpy array")
+
+    if data.shape[0] != 3:
+        raise ValueError("data must be m by 3 matrix")
+
+    if parstart is None:
+        parstart = np.array([np.mean(data[0, :]), 3.0, 0.05])
+    if parmin is None:
+        parmin = np.array([np.min(data[0, :]), 0.0, 0.0])
+    if parmax is None:
+        parmax = np.array([np.max(data[0, :]), 10.0, 0.4])
+    parmin = np.asarray(parmin, dtype=float)
+    parmax = np.asarray(parmax, dtype=float)
+
+    # the scale parameter divides the stim levels, keep it strictly positive
+    scale_index = 0 if P_model in ("weibull", "weibull50") else 1
+    lower = parmin.copy()
+    lower[scale_index] = max(lower[scale_index], _MIN_SCALE)
+    bounds = list(zip(lower, np.maximum(parmax, lower)))
+
+    # find the good values in pp (conditions that were effectively run)
+    ii = np.isfinite(data[2, :])
+    data = data[:, ii]
+
+    rng = np.random.default_rng(seed)
+    starts = [] if warm_start is None else [np.asarray(warm_start, dtype=float)]
+    starts.append(np.asarray(parstart, dtype=float))
+    while len(starts) < nfits:
+        starts.append(parmin + rng.random(parmin.size) * (parmax - parmin))
+
+    best_pars, best_l = None, np.inf
+    for start in starts[:nfits]:
+        result = scipy.optimize.minimize(
+            neg_likelihood_grad,
+            np.clip(start, lower, np.maximum(parmax, lower)),
+            args=(data, P_model),
+            jac=True,
+            method="L-BFGS-B",
+            bounds=bounds,
+        )
+        if result.fun < best_l:
+            best_pars, best_l = result.x, result.fun
+
+    return best_pars, -best_l
+
+
+_MIN_SCALE = 1e-6
+
+
+def neg_likelihood_grad(pars, data, P_model="weibull"):
+    """
+    Negative likelihood of a psychometric function and its gradient with respect
+    to the parameters, without the parameter bounds of neg_likelihood, which are
+    left to the optimizer.
+
+    Args:
+        pars: Model parameters [threshold, slope, gamma], or if
+            using the 'erf_psycho_2gammas' model append a second gamma value.
+        data: 3 x n matrix where first row corrsponds to stim levels (%),
+            the second to number of trials for each stim level (int),
+            the third to proportion correct (float between 0 and 1)
+        P_model: The psychometric function. Possibilities include 'weibull'
+            (DEFAULT), 'weibull50', 'erf_psycho' and 'erf_psycho_2gammas'
+
+    Returns:
+        l: The negative likelihood of the parameters, see neg_likelihood
+        grad: The gradient of l with respect to pars
+
+    Raises:
+        ValueError: invalid model, options are "weibull",
+                    "weibull50", "erf_psycho" and "erf_psycho_2gammas"
+    """
+    xx, nn, pp = data
+    try:
+        probs, dprobs = _psycho_grad_dispatcher[P_model](np.asarray(pars), xx)
+    except KeyError:
+        raise ValueError(
+            'invalid model, options are "weibull", '
+            + '"weibull50", "erf_psycho" and "erf_psycho_2gammas"'
+        )
+
+    # as in neg_likelihood, probabilities of 0 or 1 are moved by eps
+    eps = np.finfo(float).eps
+    clipped = (probs <= 0) | (probs >= 1)
+    probs = np.clip(probs, eps, 1 - eps)
+
+    l = -np.sum(nn * (pp * np.log(probs) + (1 - pp) * np.log(1 - probs)))
+    dl_dprobs = -nn * (pp / probs - (1 - pp) / (1 - probs))
+    dl_dprobs[clipped] = 0
+    return l, dprobs @ dl_dprobs
+
+
+def _weibull_grad(pars, xx, floor):
+    """Weibull function from floor to 1 and its gradient, floor being 0 for
+    weibull and 0.5 for weibull50"""
+    alpha, beta, gamma = pars
+    # amplitude 1 - 2 * gamma for weibull, 0.5 - gamma for weibull50
+    damplitude_dgamma = 2 if floor == 0 else 1
+    amplitude = 1 - floor - damplitude_dgamma * gamma
+    ratio = xx / alpha
+    with np.errstate(divide="ignore", invalid="ignore"):
+        uu = ratio**beta
+        log_ratio = np.where(ratio > 0, np.log(ratio), 0)
+    ee = np.exp(-uu)
+    probs = (1 - gamma) - amplitude * ee
+    dprobs = np.vstack(
+        [
+            -amplitude * ee * uu * beta / alpha,
+            amplitude * ee * uu * log_ratio,
+            -1 + damplitude_dgamma * ee,
+        ]
+    )
+    return probs, dprobs
+
+
+def _erf_psycho_2gammas_grad(pars, xx):
+    """erf_psycho_2gammas and its gradient"""
+    threshold, slope, gamma1, gamma2 = pars
+    zz = (xx - threshold) / slope
+    cdf = (erf(zz) + 1) / 2
+    dcdf_dz = np.exp(-(zz**2)) / np.sqrt(np.pi)
+    amplitude = 1 - gamma1 - gamma2
+    probs = gamma1 + amplitude * cdf
+    dprobs = np.vstack(
+        [
+            -amplitude * dcdf_dz / slope,
+            -amplitude * dcdf_dz * zz / slope,
+            1 - cdf,
+            -cdf,
+        ]
+    )
+    return probs, dprobs
+
+
+def _erf_psycho_grad(pars, xx):
+    """erf_psycho and its gradient, erf_psycho_2gammas with equal lapse rates"""
+    threshold, slope, gamma = pars
+    probs, dprobs = _erf_psycho_2gammas_grad([threshold, slope, gamma, gamma], xx)
+    return probs, np.vstack([dprobs[0], dprobs[1], dprobs[2] + dprobs[3]])
+
+
+_psycho_grad_dispatcher = {
+    "weibull": functools.partial(_weibull_grad, floor=0),
+    "weibull50": functools.partial(_weibull_grad, floor=0.5),
+    "erf_psycho": _erf_psycho_grad,
+    "erf_psycho_2gammas": _erf_psycho_2gammas_grad,
+}
+
+
 def weibull(pars, xx):
     """
     Weibull function from 0 to 1, with lapse rate.
@@ -0,0 +1,76 @@
+"""
+This script measures the import time of the ibl_pipeline schema modules, each in a
+fresh python process with `python -X importtime`, and checks that importing them
+does not create the ONE api instance.
+
+Usage: python benchmark_import_time.py [module ...] [--repeat N]
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+MODULES = [
+    "ibl_pipeline",
+    "ibl_pipeline.reference",
+    "ibl_pipeline.subject",
+    "ibl_pipeline.acquisition",
+    "ibl_pipeline.data",
+    "ibl_pipeline.qc",
+    "ibl_pipeline.ingest.data",
+    "ibl_pipeline.ingest.qc",
+]
+
+CODE = """
+import {module}
+import ibl_pipeline
+print(ibl_pipeline.one._initialized)
+"""
+
+
+def time_import(module):
+    """Import module in a fresh process
+
+    Returns:
+        wall_time (float): seconds to run the process
+        import_time (float): seconds reported by -X importtime for the module
+        one_initialized (bool): whether the ONE api instance was created
+    """
+    start = time.time()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", CODE.format(module=module)],
+        capture_output=True,
+        text=True,
+    )
+    wall_time = time.time() - start
+    if result.returncode:
+        raise RuntimeError(f"Failed to import {module}:\n{result.stderr}")
+
+    # lines of the form "import time: self [us] | cumulative | imported package"
+    import_time = 0
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:") and line.split("|")[-1].strip() == module:
+            import_time = int(line.split("|")[1]) / 1e6
+
+    return wall_time, import_time, result.stdout.strip().endswith("True")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("modules", nargs="*", default=MODULES)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'module':<30} {'wall [s]':>10} {'import [s]':>10}  one")
+    for module in args.modules:
+        timings = [time_import(module) for _ in range(args.repeat)]
+        wall_time = statistics.median(t[0] for t in timings)
+        import_time = statistics.median(t[1] for t in timings)
+        one_initialized = any(t[2] for t in timings)
+        print(
+            f"{module:<30} {wall_time:>10.2f} {import_time:>10.2f}  "
+            f"{'initialized' if one_initialized else 'lazy'}"
+        )
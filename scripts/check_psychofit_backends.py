@@ -0,0 +1,145 @@
+"""
+This script checks that the L-BFGS-B backend of psychofit is numerically
+equivalent to the fmin path of mle_fit_psycho:
+    + the analytic gradients of neg_likelihood_grad match finite differences
+    + neg_likelihood_grad matches neg_likelihood within the parameter bounds
+    + on simulated sessions, the fits of mle_fit_psycho_lbfgsb are at least as
+      likely as the fits of mle_fit_psycho, with close parameters
+It also reports the time taken by both backends.
+
+Usage: python check_psychofit_backends.py [--n-sessions N] [--seed S]
+"""
+
+import argparse
+import sys
+import time
+
+import numpy as np
+import scipy.optimize
+
+from ibl_pipeline.utils import psychofit as psy
+
+CONTRASTS = np.array([-100, -25, -12.5, -6.25, 0, 6.25, 12.5, 25, 100])
+
+# model, true parameters, parstart, parmin, parmax, stim levels
+MODELS = {
+    "erf_psycho_2gammas": (
+        np.array([5.0, 15.0, 0.1, 0.05]),
+        np.array([0.0, 20.0, 0.05, 0.05]),
+        np.array([-100.0, 0.0, 0.0, 0.0]),
+        np.array([100.0, 100.0, 1, 1]),
+        CONTRASTS,
+    ),
+    "erf_psycho": (
+        np.array([-5.0, 20.0, 0.08]),
+        np.array([0.0, 20.0, 0.05]),
+        np.array([-100.0, 0.0, 0.0]),
+        np.array([100.0, 100.0, 0.4]),
+        CONTRASTS,
+    ),
+    "weibull": (
+        np.array([20.0, 2.0, 0.05]),
+        np.array([25.0, 3.0, 0.05]),
+        np.array([1.0, 0.0, 0.0]),
+        np.array([100.0, 10.0, 0.4]),
+        CONTRASTS[CONTRASTS > 0],
+    ),
+    "weibull50": (
+        np.array([15.0, 1.5, 0.05]),
+        np.array([25.0, 3.0, 0.05]),
+        np.array([1.0, 0.0, 0.0]),
+        np.array([100.0, 10.0, 0.4]),
+        CONTRASTS[CONTRASTS > 0],
+    ),
+}
+
+MODEL_FUNCTIONS = {
+    "erf_psycho_2gammas": psy.erf_psycho_2gammas,
+    "erf_psycho": psy.erf_psycho,
+    "weibull": psy.weibull,
+    "weibull50": psy.weibull50,
+}
+
+
+def simulate_session(rng, model, pars, xx, n_per_level=40):
+    probs = MODEL_FUNCTIONS[model](pars, xx)
+    nn = rng.integers(n_per_level // 2, n_per_level * 2, size=xx.size)
+    return np.vstack([xx, nn, rng.binomial(nn, probs) / nn])
+
+
+def check_gradients(rng, model, pars, parmin, parmax, xx, n_points=20):
+    """Largest relative error between the analytic and finite difference gradients"""
+    data = simulate_session(rng, model, pars, xx)
+    max_error = 0
+    for _ in range(n_points):
+        # away from the bounds, where neg_likelihood adds its penalty
+        point = parmin + (0.1 + 0.8 * rng.random(parmin.size)) * (parmax - parmin)
+        l, grad = psy.neg_likelihood_grad(point, data, model)
+        assert np.isclose(l, psy.neg_likelihood(point, data, model, parmin, parmax))
+        approx = scipy.optimize.approx_fprime(
+            point, lambda p: psy.neg_likelihood_grad(p, data, model)[0], 1e-7
+        )
+        error = np.max(np.abs(grad - approx) / np.maximum(1, np.abs(approx)))
+        max_error = max(max_error, error)
+    return max_error
+
+
+def compare_fits(rng, model, pars, parstart, parmin, parmax, xx, n_sessions):
+    """Compare both backends on simulated sessions
+
+    Returns:
+        worse_count (int): number of sessions where the L-BFGS-B fit is less likely
+        max_par_diff (float): largest parameter difference relative to the bounds
+        durations (tuple): seconds taken by fmin and L-BFGS-B
+    """
+    worse_count, max_par_diff, fmin_time, lbfgsb_time = 0, 0, 0, 0
+    for _ in range(n_sessions):
+        data = simulate_session(rng, model, pars, xx)
+        kwargs = dict(P_model=model, parstart=parstart, parmin=parmin, parmax=parmax)
+
+        start = time.time()
+        pars_fmin, l_fmin = psy.mle_fit_psycho(data, **kwargs)
+        fmin_time += time.time() - start
+
+        start = time.time()
+        pars_lbfgsb, l_lbfgsb = psy.mle_fit_psycho_lbfgsb(data, **kwargs)
+        lbfgsb_time += time.time() - start
+
+        # likelihoods are maximized, allow for the tolerance of fmin
+        if l_lbfgsb < l_fmin - 1e-3 * max(1, abs(l_fmin)):
+            worse_count += 1
+        max_par_diff = max(
+            max_par_diff,
+            np.max(np.abs(pars_fmin - pars_lbfgsb) / (parmax - parmin)),
+        )
+    return worse_count, max_par_diff, (fmin_time, lbfgsb_time)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--n-sessions", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    # the random restarts of mle_fit_psycho use the global random state
+    np.random.seed(args.seed)
+
+    failed = False
+    print(
+        f"{'model':<20} {'grad err':>10} {'worse':>6} {'par diff':>9} "
+        f"{'fmin [s]':>9} {'lbfgsb [s]':>10}"
+    )
+    for model, (pars, parstart, parmin, parmax, xx) in MODELS.items():
+        grad_error = check_gradients(rng, model, pars, parmin, parmax, xx)
+        worse_count, par_diff, (fmin_time, lbfgsb_time) = compare_fits(
+            rng, model, pars, parstart, parmin, parmax, xx, args.n_sessions
+        )
+        print(
+            f"{model:<20} {grad_error:>10.1e} {worse_count:>6} {par_diff:>9.3f} "
+            f"{fmin_time:>9.2f} {lbfgsb_time:>10.2f}"
+        )
+        failed |= grad_error > 1e-4 or worse_count > 0
+
+    sys.exit(int(failed))
@@ -0,0 +1,43 @@
+"""
+This script adds the content_hash and fields_hash fields to the tables AlyxRaw and
+UpdateAlyxRaw, and computes them for the existing entries from their AlyxRaw.Field.
+"""
+
+import datajoint as dj
+from tqdm import tqdm
+
+from ibl_pipeline.ingest import alyxraw, get_alyxraw_hashes
+from ibl_pipeline.utils import dj_alter_table
+
+
+def table_add_hash_columns(table):
+    print("Altering " + table.full_table_name + "...")
+    for name, comment in (
+        ("content_hash", "md5 of the sorted fields except json, computed at ingest"),
+        ("fields_hash", "md5 of the fields of interest of the model, if any"),
+    ):
+        if name not in table.heading.names:
+            dj_alter_table.add_column(table, name, "char(32)", comment=comment)
+
+
+def table_fill_hashes(table, chunksz=5000):
+    models = dj.U("model") & table
+    for model in models.fetch("model"):
+        uuids = (table & {"model": model} & "content_hash is null").fetch("KEY")
+        print(f"Computing hashes of {len(uuids)} {model} entries...")
+        for i in tqdm(range(0, len(uuids), chunksz), position=0):
+            keys = uuids[i : i + chunksz]
+            field_entries = {key["uuid"]: [] for key in keys}
+            for entry in (table.Field & keys).fetch(as_dict=True):
+                field_entries[entry["uuid"]].append(entry)
+            with table.connection.transaction:
+                for uuid, entries in field_entries.items():
+                    for name, value in get_alyxraw_hashes(model, entries).items():
+                        dj.Table._update(table & {"uuid": uuid}, name, value)
+
+
+if __name__ == "__main__":
+
+    for table in (alyxraw.AlyxRaw(), alyxraw.UpdateAlyxRaw()):
+        table_add_hash_columns(table)
+        table_fill_hashes(table)